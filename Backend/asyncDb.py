@@ -0,0 +1,86 @@
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import contextvars
+import functools
+import os
+
+
+class DbExecutor:
+    """
+    Runs blocking psycopg2 work on a dedicated thread pool so the event loop
+    keeps serving other requests while a query is in flight.
+
+    Concurrency is capped by an asyncio semaphore sized to the connection
+    pool, so waiting callers queue cheaply on the loop instead of holding a
+    thread that would only block on pool checkout.
+    """
+
+    def __init__(self, max_workers: int):
+        self.max_workers = max_workers
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="db")
+        self._slots = asyncio.Semaphore(max_workers)
+        self._queued = 0
+        self._in_flight = 0
+        self._completed = 0
+
+    async def run(self, fn, *args, **kwargs):
+        self._queued += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self._queued -= 1
+        self._in_flight += 1
+        try:
+            loop = asyncio.get_running_loop()
+            # Copy the request context so stage timings land on the calling request
+            ctx = contextvars.copy_context()
+            return await loop.run_in_executor(self._executor, functools.partial(ctx.run, fn, *args, **kwargs))
+        finally:
+            self._in_flight -= 1
+            self._completed += 1
+            self._slots.release()
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+
+    def stats(self):
+        return {
+            "max_workers": self.max_workers,
+            "queued": self._queued,
+            "in_flight": self._in_flight,
+            "completed": self._completed,
+        }
+
+
+_executor = None
+
+
+def init_db_executor():
+    """
+    Create the shared DB executor. Called once at application startup.
+    """
+    global _executor
+    if _executor is None:
+        _executor = DbExecutor(int(os.getenv("db_pool_max", "10")))
+    return _executor
+
+
+def get_db_executor():
+    return _executor if _executor is not None else init_db_executor()
+
+
+def close_db_executor():
+    """
+    Wait for in-flight queries and stop the DB threads. Called at shutdown.
+    """
+    global _executor
+    executor, _executor = _executor, None
+    if executor is not None:
+        executor.shutdown()
+
+
+async def run_db(fn, *args, **kwargs):
+    """
+    Await a blocking database call on the shared DB executor.
+    """
+    return await get_db_executor().run(fn, *args, **kwargs)
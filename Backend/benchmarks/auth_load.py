@@ -0,0 +1,141 @@
+"""
+Load benchmark for the auth endpoints.
+
+Drives a running backend at increasing concurrency and prints throughput and
+latency percentiles per level. With the DB calls off the event loop, p99
+should stay roughly flat as concurrency rises until the DB pool saturates.
+
+    python benchmarks/auth_load.py --url http://localhost:8000 \
+        --email farmer@example.com --password secret --levels 1,8,32,64
+"""
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode, urlsplit
+import argparse
+import http.client
+import json
+import threading
+import time
+
+
+def percentile(samples, pct):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+class HttpDriver:
+    """
+    Issues requests over one keep-alive connection per worker thread.
+    """
+
+    def __init__(self, base_url, timeout=30.0):
+        parts = urlsplit(base_url)
+        self.host = parts.hostname
+        self.port = parts.port or (443 if parts.scheme == "https" else 80)
+        self.https = parts.scheme == "https"
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            cls = http.client.HTTPSConnection if self.https else http.client.HTTPConnection
+            conn = cls(self.host, self.port, timeout=self.timeout)
+            self._local.conn = conn
+        return conn
+
+    def request(self, method, path, params=None, body=None, headers=None):
+        """
+        Return (status, seconds). Status 0 means a transport error.
+        """
+        url = path + ("?" + urlencode(params) if params else "")
+        started = time.perf_counter()
+        try:
+            conn = self._connection()
+            conn.request(method, url, body=body, headers=headers or {})
+            response = conn.getresponse()
+            response.read()
+            status = response.status
+        except (OSError, http.client.HTTPException):
+            self._local.conn = None
+            status = 0
+        return status, time.perf_counter() - started
+
+
+def run_level(call, concurrency, total):
+    """
+    Run ``call`` ``total`` times across ``concurrency`` threads.
+    """
+    latencies, errors = [], 0
+    lock = threading.Lock()
+
+    def worker(_):
+        nonlocal errors
+        status, seconds = call()
+        with lock:
+            latencies.append(seconds)
+            if status == 0 or status >= 500:
+                errors += 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(worker, range(total)))
+    elapsed = time.perf_counter() - started
+    return {
+        "concurrency": concurrency,
+        "requests": total,
+        "errors": errors,
+        "rps": total / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+    }
+
+
+def print_table(rows, title=""):
+    if title:
+        print(title)
+    print(f"{'conc':>6} {'reqs':>7} {'err':>5} {'rps':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for row in rows:
+        print(f"{row['concurrency']:>6} {row['requests']:>7} {row['errors']:>5} {row['rps']:>9.1f} "
+              f"{row['p50_ms']:>9.1f} {row['p95_ms']:>9.1f} {row['p99_ms']:>9.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--endpoint", choices=["login", "getUserInfo"], default="getUserInfo")
+    parser.add_argument("--email", help="existing user for /login and to resolve the userId")
+    parser.add_argument("--password")
+    parser.add_argument("--user-id", help="userId for /getUserInfo (resolved via /login when omitted)")
+    parser.add_argument("--levels", default="1,8,32,64")
+    parser.add_argument("--requests-per-worker", type=int, default=50)
+    args = parser.parse_args()
+
+    driver = HttpDriver(args.url)
+    if args.endpoint == "login":
+        credentials = {"email": args.email, "password": args.password}
+
+        def call():
+            return driver.request("POST", "/login", credentials)
+    else:
+        user_id = args.user_id
+        if user_id is None:
+            conn = http.client.HTTPConnection(driver.host, driver.port, timeout=30)
+            conn.request("POST", "/login?" + urlencode({"email": args.email, "password": args.password}))
+            user_id = json.loads(conn.getresponse().read())["user"]["userId"]
+
+        def call():
+            return driver.request("GET", "/getUserInfo", {"userId": user_id})
+
+    call()  # warm the pool and the server
+    rows = []
+    for level in [int(v) for v in args.levels.split(",")]:
+        rows.append(run_level(call, level, level * args.requests_per_worker))
+    print_table(rows, f"/{args.endpoint} against {args.url}")
+
+
+if __name__ == "__main__":
+    main()
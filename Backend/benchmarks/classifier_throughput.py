@@ -0,0 +1,105 @@
+"""
+CPU throughput benchmark of the local crop classifier (cropClassifier.py).
+
+Runs the ONNX model directly at several batch sizes and reports images/s
+and per-batch latency, then pushes --requests concurrent classify() calls
+through the micro-batcher as /crop would. Needs onnxruntime and numpy.
+
+    python benchmarks/classifier_throughput.py models/crop.onnx --labels models/crop.labels.json \
+        --images uploads/*.jpeg --batch-sizes 1,4,8,16 --threads 4
+"""
+import argparse
+import asyncio
+import io
+import os
+import random
+import sys
+import time
+
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from auth_load import percentile  # noqa: E402
+from cropClassifier import CropClassifier, load_labels  # noqa: E402
+from imagePreprocess import preprocess_image  # noqa: E402
+
+
+def load_images(paths, count, seed=1):
+    """
+    Prepared JPEGs from the given files, or random stand-ins.
+    """
+    if paths:
+        images = []
+        for path in paths:
+            with open(path, "rb") as f:
+                images.append(preprocess_image(f.read()))
+        return images
+    rng = random.Random(seed)
+    images = []
+    for _ in range(count):
+        buf = io.BytesIO()
+        Image.frombytes("RGB", (640, 480), rng.randbytes(640 * 480 * 3)).save(buf, "JPEG", quality=85)
+        images.append(preprocess_image(buf.getvalue()))
+    return images
+
+
+def sweep(classifier, images, batch_sizes, rounds):
+    print(f"{'batch':>6} {'img/s':>9} {'p50 ms':>9} {'p95 ms':>9}")
+    for size in batch_sizes:
+        payloads = [images[i % len(images)].data for i in range(size)]
+        classifier._run_batch(payloads)  # warm
+        samples = []
+        started = time.perf_counter()
+        for _ in range(rounds):
+            batch_started = time.perf_counter()
+            classifier._run_batch(payloads)
+            samples.append(time.perf_counter() - batch_started)
+        elapsed = time.perf_counter() - started
+        print(f"{size:>6} {size * rounds / elapsed:>9.1f} {percentile(samples, 50) * 1000:>9.1f} "
+              f"{percentile(samples, 95) * 1000:>9.1f}")
+
+
+async def concurrent(classifier, images, requests):
+    classifier.start()
+    latencies = []
+
+    async def one(prepared):
+        started = time.perf_counter()
+        await classifier.classify(prepared)
+        latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(images[i % len(images)]) for i in range(requests)))
+    elapsed = time.perf_counter() - started
+    await classifier.stop()
+    stats = classifier.stats()
+    print(f"\n{requests} concurrent classify() calls: {requests / elapsed:.1f} img/s, "
+          f"p50 {percentile(latencies, 50) * 1000:.1f} ms, p95 {percentile(latencies, 95) * 1000:.1f} ms, "
+          f"avg batch {stats['images'] / max(1, stats['batches']):.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("model")
+    parser.add_argument("--labels", help="defaults to <model>.labels.json")
+    parser.add_argument("--images", nargs="*")
+    parser.add_argument("--batch-sizes", default="1,4,8,16,32")
+    parser.add_argument("--rounds", type=int, default=20)
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--requests", type=int, default=256)
+    parser.add_argument("--max-batch", type=int, default=16, help="micro-batch size for the concurrent run")
+    args = parser.parse_args()
+
+    labels = load_labels(args.labels or os.path.splitext(args.model)[0] + ".labels.json")
+    images = load_images(args.images, 32)
+    started = time.perf_counter()
+    classifier = CropClassifier(args.model, labels, batch_size=args.max_batch, threads=args.threads)
+    print(f"Model loaded and warmed in {(time.perf_counter() - started) * 1000:.0f} ms "
+          f"({len(labels)} classes, input {classifier.input_size}px, {args.threads or os.cpu_count()} threads)\n")
+    sweep(classifier, images, [int(size) for size in args.batch_sizes.split(",")], args.rounds)
+    asyncio.run(concurrent(classifier, images, args.requests))
+
+
+if __name__ == "__main__":
+    main()
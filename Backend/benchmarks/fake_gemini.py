@@ -0,0 +1,185 @@
+"""
+Local stand-in for the Gemini REST API, for benchmarks and offline runs.
+
+Answers ``:generateContent`` and ``:streamGenerateContent`` for any model
+after a configurable delay, and can inject rate-limit / server errors.
+Point the backend at it with ``gemini_api_endpoint``:
+
+    python benchmarks/fake_gemini.py --port 8089 --latency-ms 400 --error-rate 0.02
+    gemini_api_endpoint=http://127.0.0.1:8089 gemini_api=fake uvicorn main:app
+
+Requests that ask for ``application/json`` get a crop diagnosis (a JSON
+array with one entry per image when several images are sent); everything
+else gets a short text answer, split into chunks when streamed.
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import argparse
+import json
+import random
+import threading
+import time
+
+DIAGNOSIS = {
+    "crop_name": "maize",
+    "growth_stage": "vegetative",
+    "health_status": "northern corn leaf blight",
+    "recommendations": "Apply a recommended fungicide, remove infected leaves and rotate crops next season.",
+}
+ANSWER = ("Water your maize early in the morning and check the soil moisture a few centimetres "
+          "below the surface before irrigating again. Mulching helps keep the moisture in.")
+
+
+class FakeGemini:
+    """
+    Settings and counters shared by the request handlers.
+    """
+
+    def __init__(self, latency_ms=300.0, jitter_ms=50.0, error_rate=0.0, stream_chunks=8, chunk_delay_ms=30.0, seed=1):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.stream_chunks = stream_chunks
+        self.chunk_delay_ms = chunk_delay_ms
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.stats = {"requests": 0, "errors_injected": 0, "images": 0}
+
+    def delay(self):
+        with self._lock:
+            jitter = self._random.uniform(-self.jitter_ms, self.jitter_ms)
+        time.sleep(max(0.0, self.latency_ms + jitter) / 1000)
+
+    def should_fail(self):
+        with self._lock:
+            self.stats["requests"] += 1
+            if self._random.random() < self.error_rate:
+                self.stats["errors_injected"] += 1
+                return self._random.choice((429, 503))
+        return None
+
+    def answer(self, request):
+        config = request.get("generationConfig") or request.get("generation_config") or {}
+        mime = config.get("responseMimeType") or config.get("response_mime_type")
+        images = sum(
+            1 for content in request.get("contents", []) for part in content.get("parts", [])
+            if "inlineData" in part or "inline_data" in part
+        )
+        with self._lock:
+            self.stats["images"] += images
+        if mime == "application/json":
+            return json.dumps([DIAGNOSIS] * images if images > 1 else DIAGNOSIS)
+        return ANSWER
+
+
+def prompt_tokens(request):
+    """
+    Roughly what Gemini would bill: four characters per text token and a
+    flat 258 tokens per image.
+    """
+    contents = list(request.get("contents", []))
+    instruction = request.get("systemInstruction") or request.get("system_instruction")
+    if instruction:
+        contents.append(instruction)
+    tokens = 0
+    for content in contents:
+        for part in content.get("parts", []):
+            tokens += len(part["text"]) // 4 if "text" in part else 258
+    return max(1, tokens)
+
+
+def _candidate(text, prompt_token_count=1):
+    return {
+        "candidates": [{"content": {"parts": [{"text": text}], "role": "model"}, "finishReason": "STOP", "index": 0}],
+        "usageMetadata": {"promptTokenCount": prompt_token_count, "candidatesTokenCount": len(text) // 4},
+    }
+
+
+def make_handler(fake: FakeGemini):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def _send_json(self, status, payload):
+            body = json.dumps(payload).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            path = self.path.split("?", 1)[0]
+            if not (path.endswith(":generateContent") or path.endswith(":streamGenerateContent")):
+                return self._send_json(404, {"error": {"code": 404, "message": "Not found", "status": "NOT_FOUND"}})
+
+            fake.delay()
+            failure = fake.should_fail()
+            if failure:
+                status = "RESOURCE_EXHAUSTED" if failure == 429 else "UNAVAILABLE"
+                return self._send_json(failure, {"error": {"code": failure, "message": "injected", "status": status}})
+
+            request = json.loads(body or b"{}")
+            text = fake.answer(request)
+            if path.endswith(":generateContent"):
+                return self._send_json(200, _candidate(text, prompt_tokens(request)))
+            self._stream(text, prompt_tokens(request))
+
+        def _stream(self, text, prompt_token_count):
+            # The REST transport reads a JSON array of responses incrementally
+            size = max(1, len(text) // max(1, fake.stream_chunks))
+            pieces = [text[i:i + size] for i in range(0, len(text), size)]
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for index, piece in enumerate(pieces):
+                prefix = "[" if index == 0 else ","
+                self._chunk((prefix + json.dumps(_candidate(piece, prompt_token_count))).encode("utf-8"))
+                time.sleep(fake.chunk_delay_ms / 1000)
+            self._chunk(b"]")
+            self.wfile.write(b"0\r\n\r\n")
+
+        def _chunk(self, data):
+            self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+            self.wfile.flush()
+
+    return Handler
+
+
+def serve(fake: FakeGemini, host="127.0.0.1", port=0):
+    """
+    Start the fake in a background thread and return the server; its
+    address is ``server.server_address``.
+    """
+    server = ThreadingHTTPServer((host, port), make_handler(fake))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--latency-ms", type=float, default=300.0)
+    parser.add_argument("--jitter-ms", type=float, default=50.0)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of calls answered with 429/503")
+    parser.add_argument("--stream-chunks", type=int, default=8)
+    parser.add_argument("--chunk-delay-ms", type=float, default=30.0)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    fake = FakeGemini(args.latency_ms, args.jitter_ms, args.error_rate, args.stream_chunks, args.chunk_delay_ms, args.seed)
+    server = serve(fake, args.host, args.port)
+    print(f"Fake Gemini listening on http://{args.host}:{server.server_address[1]}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
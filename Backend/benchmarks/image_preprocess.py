@@ -0,0 +1,73 @@
+"""
+Benchmark of the /crop image preprocessing stage.
+
+For each image, reports the bytes that would be sent to Gemini before
+(raw upload) and after preprocessing, and the preprocessing time. With
+--live it also sends both versions to Gemini and compares end-to-end
+latency (needs gemini_api in the environment).
+
+    python benchmarks/image_preprocess.py uploads/*.jpeg --max-edge 1024
+    python benchmarks/image_preprocess.py photo.jpg --live --repeat 3
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from imagePreprocess import preprocess_image  # noqa: E402
+
+
+def time_call(fn, repeat):
+    samples = []
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn()
+        samples.append(time.perf_counter() - started)
+    return result, statistics.median(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("images", nargs="+")
+    parser.add_argument("--max-edge", type=int, default=1024)
+    parser.add_argument("--quality", type=int, default=85)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--live", action="store_true", help="also time real Gemini calls with both payloads")
+    parser.add_argument("--model", default="gemini-1.5-flash-latest")
+    args = parser.parse_args()
+
+    model = None
+    if args.live:
+        import google.generativeai as genai
+        from dotenv import load_dotenv
+        from crop_photo import CropPhoto
+        load_dotenv()
+        genai.configure(api_key=os.getenv("gemini_api"))
+        model = genai.GenerativeModel(args.model)
+        instructions = CropPhoto().text_instructions
+
+    print(f"{'image':<32} {'raw KB':>9} {'sent KB':>9} {'ratio':>6} {'prep ms':>8}"
+          + (f" {'raw e2e s':>10} {'prep e2e s':>10}" if model else ""))
+    for path in args.images:
+        with open(path, "rb") as f:
+            raw = f.read()
+        prepared, prep_seconds = time_call(lambda: preprocess_image(raw, args.max_edge, args.quality), args.repeat)
+        line = (f"{os.path.basename(path)[:32]:<32} {len(raw) / 1024:>9.1f} {len(prepared.data) / 1024:>9.1f} "
+                f"{len(prepared.data) / len(raw):>6.2f} {prep_seconds * 1000:>8.1f}")
+        if model:
+            mime = "image/png" if raw[:4] == b"\x89PNG" else "image/jpeg"
+            _, raw_e2e = time_call(
+                lambda: model.generate_content([instructions, {"mime_type": mime, "data": raw}]), args.repeat)
+            _, prep_e2e = time_call(
+                lambda: model.generate_content([instructions, prepared.as_part()]), args.repeat)
+            # Preprocessing is part of the prepared path's end-to-end time
+            line += f" {raw_e2e:>10.2f} {prep_e2e + prep_seconds:>10.2f}"
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
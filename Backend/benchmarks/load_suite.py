@@ -0,0 +1,251 @@
+"""
+Reproducible load suite for the backend.
+
+Boots ``main:app`` under uvicorn against a local Postgres and the fake
+Gemini server (benchmarks/fake_gemini.py), drives /login, /register, /chat
+and /crop at each concurrency level, and reports RPS and p50/p95/p99
+latency. Results are written as JSON and can be compared with a previous
+run to catch regressions:
+
+    docker compose -f benchmarks/docker-compose.yml up -d
+    python benchmarks/load_suite.py --output bench.json
+    python benchmarks/load_suite.py --baseline bench.json --tolerance 0.15
+
+The run is kept comparable between machines and commits by fixing the
+bcrypt cost, the fake model's latency and error seed, the request counts,
+and by starting every run with fresh local caches. Every /chat prompt and
+/crop photo is unique, so the response caches do not short-circuit the
+model path. Exits with status 1 when a regression is found.
+"""
+import argparse
+import io
+import itertools
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from auth_load import HttpDriver, print_table, run_level  # noqa: E402
+from fake_gemini import FakeGemini, serve  # noqa: E402
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCENARIOS = ("login", "register", "chat", "crop")
+
+
+def sample_photos(count=8, size=(800, 600), seed=1):
+    """
+    A few distinct JPEGs standing in for phone photos.
+    """
+    rng = random.Random(seed)
+    photos = []
+    for _ in range(count):
+        img = Image.frombytes("RGB", size, rng.randbytes(size[0] * size[1] * 3))
+        buf = io.BytesIO()
+        img.save(buf, format="JPEG", quality=85)
+        photos.append(buf.getvalue())
+    return photos
+
+
+def app_env(args, fake_url, workdir):
+    env = dict(os.environ)
+    env.update({
+        "host": args.db_host,
+        "port": str(args.db_port),
+        "user": args.db_user,
+        "password": args.db_password,
+        "dbname": args.db_name,
+        "db_sslmode": args.db_sslmode,
+        "gemini_api": "fake",
+        "gemini_api_endpoint": fake_url,
+        "bcrypt_rounds": str(args.bcrypt_rounds),
+        "chat_cache_db": "",
+        "crop_cache_db": os.path.join(workdir, "diagnosis_cache.sqlite3"),
+        "crop_jobs_db": os.path.join(workdir, "crop_jobs.sqlite3"),
+        # Every benchmark photo must reach preprocessing and the model
+        "crop_similarity_threshold": "-1",
+        "crop_persist_uploads": "false",
+        # Every request comes from one IP; the limiter would measure itself
+        "rate_limit_enabled": "false",
+    })
+    return env
+
+
+def start_app(args, env):
+    subprocess.run([sys.executable, "createTable.py"], cwd=BACKEND_DIR, env=env, check=True)
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(args.app_port),
+         "--log-level", "warning"],
+        cwd=BACKEND_DIR, env=env,
+    )
+    driver = HttpDriver(f"http://127.0.0.1:{args.app_port}")
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise SystemExit("The backend exited during startup.")
+        status, _ = driver.request("GET", "/healthz")
+        if status == 200:
+            return process
+        time.sleep(0.2)
+    process.terminate()
+    raise SystemExit("The backend did not start within 60s.")
+
+
+def scenario_calls(driver, run_id, photos):
+    counter = itertools.count()
+    lock = threading.Lock()
+
+    def next_id():
+        with lock:
+            return next(counter)
+
+    email = f"bench-{run_id}@example.com"
+    password = "bench-password"
+    status, _ = driver.request("POST", "/register", {"email": email, "password": password, "name": "Bench", "country": "Ethiopia"})
+    if not 200 <= status < 300:
+        raise SystemExit(f"Could not register the benchmark user (status {status}).")
+
+    def login():
+        return driver.request("POST", "/login", {"email": email, "password": password})
+
+    def register():
+        n = next_id()
+        return driver.request("POST", "/register", {
+            "email": f"bench-{run_id}-{n}@example.com", "password": password, "name": "Bench", "country": "Kenya",
+        })
+
+    def chat():
+        n = next_id()
+        return driver.request("POST", "/chat", {"user_input": f"How often should I water maize in week {n}?"})
+
+    def crop():
+        n = next_id()
+        # Unique trailing bytes give each upload its own content hash without changing the image
+        body = photos[n % len(photos)] + f"{run_id}-{n}".encode()
+        return driver.request("POST", "/crop", body=body, headers={"Content-Type": "image/jpeg"})
+
+    return {"login": login, "register": register, "chat": chat, "crop": crop}
+
+
+def compare(results, baseline, tolerance):
+    """
+    Return human-readable regressions of ``results`` against ``baseline``.
+    """
+    regressions = []
+    for scenario, rows in results.items():
+        previous = {row["concurrency"]: row for row in baseline.get("results", {}).get(scenario, [])}
+        for row in rows:
+            old = previous.get(row["concurrency"])
+            if old is None:
+                continue
+            label = f"{scenario} @ {row['concurrency']}"
+            if row["p95_ms"] > old["p95_ms"] * (1 + tolerance):
+                regressions.append(f"{label}: p95 {old['p95_ms']:.1f} -> {row['p95_ms']:.1f} ms")
+            if row["rps"] < old["rps"] * (1 - tolerance):
+                regressions.append(f"{label}: rps {old['rps']:.1f} -> {row['rps']:.1f}")
+            if row["errors"] > old["errors"] + max(1, tolerance * row["requests"]):
+                regressions.append(f"{label}: errors {old['errors']} -> {row['errors']}")
+    return regressions
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--levels", default="1,8,32")
+    parser.add_argument("--requests-per-worker", type=int, default=20)
+    parser.add_argument("--app-port", type=int, default=8001)
+    parser.add_argument("--db-host", default="127.0.0.1")
+    parser.add_argument("--db-port", type=int, default=55432)
+    parser.add_argument("--db-user", default="smartfarmer")
+    parser.add_argument("--db-password", default="smartfarmer")
+    parser.add_argument("--db-name", default="smartfarmer")
+    parser.add_argument("--db-sslmode", default="disable")
+    parser.add_argument("--bcrypt-rounds", type=int, default=10, help="fixed so results do not depend on calibration")
+    parser.add_argument("--llm-latency-ms", type=float, default=300.0)
+    parser.add_argument("--llm-jitter-ms", type=float, default=50.0)
+    parser.add_argument("--llm-error-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write results as JSON")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="allowed relative change before flagging")
+    args = parser.parse_args()
+
+    scenarios = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+    levels = [int(level) for level in args.levels.split(",")]
+
+    fake = FakeGemini(args.llm_latency_ms, args.llm_jitter_ms, args.llm_error_rate, seed=args.seed)
+    fake_server = serve(fake)
+    fake_url = f"http://127.0.0.1:{fake_server.server_address[1]}"
+
+    with tempfile.TemporaryDirectory(prefix="smartfarmer-bench-") as workdir:
+        process = start_app(args, app_env(args, fake_url, workdir))
+        try:
+            driver = HttpDriver(f"http://127.0.0.1:{args.app_port}", timeout=120)
+            calls = scenario_calls(driver, uuid.uuid4().hex[:8], sample_photos(seed=args.seed))
+            results = {}
+            for scenario in scenarios:
+                call = calls[scenario]
+                for _ in range(3):
+                    call()  # warm connections, models and caches of the code path
+                results[scenario] = [run_level(call, level, level * args.requests_per_worker) for level in levels]
+                print_table(results[scenario], f"/{scenario} (fake Gemini {args.llm_latency_ms:.0f} ms)")
+                print()
+        finally:
+            process.terminate()
+            process.wait(timeout=30)
+            fake_server.shutdown()
+
+    report = {
+        "meta": {
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "levels": levels,
+            "requests_per_worker": args.requests_per_worker,
+            "bcrypt_rounds": args.bcrypt_rounds,
+            "llm_latency_ms": args.llm_latency_ms,
+            "llm_error_rate": args.llm_error_rate,
+            "fake_llm": fake.stats,
+        },
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f"Regressions against {args.baseline} (tolerance {args.tolerance:.0%}):")
+            for line in regressions:
+                print(f"  {line}")
+            sys.exit(1)
+        print(f"No regressions against {args.baseline} (tolerance {args.tolerance:.0%}).")
+
+
+if __name__ == "__main__":
+    main()
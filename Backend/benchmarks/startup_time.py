@@ -0,0 +1,183 @@
+"""
+Cold start benchmark for the backend.
+
+Measures two things, each as the median of several fresh processes:
+
+* import time: how long ``import main`` takes in a new interpreter, plus
+  the modules that cost the most (from ``python -X importtime``);
+* time to first 200: from spawning the server until GET /healthz answers,
+  under uvicorn (one process) or gunicorn (gunicorn.conf.py, preforked).
+
+    python benchmarks/startup_time.py --server uvicorn --runs 5
+    python benchmarks/startup_time.py --server gunicorn --workers 4 \
+        --max-import-ms 600 --max-ready-ms 3000 --output startup.json
+
+The database does not have to be running: startup only warns when the
+pool cannot be filled. Exits with status 1 when a ``--max-*`` limit is
+exceeded, so a slow new import is caught before it ships.
+"""
+import argparse
+import json
+import os
+import platform
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from auth_load import HttpDriver  # noqa: E402
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+IMPORT_SNIPPET = "import time; t = time.perf_counter(); import main; print(time.perf_counter() - t)"
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def app_env(args, workdir):
+    env = dict(os.environ)
+    env.update({
+        "host": args.db_host,
+        "port": str(args.db_port),
+        "db_sslmode": args.db_sslmode,
+        "db_pool_timeout": "1",
+        "gemini_api": env.get("gemini_api", "startup-benchmark"),
+        "bcrypt_rounds": str(args.bcrypt_rounds),
+        "chat_cache_db": "",
+        "crop_cache_db": os.path.join(workdir, "diagnosis_cache.sqlite3"),
+        "crop_jobs_db": os.path.join(workdir, "crop_jobs.sqlite3"),
+        "web_workers": str(args.workers),
+        "PYTHONDONTWRITEBYTECODE": "",
+    })
+    return env
+
+
+def import_seconds(env):
+    result = subprocess.run([sys.executable, "-c", IMPORT_SNIPPET], cwd=BACKEND_DIR, env=env,
+                            capture_output=True, text=True, check=True)
+    return float(result.stdout.strip().splitlines()[-1])
+
+
+def slowest_imports(env, top):
+    """
+    The ``top`` modules with the largest self time while importing main.
+    """
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import main"], cwd=BACKEND_DIR, env=env,
+                            capture_output=True, text=True, check=True)
+    modules = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = (part.strip() for part in line[len("import time:"):].split("|"))
+        modules.append({"module": name, "self_ms": int(self_us) / 1000, "cumulative_ms": int(cumulative_us) / 1000})
+    modules.sort(key=lambda row: row["self_ms"], reverse=True)
+    return modules[:top]
+
+
+def server_command(args, port):
+    if args.server == "gunicorn":
+        return [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "--bind", f"127.0.0.1:{port}",
+                "--log-level", "warning", "main:app"]
+    return [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port),
+            "--log-level", "warning"]
+
+
+def ready_seconds(args, env, timeout=60.0):
+    """
+    Spawn the server and return the seconds until /healthz first answers 200.
+    """
+    port = free_port()
+    driver = HttpDriver(f"http://127.0.0.1:{port}", timeout=5)
+    started = time.perf_counter()
+    process = subprocess.Popen(server_command(args, port), cwd=BACKEND_DIR, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while time.perf_counter() - started < timeout:
+            if process.poll() is not None:
+                raise SystemExit(f"The {args.server} server exited during startup (status {process.returncode}).")
+            status, _ = driver.request("GET", "/healthz")
+            if status == 200:
+                return time.perf_counter() - started
+            time.sleep(0.01)
+        raise SystemExit(f"The {args.server} server did not answer within {timeout:.0f}s.")
+    finally:
+        process.terminate()
+        try:
+            process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def summary(samples):
+    return {
+        "median_ms": statistics.median(samples) * 1000,
+        "min_ms": min(samples) * 1000,
+        "max_ms": max(samples) * 1000,
+        "runs": len(samples),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--server", choices=("uvicorn", "gunicorn"), default="uvicorn")
+    parser.add_argument("--workers", type=int, default=2, help="gunicorn workers")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=10, help="slowest imports to list")
+    parser.add_argument("--db-host", default="127.0.0.1")
+    parser.add_argument("--db-port", type=int, default=55432)
+    parser.add_argument("--db-sslmode", default="disable")
+    parser.add_argument("--bcrypt-rounds", type=int, default=10, help="fixed so results do not depend on calibration")
+    parser.add_argument("--max-import-ms", type=float, help="fail when the median import time is higher")
+    parser.add_argument("--max-ready-ms", type=float, help="fail when the median time to first 200 is higher")
+    parser.add_argument("--output", help="write results as JSON")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="smartfarmer-startup-") as workdir:
+        env = app_env(args, workdir)
+        import_seconds(env)  # the first run compiles bytecode; it is not a cold start we ship
+        imports = summary([import_seconds(env) for _ in range(args.runs)])
+        ready = summary([ready_seconds(args, env) for _ in range(args.runs)])
+        slowest = slowest_imports(env, args.top)
+
+    print(f"import main:      median {imports['median_ms']:7.1f} ms  (min {imports['min_ms']:.1f}, max {imports['max_ms']:.1f})")
+    print(f"first 200 ({args.server}): median {ready['median_ms']:7.1f} ms  (min {ready['min_ms']:.1f}, max {ready['max_ms']:.1f})")
+    print("\nslowest imports (self time):")
+    for row in slowest:
+        print(f"  {row['self_ms']:8.1f} ms  {row['module']}")
+
+    report = {
+        "meta": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "server": args.server,
+            "workers": args.workers if args.server == "gunicorn" else 1,
+        },
+        "import": imports,
+        "first_200": ready,
+        "slowest_imports": slowest,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nResults written to {args.output}")
+
+    failures = []
+    if args.max_import_ms is not None and imports["median_ms"] > args.max_import_ms:
+        failures.append(f"import main took {imports['median_ms']:.1f} ms (limit {args.max_import_ms:.0f} ms)")
+    if args.max_ready_ms is not None and ready["median_ms"] > args.max_ready_ms:
+        failures.append(f"first 200 took {ready['median_ms']:.1f} ms (limit {args.max_ready_ms:.0f} ms)")
+    if failures:
+        print("\n" + "\n".join(failures))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,47 +1,115 @@
-import google.generativeai as genai
-import os
-from dotenv import load_dotenv
+import hashlib
+import inspect
 import json
-from fastapi.responses import JSONResponse
+import os
+from fastapi.responses import JSONResponse, StreamingResponse
+import threading
+import time
+from responseCache import cache_from_env
+from llmClient import get_llm_client, LLMUnavailable
+from conversationMemory import memory_from_env, clamp_history, clamp_input
+from metrics import CHAT_TTFT, PROMPT_TRUNCATIONS
 
+MODEL_NAME = "gemini-2.0-flash"
 
-class ChatSystem:
-    def __init__(self):
-        load_dotenv()
-        api_key = os.getenv("gemini_api")
-        genai.configure(api_key = api_key )
-        self.client = genai.GenerativeModel("gemini-2.0-flash")
-        self.prompt = """
-        You are AgriBuddy, a professional agricultural advisor trained in crop science, 
-        soil management, pest control, irrigation, and local farming practices. Your job is to assist farmers using simple, 
+# The fixed AgriBuddy preambles are sent as the model's system instruction,
+# built once here; each request only adds its own short turn.
+CHAT_INSTRUCTIONS = inspect.cleandoc("""
+        You are AgriBuddy, a professional agricultural advisor trained in crop science,
+        soil management, pest control, irrigation, and local farming practices. Your job is to assist farmers using simple,
         clear, and respectful language, just like a real expert would in a face-to-face conversation.
-        The farmer may ask about planting, fertilizers, pests, weather, or how to increase yield. Speak in a friendly tone, 
+        The farmer may ask about planting, fertilizers, pests, weather, or how to increase yield. Speak in a friendly tone,
         using local farming examples where possible. Your advice must be practical, region-aware, and tailored to small to medium-scale farmers.
         If the farmer doesn’t know technical terms, explain them simply. Ask clarifying questions if needed, just like a human advisor.
         Assume that farmer is located in  India.
         Start by greeting the farmer respectfully and asking what help they need today.
-        
+
         if the farmer ask about a specific crop, provide advice on that crop.
         if the question is out of scope, politely inform the farmer that you can only provide advice on agricultural topics.
         Always end with a friendly note, encouraging the farmer to ask more questions if they need further assistance.
-        
-        here is the convesation history if available:
-        {user_history}
-        
-        Here is the user input:
-        {user_input}
-        
+""")
+CHAT_TURN = "here is the convesation history if available:\n{user_history}\n\nHere is the user input:\n{user_input}"
+
+WEATHER_INSTRUCTIONS = inspect.cleandoc("""
+            You are AgriBuddy, a professional agricultural advisor.
+            The farmer is asking about what he/she can do based on weather data provided.
+            only answer with out any question explain the actions that can be taken based on the weather data.
+""")
+WEATHER_TURN = "Here is the user input:\n{user_input}"
+
+
+class ChatSystem:
+    def __init__(self):
+        # Gemini itself is reached through the app-wide LLMClient
+        self.model_name = MODEL_NAME
+        # Repeated questions are answered from here instead of calling Gemini again
+        self.cache = cache_from_env("chat_cache")
+        # Server-side history per user, so the prompt does not grow with the conversation
+        self.memory = memory_from_env(self.model_name)
+        self._stream_lock = threading.Lock()
+        self.stream_stats = {
+            "streams": 0,
+            "errors": 0,
+            "ttft_seconds_total": 0.0,
+            "ttft_seconds_max": 0.0,
+        }
+        self.instructions = {"chat": CHAT_INSTRUCTIONS, "weather": WEATHER_INSTRUCTIONS}
+        # Cache keys include the instructions, so editing them does not serve stale answers
+        self._cache_models = {
+            endpoint: f"{self.model_name}:{hashlib.sha1(text.encode('utf-8')).hexdigest()[:8]}"
+            for endpoint, text in self.instructions.items()
+        }
+        self.input_budgets = {
+            "chat": int(os.getenv("chat_max_input_tokens", "1000")),
+            "weather": int(os.getenv("weather_max_input_tokens", "2000")),
+        }
+
+    def _budget(self, user_input, endpoint):
         """
-    def chat(self, user_input,user_history = ""):
+        Keep the farmer's input within the endpoint's token budget.
+        """
+        clamped = clamp_input(user_input, self.input_budgets[endpoint])
+        if clamped is not user_input:
+            PROMPT_TRUNCATIONS.inc(endpoint=endpoint)
+        return clamped
+
+    def _model_kwargs(self, endpoint):
+        return {"system_instruction": self.instructions[endpoint]}
+
+    async def _generate(self, prompts, endpoint):
+        """
+        Return the model's text for a prompt, serving repeats from the cache.
+        """
+        key = self.cache.key(self._cache_models[endpoint], prompts)
+        cached = await self.cache.lookup(key)
+        if cached is not None:
+            return cached
+        response = await get_llm_client().generate(
+            self.model_name, prompts, endpoint=endpoint, model_kwargs=self._model_kwargs(endpoint)
+        )
+        if response and response.text:
+            await self.cache.store(key, response.text)
+            return response.text
+        return None
+
+    async def _history(self, user_history, user_id):
+        """
+        Server-side history when the caller identifies the user, otherwise
+        the client-sent history clamped to the same token budget.
+        """
+        if user_id:
+            return await self.memory.history(user_id)
+        return clamp_history(user_history, self.memory.recent_tokens + self.memory.summary_tokens)
+
+    async def chat(self, user_input,user_history = "", user_id = None):
         try:
-            prompts = self.prompt.format(user_history=user_history, user_input=user_input)
-            response = self.client.generate_content(
-                prompts
-            )
-           
-            if response and response.text:
-                generated_text = response.text
-                
+            history = await self._history(user_history, user_id)
+            prompts = CHAT_TURN.format(user_history=history, user_input=self._budget(user_input, "chat"))
+            generated_text = await self._generate(prompts, "chat")
+
+            if generated_text:
+                if user_id:
+                    self.memory.record(user_id, user_input, generated_text)
                 return JSONResponse(
                     content={
                         "status": "success",
@@ -56,6 +124,14 @@ class ChatSystem:
                 },
                 status_code=500
             )
+        except LLMUnavailable as e:
+            return JSONResponse(
+                content={
+                    "status": "error",
+                    "message": str(e)
+                },
+                status_code=503
+            )
         except Exception as e:
             return JSONResponse(
                 content={
@@ -64,22 +140,77 @@ class ChatSystem:
                 },
                 status_code=500
             )
-    def weather(self, user_input):
+    def _record_ttft(self, seconds):
+        CHAT_TTFT.observe(seconds)
+        with self._stream_lock:
+            self.stream_stats["streams"] += 1
+            self.stream_stats["ttft_seconds_total"] += seconds
+            self.stream_stats["ttft_seconds_max"] = max(self.stream_stats["ttft_seconds_max"], seconds)
+
+    async def _stream_text(self, prompts):
+        """
+        Yield the answer in pieces as Gemini produces them. Cached answers
+        come back as a single piece; complete answers are cached afterwards.
+        """
+        started = time.perf_counter()
+        key = self.cache.key(self._cache_models["chat"], prompts)
+        cached = await self.cache.lookup(key)
+        if cached is not None:
+            self._record_ttft(time.perf_counter() - started)
+            yield cached
+            return
+        parts = []
+        async for text in get_llm_client().stream(self.model_name, prompts, endpoint="chat",
+                                                      model_kwargs=self._model_kwargs("chat")):
+            if not parts:
+                self._record_ttft(time.perf_counter() - started)
+            parts.append(text)
+            yield text
+        if parts:
+            await self.cache.store(key, "".join(parts))
+
+    async def chat_stream(self, user_input, user_history = "", fmt = "sse", user_id = None):
+        """
+        Streaming variant of chat. ``fmt`` is "sse" (text/event-stream) or
+        "ndjson" (one JSON object per line).
+        """
+        history = await self._history(user_history, user_id)
+        prompts = CHAT_TURN.format(user_history=history, user_input=self._budget(user_input, "chat"))
+
+        def event(payload, name=None):
+            if fmt == "ndjson":
+                return json.dumps(payload) + "\n"
+            prefix = f"event: {name}\n" if name else ""
+            return f"{prefix}data: {json.dumps(payload)}\n\n"
+
+        async def events():
+            try:
+                parts = []
+                async for text in self._stream_text(prompts):
+                    parts.append(text)
+                    yield event({"text": text})
+                if parts:
+                    if user_id:
+                        self.memory.record(user_id, user_input, "".join(parts))
+                    yield event({"status": "success", "done": True}, "done")
+                else:
+                    yield event({"status": "error", "message": "No response generated."}, "error")
+            except Exception as e:
+                with self._stream_lock:
+                    self.stream_stats["errors"] += 1
+                yield event({"status": "error", "message": str(e)}, "error")
+
+        media_type = "application/x-ndjson" if fmt == "ndjson" else "text/event-stream"
+        # no-cache / no buffering so proxies flush each piece to the phone right away
+        headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+        return StreamingResponse(events(), media_type=media_type, headers=headers)
+
+    async def weather(self, user_input):
         try:
-            prompts = f"""
-            You are AgriBuddy, a professional agricultural advisor. 
-            The farmer is asking about what he/she can do based on weather data provided.
-            only answer with out any question explain the actions that can be taken based on the weather data.
-            
-            Here is the user input:
-            {user_input}
-            """
-            
-            response = self.client.generate_content(
-                prompts
-            )
-            if response and response.text:
-                generated_text = response.text
+            prompts = WEATHER_TURN.format(user_input=self._budget(user_input, "weather"))
+
+            generated_text = await self._generate(prompts, "weather")
+            if generated_text:
                 return JSONResponse(
                     content={
                         "status": "success",
@@ -95,6 +226,14 @@ class ChatSystem:
                 },
                 status_code=500
             )
+        except LLMUnavailable as e:
+            return JSONResponse(
+                content={
+                    "status": "error",
+                    "message": str(e)
+                },
+                status_code=503
+            )
         except Exception as e:
             return JSONResponse(
                 content={
@@ -0,0 +1,172 @@
+import psycopg2  # type: ignore
+from createConnection import pooled_connection
+from asyncDb import run_db
+from llmClient import get_llm_client, LLMUnavailable
+import asyncio
+import json
+import math
+import os
+import weakref
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Rough token count (about four characters per token for Gemini models).
+    """
+    return math.ceil(len(text) / 4) if text else 0
+
+
+def clamp_history(history: str, budget: int) -> str:
+    """
+    Keep the most recent part of a client-sent history within ``budget`` tokens.
+    """
+    if estimate_tokens(history) <= budget:
+        return history
+    return "..." + history[-budget * 4:]
+
+
+def clamp_input(text: str, budget: int) -> str:
+    """
+    Cut an over-budget user input down to ``budget`` tokens, keeping its
+    start and its end (where the actual question usually is).
+    """
+    if estimate_tokens(text) <= budget:
+        return text
+    half = budget * 2
+    return f"{text[:half]}\n[...]\n{text[-half:]}"
+
+
+class ConversationMemory:
+    """
+    Per-user chat sessions kept in Postgres (``chat_sessions``).
+
+    The latest turns are kept verbatim up to ``recent_tokens`` (the last
+    ``min_recent_turns`` are shortened if they alone exceed it). Older turns
+    are folded into a running summary, capped at about ``summary_tokens``,
+    by a separate model call after the answer has been sent. The history
+    put into each prompt therefore stays near a constant size however long
+    the conversation gets.
+    """
+
+    def __init__(self, model_name: str, recent_tokens: int = 800, summary_tokens: int = 300, min_recent_turns: int = 2):
+        self.model_name = model_name
+        self.recent_tokens = recent_tokens
+        self.summary_tokens = summary_tokens
+        self.min_recent_turns = min_recent_turns
+        self._locks = weakref.WeakValueDictionary()  # user_id -> asyncio.Lock, dropped once unused
+        self.stats = {"turns_recorded": 0, "summaries": 0, "summary_failures": 0}
+
+    def _load(self, user_id: str):
+        with pooled_connection() as conn, conn.cursor() as cursor:
+            cursor.execute("SELECT summary, recent FROM chat_sessions WHERE user_id = %s", (user_id,))
+            row = cursor.fetchone()
+        if row is None:
+            return "", []
+        return row[0] or "", row[1] or []
+
+    def _save(self, user_id: str, summary: str, turns: list):
+        with pooled_connection() as conn, conn.cursor() as cursor:
+            cursor.execute("""
+                INSERT INTO chat_sessions (user_id, summary, recent, updated_at)
+                VALUES (%s, %s, %s::jsonb, CURRENT_TIMESTAMP)
+                ON CONFLICT (user_id) DO UPDATE
+                SET summary = EXCLUDED.summary, recent = EXCLUDED.recent, updated_at = EXCLUDED.updated_at
+            """, (user_id, summary, json.dumps(turns)))
+            conn.commit()
+
+    def _clear(self, user_id: str):
+        with pooled_connection() as conn, conn.cursor() as cursor:
+            cursor.execute("DELETE FROM chat_sessions WHERE user_id = %s", (user_id,))
+            conn.commit()
+
+    @staticmethod
+    def _format_turns(turns):
+        return "\n".join(f"{'Farmer' if turn['role'] == 'user' else 'AgriBuddy'}: {turn['text']}" for turn in turns)
+
+    async def history(self, user_id: str) -> str:
+        """
+        The conversation so far, ready to drop into the chat prompt.
+        """
+        try:
+            summary, turns = await run_db(self._load, user_id)
+        except psycopg2.Error as e:
+            print(f"Database error: {e}")
+            return ""
+        parts = []
+        if summary:
+            parts.append(f"Summary of the earlier conversation: {summary}")
+        if turns:
+            parts.append(self._format_turns(turns))
+        return "\n".join(parts)
+
+    def record(self, user_id: str, user_input: str, answer: str):
+        """
+        Store a finished turn in the background so the reply is not delayed
+        by the database write or by summarization.
+        """
+        task = asyncio.create_task(self._record(user_id, user_input, answer))
+        task.add_done_callback(self._report)
+
+    @staticmethod
+    def _report(task):
+        if not task.cancelled() and task.exception() is not None:
+            print(f"Chat memory error: {task.exception()}")
+
+    async def _record(self, user_id: str, user_input: str, answer: str):
+        # One writer per user at a time, so concurrent turns do not overwrite each other
+        lock = self._locks.get(user_id)
+        if lock is None:
+            lock = self._locks[user_id] = asyncio.Lock()
+        async with lock:
+            summary, turns = await run_db(self._load, user_id)
+            turns = turns + [{"role": "user", "text": user_input}, {"role": "model", "text": answer}]
+            self.stats["turns_recorded"] += 1
+
+            overflow = []
+            while len(turns) > self.min_recent_turns and \
+                    sum(estimate_tokens(turn["text"]) for turn in turns) > self.recent_tokens:
+                overflow.append(turns.pop(0))
+            if overflow:
+                summary = await self._summarize(summary, overflow)
+            if sum(estimate_tokens(turn["text"]) for turn in turns) > self.recent_tokens:
+                # The turns that must stay are too long on their own; share the budget between them
+                share = max(1, self.recent_tokens // len(turns) - estimate_tokens("\n[...]\n"))
+                turns = [dict(turn, text=clamp_input(turn["text"], share)) for turn in turns]
+
+            await run_db(self._save, user_id, summary, turns)
+
+    async def _summarize(self, summary: str, turns: list) -> str:
+        words = self.summary_tokens * 3 // 4
+        prompt = f"""
+        You maintain a running summary of a conversation between a farmer and AgriBuddy, an agricultural advisor.
+        Update the summary with the new turns below. Keep the facts that matter for future advice
+        (crops, location, farm size, problems, advice already given). Use at most {words} words.
+        Reply with the summary only.
+
+        Current summary:
+        {summary or "(none)"}
+
+        New turns:
+        {self._format_turns(turns)}
+        """
+        try:
+            response = await get_llm_client().generate(self.model_name, prompt, endpoint="summary")
+            self.stats["summaries"] += 1
+            return response.text.strip()
+        except (LLMUnavailable, ValueError) as e:
+            # Keep going without losing context: append the raw turns, clamped to the budget
+            print(f"Chat summary failed: {e}")
+            self.stats["summary_failures"] += 1
+            return clamp_history(f"{summary}\n{self._format_turns(turns)}".strip(), self.summary_tokens)
+
+    async def clear(self, user_id: str):
+        await run_db(self._clear, user_id)
+
+
+def memory_from_env(model_name: str) -> ConversationMemory:
+    return ConversationMemory(
+        model_name,
+        recent_tokens=int(os.getenv("chat_recent_tokens", "800")),
+        summary_tokens=int(os.getenv("chat_summary_tokens", "300")),
+        min_recent_turns=int(os.getenv("chat_min_recent_turns", "2")),
+    )
@@ -1,14 +1,18 @@
 import psycopg2 # type: ignore
+import psycopg2.extensions # type: ignore
+import psycopg2.pool # type: ignore
 from dotenv import load_dotenv # type: ignore
+from metrics import stage
+from contextlib import contextmanager
+from collections import deque
+import threading
+import time
 import os
 
 
-def create_connection():
+def _dsn():
     """
-    Create a connection to the PostgreSQL database.
-    
-    Returns:
-        conn: A connection object to the PostgreSQL database.
+    Build the PostgreSQL connection string from the environment.
     """
     load_dotenv()
     host = os.getenv("host")
@@ -16,15 +20,269 @@ def create_connection():
     password = os.getenv("password")
     database = os.getenv("dbname")
     port = os.getenv("port")
+    sslmode = os.getenv("db_sslmode", "require")
+    return f'postgres://{user}:{password}@{host}:{port}/{database}?sslmode={sslmode}'
+
+
+def create_connection():
+    """
+    Create a connection to the PostgreSQL database.
 
-    
-    
+    Returns:
+        conn: A connection object to the PostgreSQL database.
+    """
     try:
-        conn = psycopg2.connect(
-            f'postgres://{user}:{password}@{host}:{port}/{database}?sslmode=require'
-        )
+        conn = psycopg2.connect(_dsn())
         print("Connection to the database established successfully.")
         return conn
     except Exception as e:
         print(f"An error occurred while connecting to the database: {e}")
         return None
+
+
+class TimedCursor(psycopg2.extensions.cursor):
+    """
+    Cursor that records every statement as a ``db_query`` stage.
+    """
+
+    def execute(self, query, vars=None):
+        with stage("db_query"):
+            return super().execute(query, vars)
+
+    def executemany(self, query, vars_list):
+        with stage("db_query"):
+            return super().executemany(query, vars_list)
+
+
+class PoolTimeout(psycopg2.pool.PoolError):
+    """
+    Raised when no connection could be checked out before the timeout.
+    """
+
+
+class ConnectionPool:
+    """
+    Bounded, thread-safe pool of PostgreSQL connections.
+
+    Connections are handed out most-recently-used first so the warm ones are
+    reused, health checked with ``SELECT 1`` when they have been idle for a
+    while, and recycled once they exceed the max idle time.
+    """
+
+    def __init__(self, dsn, minconn=1, maxconn=10, timeout=5.0, max_idle=300.0, health_check_after=30.0):
+        self.dsn = dsn
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.health_check_after = health_check_after
+        self._idle = deque()  # (conn, last_used)
+        self._size = 0
+        self._waiting = 0
+        self._closed = False
+        self._cond = threading.Condition()
+        self._stats = {
+            "checkouts": 0,
+            "timeouts": 0,
+            "created": 0,
+            "recycled": 0,
+            "health_check_failures": 0,
+            "wait_seconds_total": 0.0,
+            "wait_seconds_max": 0.0,
+        }
+
+    def _connect(self):
+        conn = psycopg2.connect(self.dsn, connect_timeout=int(self.timeout) or 1, cursor_factory=TimedCursor)
+        with self._cond:
+            self._stats["created"] += 1
+        return conn
+
+    def prefill(self):
+        """
+        Open ``minconn`` connections up front so the first requests skip the handshake.
+        """
+        while True:
+            with self._cond:
+                if self._closed or self._size >= self.minconn:
+                    return
+                self._size += 1
+            try:
+                conn = self._connect()
+            except Exception:
+                with self._cond:
+                    self._size -= 1
+                    self._cond.notify()
+                raise
+            with self._cond:
+                self._idle.append((conn, time.monotonic()))
+                self._cond.notify()
+
+    def getconn(self):
+        started = time.monotonic()
+        deadline = started + self.timeout
+        conn, last_used = None, None
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise psycopg2.pool.PoolError("connection pool is closed")
+                if self._idle:
+                    conn, last_used = self._idle.pop()
+                    break
+                if self._size < self.maxconn:
+                    self._size += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._stats["timeouts"] += 1
+                    raise PoolTimeout(f"no connection available within {self.timeout}s")
+                self._waiting += 1
+                try:
+                    self._cond.wait(remaining)
+                finally:
+                    self._waiting -= 1
+
+        try:
+            conn = self._validate(conn, last_used)
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+
+        waited = time.monotonic() - started
+        with self._cond:
+            self._stats["checkouts"] += 1
+            self._stats["wait_seconds_total"] += waited
+            self._stats["wait_seconds_max"] = max(self._stats["wait_seconds_max"], waited)
+        return conn
+
+    def _validate(self, conn, last_used):
+        """
+        Return a usable connection, replacing ``conn`` if it is stale or broken.
+        """
+        if conn is None:
+            return self._connect()
+        idle_for = time.monotonic() - last_used
+        if conn.closed or idle_for > self.max_idle:
+            self._discard(conn)
+            with self._cond:
+                self._stats["recycled"] += 1
+            return self._connect()
+        if idle_for > self.health_check_after:
+            try:
+                with conn.cursor() as cursor:
+                    cursor.execute("SELECT 1")
+                conn.rollback()
+            except psycopg2.Error:
+                self._discard(conn)
+                with self._cond:
+                    self._stats["health_check_failures"] += 1
+                return self._connect()
+        return conn
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def putconn(self, conn, discard=False):
+        if not discard and not conn.closed:
+            try:
+                if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except psycopg2.Error:
+                discard = True
+        with self._cond:
+            if discard or conn.closed or self._closed:
+                self._size -= 1
+                self._discard(conn)
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def close(self):
+        """
+        Close idle connections and refuse new checkouts. Connections still in
+        use are closed as they are returned.
+        """
+        with self._cond:
+            self._closed = True
+            while self._idle:
+                conn, _ = self._idle.pop()
+                self._size -= 1
+                self._discard(conn)
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            idle = len(self._idle)
+            stats = dict(self._stats)
+            stats.update({
+                "size": self._size,
+                "max_size": self.maxconn,
+                "idle": idle,
+                "in_use": self._size - idle,
+                "waiting": self._waiting,
+            })
+            return stats
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def init_pool():
+    """
+    Create the shared connection pool. Called once at application startup.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            return _pool
+        _pool = ConnectionPool(
+            _dsn(),
+            minconn=int(os.getenv("db_pool_min", "1")),
+            maxconn=int(os.getenv("db_pool_max", "10")),
+            timeout=float(os.getenv("db_pool_timeout", "5")),
+            max_idle=float(os.getenv("db_pool_max_idle", "300")),
+            health_check_after=float(os.getenv("db_pool_health_check", "30")),
+        )
+    try:
+        _pool.prefill()
+        print("Database connection pool ready.")
+    except Exception as e:
+        print(f"An error occurred while warming the connection pool: {e}")
+    return _pool
+
+
+def get_pool():
+    return _pool if _pool is not None else init_pool()
+
+
+def close_pool():
+    """
+    Drain the shared connection pool. Called at application shutdown.
+    """
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.close()
+
+
+@contextmanager
+def pooled_connection():
+    """
+    Borrow a connection from the shared pool and give it back afterwards.
+
+    Any open transaction is rolled back on return, so callers only need to
+    commit what they want to keep.
+    """
+    pool = get_pool()
+    with stage("db_connect"):
+        conn = pool.getconn()
+    try:
+        yield conn
+    finally:
+        pool.putconn(conn)
@@ -28,6 +28,71 @@ def create_table():
             );
         """)
         connection.commit()
+        # Keyset pagination on /getAllUsers, with and without a country filter
+        cursor.execute("CREATE INDEX IF NOT EXISTS users_created_at_userid_idx ON users (created_at, userId);")
+        cursor.execute("CREATE INDEX IF NOT EXISTS users_country_created_at_userid_idx ON users (country, created_at, userId);")
+        connection.commit()
+        # One row per /crop result; country is copied from the user so outbreak queries need no join
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS diagnoses (
+                id BIGSERIAL PRIMARY KEY,
+                user_id UUID REFERENCES users(userId) ON DELETE SET NULL,
+                country VARCHAR(100),
+                image_hash CHAR(64) NOT NULL,
+                image_path TEXT,
+                crop_name VARCHAR(255) NOT NULL,
+                health_status VARCHAR(255) NOT NULL,
+                model VARCHAR(100),
+                cache VARCHAR(20),
+                latency_ms REAL,
+                result JSONB NOT NULL,
+                created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+            );
+        """)
+        # "My recent diagnoses", keyset-paginated newest first
+        cursor.execute("CREATE INDEX IF NOT EXISTS diagnoses_user_created_at_id_idx ON diagnoses (user_id, created_at DESC, id DESC);")
+        # Outbreaks by country and time window, answered from the index alone
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS diagnoses_country_created_at_idx
+            ON diagnoses (country, created_at) INCLUDE (crop_name, health_status);
+        """)
+        # Retention: trimming old rows and following uploads as they are compacted
+        cursor.execute("CREATE INDEX IF NOT EXISTS diagnoses_created_at_idx ON diagnoses (created_at);")
+        cursor.execute("CREATE INDEX IF NOT EXISTS diagnoses_image_path_idx ON diagnoses (image_path) WHERE image_path IS NOT NULL;")
+        connection.commit()
+        # Server-side /chat history: recent turns verbatim plus a running summary
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS chat_sessions (
+                user_id VARCHAR(255) PRIMARY KEY,
+                summary TEXT NOT NULL DEFAULT '',
+                recent JSONB NOT NULL DEFAULT '[]'::jsonb,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            );
+        """)
+        connection.commit()
+        # Shared token buckets for the rate limiter (rate_limit_backend=postgres)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS rate_limits (
+                key TEXT PRIMARY KEY,
+                tokens DOUBLE PRECISION NOT NULL,
+                updated_at DOUBLE PRECISION NOT NULL,
+                allowed BOOLEAN NOT NULL DEFAULT TRUE
+            );
+        """)
+        connection.commit()
+        # Precomputed weather advice, one row per region and forecast band
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS weather_advisories (
+                bucket_key TEXT PRIMARY KEY,
+                region TEXT NOT NULL,
+                bands JSONB NOT NULL,
+                advice TEXT NOT NULL,
+                created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                expires_at TIMESTAMP NOT NULL
+            );
+        """)
+        cursor.execute("CREATE INDEX IF NOT EXISTS weather_advisories_expires_at_idx ON weather_advisories (expires_at);")
+        connection.commit()
         print("Extension and table created (if not existed).")
     except psycopg2.Error as e:
         print(f"An error occurred while creating the table: {e}")
@@ -0,0 +1,266 @@
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+from metrics import stage
+import asyncio
+import io
+import json
+import os
+import threading
+import time
+
+# numpy and onnxruntime are optional and slow to import; they are loaded
+# by _load_runtime only when a model is configured
+np = None
+ort = None
+
+IMAGENET_MEAN = (0.485, 0.456, 0.406)
+IMAGENET_STD = (0.229, 0.224, 0.225)
+DEFAULT_RECOMMENDATION = "Confirm with a local extension officer before treating, and send a clearer photo if symptoms change."
+
+
+def parse_label(label: str) -> dict:
+    """
+    Turn a PlantVillage-style class name (``Tomato___Late_blight``) into
+    the fields of a /crop diagnosis.
+    """
+    crop, _, condition = label.partition("___")
+    crop = crop.replace("_", " ").replace(",", "").strip().lower()
+    condition = condition.replace("_", " ").strip().lower() or "unknown"
+    return {"crop_name": crop, "health_status": condition}
+
+
+def load_labels(path: str) -> list:
+    """
+    Read class labels: a JSON list of class names or of objects with a
+    ``label`` and optional ``crop_name`` / ``health_status`` /
+    ``recommendations``, or a text file with one class name per line.
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        text = f.read()
+    try:
+        entries = json.loads(text)
+    except ValueError:
+        entries = [line.strip() for line in text.splitlines() if line.strip()]
+    labels = []
+    for entry in entries:
+        if isinstance(entry, str):
+            entry = {"label": entry}
+        info = parse_label(entry["label"])
+        info.update({key: value for key, value in entry.items() if key != "label"})
+        info.setdefault("recommendations", DEFAULT_RECOMMENDATION)
+        labels.append(info)
+    return labels
+
+
+def _load_runtime() -> bool:
+    """
+    Import numpy and onnxruntime on first use; False when either is missing,
+    in which case every diagnosis goes to Gemini.
+    """
+    global np, ort
+    if ort is None:
+        try:
+            import numpy  # type: ignore
+            import onnxruntime  # type: ignore
+        except ImportError:
+            return False
+        np, ort = numpy, onnxruntime
+    return True
+
+
+class CropClassifier:
+    """
+    Local ONNX image classifier used as a fast path in front of Gemini.
+
+    The model is loaded and warmed once at startup and run on CPU. Requests
+    are gathered into batches: each ``classify`` call waits at most
+    ``max_wait_ms`` for others to join, then the whole batch runs in a
+    single inference call on a dedicated thread. Results under
+    ``threshold`` confidence, or for classes marked ``unknown``, are left
+    to Gemini.
+    """
+
+    def __init__(self, model_path: str, labels: list, threshold: float = 0.85, batch_size: int = 8,
+                 max_wait_ms: float = 5.0, threads: int = None, input_size: int = None):
+        if not _load_runtime():
+            raise RuntimeError("The local crop classifier needs onnxruntime and numpy.")
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = threads or os.cpu_count() or 1
+        self.session = ort.InferenceSession(model_path, sess_options=options, providers=["CPUExecutionProvider"])
+        model_input = self.session.get_inputs()[0]
+        self.input_name = model_input.name
+        # NCHW; a fixed batch dimension in the export caps the batch size
+        shape = model_input.shape
+        self.input_size = input_size or (shape[2] if isinstance(shape[2], int) else 224)
+        if isinstance(shape[0], int):
+            batch_size = min(batch_size, shape[0])
+        self.labels = labels
+        self.threshold = threshold
+        self.batch_size = batch_size
+        self.max_wait = max_wait_ms / 1000
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="classifier")
+        self._queue = None
+        self._batcher = None
+        self._lock = threading.Lock()
+        self._stats = {"images": 0, "batches": 0, "local_answers": 0, "fallbacks": 0, "errors": 0, "inference_seconds_total": 0.0}
+        self._infer([Image.new("RGB", (self.input_size, self.input_size))])
+
+    def _tensor(self, images):
+        size = self.input_size
+        batch = np.empty((len(images), 3, size, size), dtype=np.float32)
+        mean = np.array(IMAGENET_MEAN, dtype=np.float32).reshape(3, 1, 1)
+        std = np.array(IMAGENET_STD, dtype=np.float32).reshape(3, 1, 1)
+        for i, img in enumerate(images):
+            pixels = np.asarray(img.resize((size, size), Image.Resampling.BILINEAR), dtype=np.float32) / 255.0
+            batch[i] = (pixels.transpose(2, 0, 1) - mean) / std
+        return batch
+
+    def _decode(self, data: bytes):
+        img = Image.open(io.BytesIO(data))
+        # The prepared JPEG is already small; draft lets libjpeg skip most of it
+        img.draft("RGB", (self.input_size, self.input_size))
+        return img.convert("RGB")
+
+    def _infer(self, images):
+        """
+        Run one batch and return ``(class_index, confidence)`` per image.
+        """
+        started = time.perf_counter()
+        logits = self.session.run(None, {self.input_name: self._tensor(images)})[0]
+        if logits.min() < 0 or not np.allclose(logits.sum(axis=1), 1.0, atol=1e-3):
+            shifted = np.exp(logits - logits.max(axis=1, keepdims=True))
+            probabilities = shifted / shifted.sum(axis=1, keepdims=True)
+        else:
+            probabilities = logits
+        best = probabilities.argmax(axis=1)
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            self._stats["batches"] += 1
+            self._stats["images"] += len(images)
+            self._stats["inference_seconds_total"] += elapsed
+        return [(int(index), float(probabilities[row, index])) for row, index in enumerate(best)]
+
+    def _run_batch(self, payloads):
+        with stage("local_inference"):
+            return self._infer([self._decode(data) for data in payloads])
+
+    def start(self):
+        self._queue = asyncio.Queue()
+        self._batcher = asyncio.create_task(self._batch_loop())
+
+    async def stop(self):
+        if self._batcher is not None:
+            self._batcher.cancel()
+            await asyncio.gather(self._batcher, return_exceptions=True)
+            self._batcher = None
+        self._executor.shutdown(wait=True)
+
+    async def _batch_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.batch_size:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+            try:
+                results = await loop.run_in_executor(self._executor, self._run_batch, [data for data, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+    async def classify(self, prepared):
+        """
+        Return a /crop diagnosis dict when the model is confident enough,
+        otherwise None so the caller asks Gemini.
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((prepared.data, future))
+        try:
+            index, confidence = await future
+        except Exception as e:
+            print(f"Local crop classifier failed: {e}")
+            with self._lock:
+                self._stats["errors"] += 1
+            return None
+        info = self.labels[index] if index < len(self.labels) else None
+        if info is None or confidence < self.threshold or "unknown" in (info["crop_name"], info["health_status"]):
+            with self._lock:
+                self._stats["fallbacks"] += 1
+            return None
+        with self._lock:
+            self._stats["local_answers"] += 1
+        return {
+            "crop_name": info["crop_name"],
+            "growth_stage": info.get("growth_stage", "unknown"),
+            "health_status": info["health_status"],
+            "recommendations": info["recommendations"],
+            "confidence": round(confidence, 4),
+            "source": "local",
+        }
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats.update({
+            "threshold": self.threshold,
+            "batch_size": self.batch_size,
+            "classes": len(self.labels),
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+        })
+        return stats
+
+
+_classifier = None
+
+
+def init_classifier():
+    """
+    Load the local classifier if one is configured (crop_classifier_model
+    and crop_classifier_labels). Called once at application startup;
+    returns None when the fast path is disabled.
+    """
+    global _classifier
+    model_path = os.getenv("crop_classifier_model")
+    if _classifier is not None or not model_path:
+        return _classifier
+    if not _load_runtime():
+        print("crop_classifier_model is set but onnxruntime/numpy are not installed; local classifier disabled.")
+        return None
+    try:
+        labels = load_labels(os.getenv("crop_classifier_labels", os.path.splitext(model_path)[0] + ".labels.json"))
+        _classifier = CropClassifier(
+            model_path,
+            labels,
+            threshold=float(os.getenv("crop_classifier_threshold", "0.85")),
+            batch_size=int(os.getenv("crop_classifier_batch", "8")),
+            max_wait_ms=float(os.getenv("crop_classifier_wait_ms", "5")),
+            threads=int(os.getenv("crop_classifier_threads", "0")) or None,
+        )
+    except Exception as e:
+        print(f"An error occurred while loading the local crop classifier: {e}")
+        return None
+    _classifier.start()
+    print(f"Local crop classifier ready ({len(_classifier.labels)} classes).")
+    return _classifier
+
+
+def get_classifier():
+    return _classifier
+
+
+async def close_classifier():
+    global _classifier
+    classifier, _classifier = _classifier, None
+    if classifier is not None:
+        await classifier.stop()
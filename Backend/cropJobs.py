@@ -0,0 +1,269 @@
+from fastapi.responses import JSONResponse
+import asyncio
+import json
+import os
+import random
+import sqlite3
+import threading
+import time
+import uuid
+
+FINISHED = ("done", "failed")
+
+
+def response_payload(response):
+    """
+    Turn whatever CropPhoto returned (a JSONResponse or a JSON string) into
+    ``(status_code, data)``.
+    """
+    if isinstance(response, JSONResponse):
+        return response.status_code, json.loads(response.body)
+    try:
+        return 200, json.loads(response)
+    except (TypeError, ValueError):
+        return 500, {"crop_name": "unknown", "description": "Model did not return valid JSON.", "raw_response": str(response)}
+
+
+class CropJobQueue:
+    """
+    Durable local queue of /crop analyses backed by SQLite.
+
+    Jobs are claimed with a single ``UPDATE ... RETURNING`` statement, which
+    SQLite runs under its write lock, so several workers (or worker
+    processes sharing the file) never pick the same job. Failed model calls
+    are retried with backoff up to ``max_attempts``.
+    """
+
+    def __init__(self, db_path: str, max_attempts: int = 3, retry_backoff: float = 5.0, retention: float = 24 * 3600):
+        self.max_attempts = max_attempts
+        self.retry_backoff = retry_backoff
+        self.retention = retention
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS crop_jobs (
+                id TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                image_path TEXT NOT NULL,
+                digest TEXT NOT NULL,
+                user_id TEXT,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                result TEXT,
+                error TEXT,
+                created_at REAL NOT NULL,
+                available_at REAL NOT NULL,
+                started_at REAL,
+                finished_at REAL
+            )
+        """)
+        self._db.execute("CREATE INDEX IF NOT EXISTS crop_jobs_claim_idx ON crop_jobs (status, available_at, created_at)")
+        columns = {row[1] for row in self._db.execute("PRAGMA table_info(crop_jobs)")}
+        if "user_id" not in columns:
+            # Queue files created before jobs were attributed to users
+            self._db.execute("ALTER TABLE crop_jobs ADD COLUMN user_id TEXT")
+        self._db.commit()
+        self.retries = 0
+
+    def _execute(self, sql, params=()):
+        with self._lock:
+            cursor = self._db.execute(sql, params)
+            rows = cursor.fetchall()
+            self._db.commit()
+            return rows
+
+    def submit(self, image_path: str, digest: str, user_id: str = None) -> str:
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        self._execute(
+            "INSERT INTO crop_jobs (id, status, image_path, digest, user_id, created_at, available_at) VALUES (?, 'queued', ?, ?, ?, ?, ?)",
+            (job_id, image_path, digest, user_id, now, now),
+        )
+        return job_id
+
+    def claim(self):
+        now = time.time()
+        rows = self._execute("""
+            UPDATE crop_jobs
+            SET status = 'running', started_at = ?, attempts = attempts + 1
+            WHERE id = (
+                SELECT id FROM crop_jobs
+                WHERE status = 'queued' AND available_at <= ?
+                ORDER BY created_at
+                LIMIT 1
+            )
+            RETURNING id, image_path, digest, attempts, user_id
+        """, (now, now))
+        return rows[0] if rows else None
+
+    def complete(self, job_id: str, result: dict):
+        self._execute(
+            "UPDATE crop_jobs SET status = 'done', result = ?, finished_at = ? WHERE id = ?",
+            (json.dumps(result), time.time(), job_id),
+        )
+
+    def fail(self, job_id: str, attempts: int, error: str, result: dict = None):
+        """
+        Requeue with exponential backoff, or give up after ``max_attempts``.
+        """
+        if attempts < self.max_attempts:
+            self.retries += 1
+            delay = self.retry_backoff * (2 ** (attempts - 1)) * random.uniform(0.5, 1.5)
+            self._execute(
+                "UPDATE crop_jobs SET status = 'queued', error = ?, available_at = ? WHERE id = ?",
+                (error, time.time() + delay, job_id),
+            )
+        else:
+            self._execute(
+                "UPDATE crop_jobs SET status = 'failed', error = ?, result = ?, finished_at = ? WHERE id = ?",
+                (error, json.dumps(result) if result is not None else None, time.time(), job_id),
+            )
+
+    def get(self, job_id: str):
+        rows = self._execute(
+            "SELECT id, status, attempts, result, error, created_at, started_at, finished_at FROM crop_jobs WHERE id = ?",
+            (job_id,),
+        )
+        if not rows:
+            return None
+        job_id, status, attempts, result, error, created_at, started_at, finished_at = rows[0]
+        return {
+            "job_id": job_id,
+            "status": status,
+            "attempts": attempts,
+            "result": json.loads(result) if result else None,
+            "error": error,
+            "created_at": created_at,
+            "started_at": started_at,
+            "finished_at": finished_at,
+        }
+
+    def recover(self, stale_after: float = 600.0):
+        """
+        Put jobs back in the queue whose worker died mid-run.
+        """
+        self._execute(
+            "UPDATE crop_jobs SET status = 'queued', available_at = ? WHERE status = 'running' AND started_at < ?",
+            (time.time(), time.time() - stale_after),
+        )
+
+    def purge(self):
+        self._execute(
+            "DELETE FROM crop_jobs WHERE status IN ('done', 'failed') AND finished_at < ?",
+            (time.time() - self.retention,),
+        )
+
+    def stats(self):
+        now = time.time()
+        counts = dict(self._execute("SELECT status, COUNT(*) FROM crop_jobs GROUP BY status"))
+        oldest = self._execute("SELECT MIN(created_at) FROM crop_jobs WHERE status = 'queued'")[0][0]
+        avg_wait = self._execute(
+            "SELECT AVG(started_at - created_at) FROM crop_jobs WHERE started_at > ?", (now - 3600,)
+        )[0][0]
+        return {
+            "queued": counts.get("queued", 0),
+            "running": counts.get("running", 0),
+            "done": counts.get("done", 0),
+            "failed": counts.get("failed", 0),
+            "oldest_queued_seconds": now - oldest if oldest else 0.0,
+            "avg_wait_seconds_last_hour": avg_wait or 0.0,
+            "retries": self.retries,
+            "max_attempts": self.max_attempts,
+        }
+
+
+class CropJobRunner:
+    """
+    In-process workers that drain the queue with ``CropPhoto.crop``.
+    ``on_done(user_id, digest, image_path, response, seconds)`` is called
+    for every successful analysis, e.g. to record it in the user's history.
+    """
+
+    def __init__(self, queue: CropJobQueue, crop_photo, workers: int = 2, poll_interval: float = 1.0, on_done=None):
+        self.queue = queue
+        self.crop_photo = crop_photo
+        self.on_done = on_done
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self._wakeup = asyncio.Event()
+        self._finished = asyncio.Condition()
+        self._tasks = []
+
+    def start(self):
+        self.queue.recover()
+        self._tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def submit(self, image_path: str, digest: str, user_id: str = None) -> str:
+        job_id = await asyncio.to_thread(self.queue.submit, image_path, digest, user_id)
+        self._wakeup.set()
+        return job_id
+
+    async def get(self, job_id: str, wait: float = 0.0):
+        """
+        Return the job, waiting up to ``wait`` seconds for it to finish.
+        """
+        deadline = time.monotonic() + wait
+        while True:
+            job = await asyncio.to_thread(self.queue.get, job_id)
+            remaining = deadline - time.monotonic()
+            if job is None or job["status"] in FINISHED or remaining <= 0:
+                return job
+            async with self._finished:
+                try:
+                    # Also re-check periodically in case another process finished it
+                    await asyncio.wait_for(self._finished.wait(), min(remaining, self.poll_interval))
+                except asyncio.TimeoutError:
+                    pass
+
+    async def _work(self):
+        last_purge = 0.0
+        while True:
+            job = await asyncio.to_thread(self.queue.claim)
+            if job is None:
+                if time.monotonic() - last_purge > 3600:
+                    last_purge = time.monotonic()
+                    await asyncio.to_thread(self.queue.purge)
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            job_id, image_path, digest, attempts, user_id = job
+            try:
+                started = time.perf_counter()
+                response = await self.crop_photo.crop(image_path, digest)
+                status, data = response_payload(response)
+                if status == 200:
+                    await asyncio.to_thread(self.queue.complete, job_id, data)
+                    if self.on_done is not None:
+                        try:
+                            self.on_done(user_id, digest, image_path, response, time.perf_counter() - started)
+                        except Exception as e:
+                            # The job itself is done; only the follow-up failed
+                            print(f"Crop job {job_id} completion hook failed: {e}")
+                else:
+                    await asyncio.to_thread(self.queue.fail, job_id, attempts, data.get("description", "analysis failed"), data)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                await asyncio.to_thread(self.queue.fail, job_id, attempts, str(e))
+            async with self._finished:
+                self._finished.notify_all()
+
+
+def runner_from_env(crop_photo, on_done=None) -> CropJobRunner:
+    queue = CropJobQueue(
+        db_path=os.getenv("crop_jobs_db", "crop_jobs.sqlite3"),
+        max_attempts=int(os.getenv("crop_jobs_max_attempts", "3")),
+        retry_backoff=float(os.getenv("crop_jobs_retry_backoff", "5")),
+        retention=float(os.getenv("crop_jobs_retention", str(24 * 3600))),
+    )
+    return CropJobRunner(queue, crop_photo, workers=int(os.getenv("crop_jobs_workers", "2")), on_done=on_done)
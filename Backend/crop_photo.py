@@ -1,14 +1,16 @@
-import google.generativeai as genai
-import os
-from PIL import Image # Required for opening image files
 import json
 from fastapi.responses import JSONResponse
+from llmClient import get_llm_client, LLMUnavailable
+from imageIndex import content_hash, index_from_env
+from imagePreprocess import get_preprocessor
+from cropClassifier import get_classifier
+import asyncio
 class CropPhoto:
-    def __init__(self, image_path):
-        self.image_path = image_path
-        api_key = os.getenv("gemini_api")
-        genai.configure(api_key=api_key)
-        self.client = genai.GenerativeModel("gemini-1.5-flash-latest")
+    def __init__(self):
+        # One instance serves every request; Gemini is reached through the shared LLMClient
+        self.model_name = "gemini-1.5-flash-latest"
+        # Diagnoses by content hash and perceptual hash, so repeat photos skip the model
+        self.index = index_from_env()
         self.text_instructions = """Your are smart farmer, you provide detailed information about the crop in the image.
         You will provide the crop name, its growth stage, and any visible issues or pests. 
         If the crop is healthy, you will say 'healthy'. If there are issues, you will describe them in detail.
@@ -27,34 +29,76 @@ class CropPhoto:
         alway provide for similar image similar response.
         """ # Note: I'm assuming this is the text prompt, and not the one with image_path concatenated.
 
-    def crop(self):
+    @staticmethod
+    def _read_file(image_path):
+        with open(image_path, "rb") as f:
+            return f.read()
+
+    def _cached_response(self, data, kind):
+        return JSONResponse(content=data, status_code=200, headers={"X-Diagnosis-Cache": kind})
+
+    async def crop(self, image_path, digest=None):
+        """
+        Diagnose the crop in an image file. ``digest`` is the sha256 of the
+        file contents when the caller already has it.
+        """
         try:
-            # Open the image file from the provided path
-            img = Image.open(self.image_path)
+            # Read the image file from the provided path
+            raw = await asyncio.to_thread(self._read_file, image_path)
         except FileNotFoundError:
-            safe_image_path = self.image_path.replace('"', '\\"')
+            safe_image_path = image_path.replace('"', '\\"')
             return f'{{"crop_name": "unknown", "description": "Error: Image file not found at {safe_image_path}."}}'
+        return await self.diagnose(raw, digest)
+
+    async def diagnose(self, raw, digest=None):
+        """
+        Diagnose the crop in an in-memory image, e.g. an upload that was
+        never written to disk.
+        """
+        if digest is None:
+            digest = content_hash(raw)
+        cached = await self.index.lookup_exact(digest)
+        if cached is not None:
+            return self._cached_response(cached, "exact")
+
+        try:
+            # Oriented, downscaled, metadata-free JPEG decoded off the event loop
+            prepared = await get_preprocessor().prepare(raw)
         except Exception as e:
             safe_error_message = str(e).replace('"', '\\"')
             return f'{{"crop_name": "unknown", "description": "Error: Could not open image - {safe_error_message}."}}'
 
-        content_parts = [self.text_instructions, img]
-        
+        image_hash = prepared.image_hash
+        similar = await self.index.lookup_similar(image_hash)
+        if similar is not None:
+            return self._cached_response(similar, "similar")
+
+        local = await self._classify_locally(prepared)
+        if local is not None:
+            await self._remember(digest, image_hash, local)
+            return JSONResponse(content=local, status_code=200, headers={"X-Diagnosis-Cache": "miss", "X-Diagnosis-Source": "local"})
+
+        content_parts = [self.text_instructions, prepared.as_part()]
+        llm = get_llm_client()
+
         try:
-            response = self.client.generate_content(
+            response = await llm.generate(
+                self.model_name,
                 content_parts,
-                generation_config=genai.types.GenerationConfig(
+                endpoint="crop",
+                generation_config={
                     # Requesting JSON output directly if supported by the model/SDK version
-                    response_mime_type="application/json" 
-                )
+                    "response_mime_type": "application/json",
+                }
             )
             # The model is instructed to return JSON directly.
 
             data = json.loads(response.text)
-            return JSONResponse(content=data, status_code=200)
+            await self._remember(digest, image_hash, data)
+            return JSONResponse(content=data, status_code=200, headers={"X-Diagnosis-Cache": "miss"})
         except AttributeError: # Fallback if response_mime_type or genai.types is not supported
             try:
-                response = self.client.generate_content(content_parts)
+                response = await llm.generate(self.model_name, content_parts, endpoint="crop")
                 return response.text # Model should still attempt to return JSON based on prompt
             except Exception as e:
                 return JSONResponse(content={
@@ -63,8 +107,169 @@ class CropPhoto:
                     "raw_response": response.text
                 }, status_code=500)
 
+        except LLMUnavailable as e:
+            return JSONResponse(content={
+                "crop_name": "unknown",
+                "description": f"Error: {str(e)}"
+            }, status_code=503)
         except Exception as e:
             return JSONResponse(content={
                 "crop_name": "unknown",
                 "description": f"Error: API call failed - {str(e)}"
-            }, status_code=500)
\ No newline at end of file
+            }, status_code=500)
+    @staticmethod
+    async def _classify_locally(prepared):
+        """
+        Answer from the on-CPU classifier when it is loaded and confident;
+        None means ask Gemini.
+        """
+        classifier = get_classifier()
+        if classifier is None:
+            return None
+        return await classifier.classify(prepared)
+
+    async def _remember(self, digest, image_hash, data):
+        if isinstance(data, dict) and data.get("crop_name") != "unknown":
+            await self.index.store(digest, image_hash, data)
+
+    async def _diagnose_group(self, group):
+        """
+        Diagnose several prepared images with one model call. Returns one
+        result per image, or None if the model did not answer with a JSON
+        array of the right length.
+        """
+        content_parts = [
+            self.text_instructions,
+            f"You will receive {len(group)} images. Respond with a JSON array of exactly {len(group)} objects, "
+            "one per image in the order given, each in the format described above.",
+        ]
+        content_parts.extend(prepared.as_part() for prepared in group)
+        response = await get_llm_client().generate(
+            self.model_name,
+            content_parts,
+            endpoint="crop",
+            generation_config={"response_mime_type": "application/json"},
+        )
+        data = json.loads(response.text)
+        if not isinstance(data, list) or len(data) != len(group):
+            return None
+        return data
+
+    async def _diagnose_single(self, prepared):
+        response = await get_llm_client().generate(
+            self.model_name,
+            [self.text_instructions, prepared.as_part()],
+            endpoint="crop",
+            generation_config={"response_mime_type": "application/json"},
+        )
+        return json.loads(response.text)
+
+    async def diagnose_batch(self, uploads, group_size=4):
+        """
+        Diagnose many images, yielding ``(index, cache, result)`` as soon as
+        each result is ready, in completion order.
+
+        Cache hits come back first. The rest are preprocessed in parallel
+        and sent to Gemini ``group_size`` images per request; a group whose
+        answer cannot be matched to its images falls back to one call per
+        image. The shared LLM client bounds how many calls run at once.
+        """
+        results = asyncio.Queue()
+        emitted = set()
+        pending = []
+
+        def emit(index, cache, data):
+            # Exactly one result per image, even when a failure is reported late
+            if index not in emitted:
+                emitted.add(index)
+                results.put_nowait((index, cache, data))
+
+        def fail(index, error):
+            emit(index, "miss", {
+                "crop_name": "unknown",
+                "description": f"Error: API call failed - {str(error)}"
+            })
+
+        for index, (raw, digest) in enumerate(uploads):
+            cached = await self.index.lookup_exact(digest)
+            if cached is not None:
+                emit(index, "exact", cached)
+            else:
+                pending.append((index, raw, digest))
+
+        async def run_group(group):
+            try:
+                # Confident local classifications are answered without a model call
+                local = await asyncio.gather(*(self._classify_locally(prepared) for _, _, prepared in group))
+                remaining = []
+                for (index, digest, prepared), data in zip(group, local):
+                    if data is None:
+                        remaining.append((index, digest, prepared))
+                        continue
+                    await self._remember(digest, prepared.image_hash, data)
+                    emit(index, "miss", data)
+                group = remaining
+                if not group:
+                    return
+                answers = None
+                if len(group) > 1:
+                    try:
+                        answers = await self._diagnose_group([prepared for _, _, prepared in group])
+                    except (ValueError, LLMUnavailable):
+                        answers = None
+                if answers is None:
+                    answers = await asyncio.gather(
+                        *(self._diagnose_single(prepared) for _, _, prepared in group), return_exceptions=True
+                    )
+                for (index, digest, prepared), data in zip(group, answers):
+                    if isinstance(data, BaseException):
+                        fail(index, data)
+                        continue
+                    await self._remember(digest, prepared.image_hash, data)
+                    emit(index, "miss", data)
+            except Exception as e:
+                for index, _, _ in group:
+                    fail(index, e)
+
+        async def prepare_one(index, raw, digest):
+            try:
+                return index, digest, await get_preprocessor().prepare(raw), None
+            except Exception as e:
+                return index, digest, None, e
+
+        async def prepare_all():
+            group, group_tasks = [], []
+            try:
+                for future in asyncio.as_completed([prepare_one(*item) for item in pending]):
+                    index, digest, prepared, error = await future
+                    if error is not None:
+                        emit(index, "miss", {
+                            "crop_name": "unknown",
+                            "description": f"Error: Could not open image - {str(error)}."
+                        })
+                        continue
+                    similar = await self.index.lookup_similar(prepared.image_hash)
+                    if similar is not None:
+                        emit(index, "similar", similar)
+                        continue
+                    group.append((index, digest, prepared))
+                    if len(group) >= group_size:
+                        group_tasks.append(asyncio.create_task(run_group(group)))
+                        group = []
+                if group:
+                    group_tasks.append(asyncio.create_task(run_group(group)))
+            except Exception as e:
+                # Groups already sent still answer for their images; the rest get the error
+                await asyncio.gather(*group_tasks, return_exceptions=True)
+                for index, _, _ in pending:
+                    fail(index, e)
+                return
+            await asyncio.gather(*group_tasks)
+
+        worker = asyncio.create_task(prepare_all())
+        try:
+            for _ in range(len(uploads)):
+                yield await results.get()
+        finally:
+            if not worker.done():
+                worker.cancel()
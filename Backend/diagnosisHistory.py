@@ -0,0 +1,324 @@
+from PIL import Image
+from createConnection import pooled_connection
+from asyncDb import run_db
+from loginSystem import encode_cursor, decode_cursor
+from cropJobs import response_payload
+import asyncio
+import fcntl
+import json
+import os
+import time
+import uuid
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+# Diagnoses that are not a problem to track
+NOT_OUTBREAKS = ("healthy", "unknown")
+THUMBNAIL_DIR = "thumbs"
+
+
+def _user_uuid(user_id):
+    """
+    The user id as stored in ``diagnoses.user_id``, or None when the
+    request was anonymous or carried something that is not a user id.
+    """
+    try:
+        return str(uuid.UUID(str(user_id))) if user_id else None
+    except ValueError:
+        return None
+
+
+class DiagnosisHistory:
+    """
+    Every /crop result kept in the ``diagnoses`` table, with the user,
+    image hash, outcome, model and latency.
+
+    Rows are written in the background after the response is ready, so a
+    slow or unavailable database never delays a diagnosis. A user id that
+    is not a registered user is stored as anonymous rather than failing
+    the insert on the foreign key. Reads are
+    keyset-paginated on ``(created_at, id)``, which the composite indexes
+    serve without sorting.
+    """
+
+    def __init__(self):
+        self.stats_counts = {"recorded": 0, "record_failures": 0}
+
+    def _insert(self, rows):
+        with pooled_connection() as conn, conn.cursor() as cursor:
+            cursor.executemany("""
+                INSERT INTO diagnoses (user_id, country, image_hash, image_path, crop_name, health_status,
+                                       model, cache, latency_ms, result)
+                VALUES ((SELECT userId FROM users WHERE userId = %s), (SELECT country FROM users WHERE userId = %s),
+                        %s, %s, %s, %s, %s, %s, %s, %s::jsonb)
+            """, rows)
+            conn.commit()
+
+    def record(self, user_id, image_hash: str, image_path: str, data: dict, model: str, cache: str, latency: float):
+        """
+        Store one finished diagnosis in the background.
+        """
+        self.record_many(user_id, [(image_hash, image_path, data, model, cache, latency)])
+
+    def record_response(self, user_id, image_hash: str, image_path: str, response, model: str, latency: float):
+        """
+        Store what CropPhoto returned, if it was a successful diagnosis.
+        """
+        status, data = response_payload(response)
+        if status != 200 or not isinstance(data, dict):
+            return
+        cache = getattr(response, "headers", {}).get("x-diagnosis-cache")
+        self.record(user_id, image_hash, image_path, data, "local" if data.get("source") == "local" else model, cache, latency)
+
+    def record_many(self, user_id, diagnoses):
+        """
+        Store ``(image_hash, image_path, data, model, cache, latency)``
+        tuples for one user in the background, in a single round trip.
+        """
+        user = _user_uuid(user_id)
+        rows = [
+            (user, user, image_hash, image_path, str(data.get("crop_name") or "unknown").lower(),
+             str(data.get("health_status") or "unknown").lower(), model, cache, round(latency * 1000, 1), json.dumps(data))
+            for image_hash, image_path, data, model, cache, latency in diagnoses
+        ]
+        if rows:
+            task = asyncio.create_task(run_db(self._insert, rows))
+            task.add_done_callback(lambda task: self._report(task, len(rows)))
+
+    def _report(self, task, count):
+        if task.cancelled() or task.exception() is not None:
+            print(f"Diagnosis history error: {None if task.cancelled() else task.exception()}")
+            self.stats_counts["record_failures"] += count
+        else:
+            self.stats_counts["recorded"] += count
+
+    def _forUser(self, user_id: str, limit: int, after):
+        keyset, params = "", [user_id]
+        if after is not None:
+            keyset = "AND (created_at, id) < (%s, %s)"
+            params.extend(after)
+        with pooled_connection() as conn, conn.cursor() as cursor:
+            cursor.execute(f"""
+                SELECT id, created_at, crop_name, health_status, model, latency_ms, result
+                FROM diagnoses
+                WHERE user_id = %s {keyset}
+                ORDER BY created_at DESC, id DESC
+                LIMIT %s
+            """, (*params, limit + 1))
+            return cursor.fetchall()
+
+    async def for_user(self, user_id: str, limit: int = DEFAULT_PAGE_SIZE, cursor: str = None) -> dict:
+        """
+        One page of a user's diagnoses, newest first. Pass ``next_cursor``
+        back to fetch the following page. Raises ValueError for a bad cursor.
+        """
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+        after = None
+        if cursor:
+            created_at, row_id = decode_cursor(cursor)
+            after = (created_at, int(row_id))
+        user = _user_uuid(user_id)
+        rows = await run_db(self._forUser, user, limit, after) if user else []
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        return {
+            "diagnoses": [{
+                "id": row[0],
+                "created_at": row[1].isoformat(),
+                "crop_name": row[2],
+                "health_status": row[3],
+                "model": row[4],
+                "latency_ms": row[5],
+                "result": row[6],
+            } for row in rows],
+            "next_cursor": encode_cursor(rows[-1][1], rows[-1][0]) if has_more else None,
+        }
+
+    def _outbreaks(self, country: str, days: float, crop: str = None):
+        crop_filter, params = "", [country, days, list(NOT_OUTBREAKS)]
+        if crop:
+            crop_filter = "AND crop_name = %s"
+            params.append(crop.lower())
+        with pooled_connection() as conn, conn.cursor() as cursor:
+            cursor.execute(f"""
+                SELECT crop_name, health_status, count(*), min(created_at), max(created_at)
+                FROM diagnoses
+                WHERE country = %s
+                  AND created_at >= CURRENT_TIMESTAMP - %s * INTERVAL '1 day'
+                  AND health_status <> ALL(%s)
+                  {crop_filter}
+                GROUP BY crop_name, health_status
+                ORDER BY count(*) DESC
+            """, params)
+            return cursor.fetchall()
+
+    async def outbreaks(self, country: str, days: float = 14, crop: str = None) -> list:
+        """
+        Problems diagnosed in a country over the last ``days``, most
+        reported first.
+        """
+        rows = await run_db(self._outbreaks, country, days, crop)
+        return [{
+            "crop_name": row[0],
+            "health_status": row[1],
+            "cases": row[2],
+            "first_seen": row[3].isoformat(),
+            "last_seen": row[4].isoformat(),
+        } for row in rows]
+
+    def stats(self):
+        return dict(self.stats_counts)
+
+
+class UploadRetention:
+    """
+    Background sweep that keeps ``uploads/`` and the ``diagnoses`` table
+    from growing without bound.
+
+    Uploads older than ``thumbnail_after`` seconds are replaced by a small
+    JPEG thumbnail in ``uploads/thumbs``; thumbnails older than
+    ``delete_after`` are removed; diagnoses older than ``keep_rows_for``
+    are deleted in batches. ``image_path`` in the table follows the file.
+    With several worker processes, a file lock lets only one sweep at a time.
+    """
+
+    DELETE_BATCH = 5000
+
+    def __init__(self, upload_dir: str, interval: float = 3600, thumbnail_after: float = 30 * 86400,
+                 delete_after: float = 365 * 86400, keep_rows_for: float = 2 * 365 * 86400, thumbnail_size: int = 256):
+        self.upload_dir = upload_dir
+        self.thumbnail_dir = os.path.join(upload_dir, THUMBNAIL_DIR)
+        self.interval = interval
+        self.thumbnail_after = thumbnail_after
+        self.delete_after = delete_after
+        self.keep_rows_for = keep_rows_for
+        self.thumbnail_size = thumbnail_size
+        self._task = None
+        self.stats_counts = {"sweeps": 0, "thumbnailed": 0, "deleted_files": 0, "deleted_rows": 0, "bytes_freed": 0, "errors": 0}
+
+    def start(self):
+        if self.interval > 0:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _loop(self):
+        while True:
+            # The first sweep waits a full interval, keeping it out of startup
+            await asyncio.sleep(self.interval)
+            try:
+                await self.sweep()
+            except Exception as e:
+                print(f"Upload retention error: {e}")
+                self.stats_counts["errors"] += 1
+
+    async def sweep(self):
+        swept = await asyncio.to_thread(self._sweep_files)
+        if swept is None:
+            return  # another worker is sweeping
+        moved, removed = swept
+        if moved or removed:
+            await run_db(self._update_paths, moved, removed)
+        if self.keep_rows_for > 0:
+            await run_db(self._delete_rows)
+        self.stats_counts["sweeps"] += 1
+
+    def _thumbnail(self, path: str, thumb_path: str):
+        with Image.open(path) as img:
+            img.draft("RGB", (self.thumbnail_size, self.thumbnail_size))
+            img = img.convert("RGB")
+            img.thumbnail((self.thumbnail_size, self.thumbnail_size))
+            tmp_path = f"{thumb_path}.{os.getpid()}.tmp"
+            img.save(tmp_path, format="JPEG", quality=80)
+        os.replace(tmp_path, thumb_path)
+
+    def _sweep_files(self):
+        """
+        Compact and delete files; returns ``(moved, removed)`` path lists
+        for the table update, or None when another process holds the lock.
+        """
+        os.makedirs(self.thumbnail_dir, exist_ok=True)
+        now = time.time()
+        moved, removed = [], []
+        with open(os.path.join(self.upload_dir, ".retention.lock"), "w") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return None
+            for entry in os.scandir(self.upload_dir):
+                if not entry.is_file() or entry.name.startswith(".") or entry.name.endswith(".tmp"):
+                    continue
+                stat = entry.stat()
+                age = now - stat.st_mtime
+                if self.delete_after > 0 and age >= self.delete_after:
+                    os.remove(entry.path)
+                    removed.append(entry.path)
+                    self.stats_counts["bytes_freed"] += stat.st_size
+                    continue
+                if age < self.thumbnail_after:
+                    continue
+                thumb_path = os.path.join(self.thumbnail_dir, os.path.splitext(entry.name)[0] + ".jpg")
+                try:
+                    self._thumbnail(entry.path, thumb_path)
+                    # Keep the upload's age, so delete_after counts from the upload
+                    os.utime(thumb_path, (stat.st_atime, stat.st_mtime))
+                    self.stats_counts["thumbnailed"] += 1
+                    moved.append((entry.path, thumb_path))
+                except (OSError, ValueError) as e:
+                    # Not an image we can read; nothing worth keeping
+                    print(f"Could not thumbnail {entry.path}: {e}")
+                    removed.append(entry.path)
+                os.remove(entry.path)
+                self.stats_counts["bytes_freed"] += stat.st_size
+            if self.delete_after > 0:
+                for entry in os.scandir(self.thumbnail_dir):
+                    if entry.is_file() and now - entry.stat().st_mtime >= self.delete_after:
+                        self.stats_counts["bytes_freed"] += entry.stat().st_size
+                        os.remove(entry.path)
+                        removed.append(entry.path)
+            self.stats_counts["deleted_files"] += len(removed)
+        return moved, removed
+
+    def _update_paths(self, moved, removed):
+        with pooled_connection() as conn, conn.cursor() as cursor:
+            cursor.executemany("UPDATE diagnoses SET image_path = %s WHERE image_path = %s",
+                               [(thumb_path, path) for path, thumb_path in moved])
+            if removed:
+                cursor.execute("UPDATE diagnoses SET image_path = NULL WHERE image_path = ANY(%s)", (removed,))
+            conn.commit()
+
+    def _delete_rows(self):
+        while True:
+            with pooled_connection() as conn, conn.cursor() as cursor:
+                # Small batches keep each transaction (and its locks) short
+                cursor.execute("""
+                    DELETE FROM diagnoses WHERE id IN (
+                        SELECT id FROM diagnoses
+                        WHERE created_at < CURRENT_TIMESTAMP - %s * INTERVAL '1 second'
+                        LIMIT %s
+                    )
+                """, (self.keep_rows_for, self.DELETE_BATCH))
+                deleted = cursor.rowcount
+                conn.commit()
+            self.stats_counts["deleted_rows"] += deleted
+            if deleted < self.DELETE_BATCH:
+                return
+
+    def stats(self):
+        return dict(self.stats_counts)
+
+
+def retention_from_env(upload_dir: str) -> UploadRetention:
+    day = 86400
+    return UploadRetention(
+        upload_dir,
+        interval=float(os.getenv("upload_retention_interval", "3600")),
+        thumbnail_after=float(os.getenv("upload_thumbnail_after_days", "30")) * day,
+        delete_after=float(os.getenv("upload_delete_after_days", "365")) * day,
+        keep_rows_for=float(os.getenv("diagnosis_retention_days", "730")) * day,
+        thumbnail_size=int(os.getenv("upload_thumbnail_size", "256")),
+    )
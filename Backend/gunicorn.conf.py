@@ -0,0 +1,62 @@
+"""
+Multi-worker serving mode: gunicorn managing uvicorn workers.
+
+    gunicorn -c gunicorn.conf.py main:app
+
+Settings come from the environment:
+
+    web_workers      worker processes (default: one per core)
+    web_bind         listen address (default 0.0.0.0:8000)
+    web_preload      import the app and the heavy SDKs once in the master,
+                     before forking, so workers start warm and share those
+                     pages copy-on-write (default true)
+    web_timeout      seconds before a stuck worker is restarted (default 120)
+
+Everything with a connection, thread or file handle (the database pool,
+the bcrypt process pool, the Gemini client, SQLite caches, the crop job
+runner) is created in each worker's lifespan, after the fork. Pool sizes
+such as db_pool_max are therefore per worker.
+"""
+import os
+import secrets
+
+
+def _flag(name, default):
+    return os.getenv(name, default).lower() in ("1", "true", "yes")
+
+
+bind = os.getenv("web_bind", "0.0.0.0:8000")
+workers = int(os.getenv("web_workers", "0")) or os.cpu_count() or 1
+worker_class = "uvicorn.workers.UvicornWorker"
+preload_app = _flag("web_preload", "true")
+timeout = int(os.getenv("web_timeout", "120"))
+graceful_timeout = int(os.getenv("web_graceful_timeout", "30"))
+keepalive = 5
+
+
+def on_starting(server):
+    """
+    Runs once in the master before any worker exists. Decisions every
+    worker must agree on are made here and handed down through the
+    environment.
+    """
+    from dotenv import load_dotenv  # type: ignore
+    load_dotenv()
+    # Tokens signed by one worker must verify in the others
+    if not os.getenv("session_secret"):
+        server.log.warning("session_secret is not set; using a random secret shared by this server's workers.")
+        os.environ["session_secret"] = secrets.token_urlsafe(32)
+    # Calibrate bcrypt once rather than once per worker
+    if not os.getenv("bcrypt_rounds"):
+        from passwordHasher import calibrate_rounds
+        os.environ["bcrypt_rounds"] = str(calibrate_rounds(float(os.getenv("bcrypt_target_ms", "250"))))
+        server.log.info(f"bcrypt cost calibrated to {os.environ['bcrypt_rounds']} rounds for all workers.")
+    # Each worker has its own hashing pool; together they should not exceed the cores
+    os.environ.setdefault("bcrypt_workers", str(max(1, (os.cpu_count() or 1) // workers)))
+    if workers > 1:
+        # Profile caches are per worker; writes in one must evict in the others
+        os.environ.setdefault("profile_cache_listen", "true")
+    if preload_app:
+        # Only imported, not configured: the SDK's clients and channels are
+        # created per worker by init_llm_client
+        import google.generativeai  # noqa: F401  # type: ignore
@@ -0,0 +1,164 @@
+from collections import deque
+from PIL import Image
+from responseCache import LRUCache
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+def content_hash(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def dhash(img: Image.Image, size: int = 8) -> int:
+    """
+    Difference hash: shrink to (size+1) x size greyscale and record whether
+    each pixel is brighter than its right neighbour. Photos of the same
+    scene land within a few bits of each other.
+    """
+    img.draft("L", (size * 8, size * 8))  # let the JPEG decoder skip most of the pixels
+    small = img.convert("L").resize((size + 1, size), Image.Resampling.LANCZOS)
+    pixels = list(small.getdata())
+    bits = 0
+    for row in range(size):
+        for col in range(size):
+            left = pixels[row * (size + 1) + col]
+            right = pixels[row * (size + 1) + col + 1]
+            bits = (bits << 1) | (left > right)
+    return bits
+
+
+class DiagnosisIndex:
+    """
+    Remembers crop diagnoses by image content hash and by perceptual hash.
+
+    Exact re-uploads are answered from the content hash. Near-duplicates
+    (another shot of the same field) reuse a diagnosis made within
+    ``max_age`` seconds whose dHash differs by at most ``threshold`` bits.
+    Entries are persisted in SQLite so they survive restarts.
+    """
+
+    def __init__(self, db_path: str, threshold: int = 5, max_age: float = 7 * 24 * 3600, max_recent: int = 10000):
+        self.threshold = threshold
+        self.max_age = max_age
+        self._memory = LRUCache(max_entries=1024, ttl=max_age)
+        self._recent = deque(maxlen=max_recent)  # (dhash, content_hash, created_at), oldest first
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS diagnoses (
+                content_hash TEXT PRIMARY KEY,
+                dhash TEXT NOT NULL,
+                result TEXT NOT NULL,
+                created_at REAL NOT NULL
+            )
+        """)
+        self._db.execute("CREATE INDEX IF NOT EXISTS diagnoses_created_at_idx ON diagnoses (created_at)")
+        self._db.commit()
+        rows = self._db.execute(
+            "SELECT dhash, content_hash, created_at FROM diagnoses WHERE created_at > ? ORDER BY created_at DESC LIMIT ?",
+            (time.time() - max_age, max_recent),
+        ).fetchall()
+        for hash_hex, digest, created_at in reversed(rows):
+            self._recent.append((int(hash_hex, 16), digest, created_at))
+        self.exact_hits = 0
+        self.near_hits = 0
+        self.misses = 0
+
+    def _load(self, digest: str):
+        result = self._memory.get(digest)
+        if result is not None:
+            return result
+        with self._lock:
+            row = self._db.execute(
+                "SELECT result FROM diagnoses WHERE content_hash = ? AND created_at > ?",
+                (digest, time.time() - self.max_age),
+            ).fetchone()
+        if row is None:
+            return None
+        result = json.loads(row[0])
+        self._memory.set(digest, result)
+        return result
+
+    def get_exact(self, digest: str):
+        result = self._load(digest)
+        if result is not None:
+            self.exact_hits += 1
+        return result
+
+    def find_similar(self, image_hash: int):
+        """
+        Return the diagnosis of the most recent photo within the threshold.
+        """
+        cutoff = time.time() - self.max_age
+        with self._lock:
+            candidates = list(self._recent)
+        for other_hash, digest, created_at in reversed(candidates):
+            if created_at < cutoff:
+                break
+            if (image_hash ^ other_hash).bit_count() <= self.threshold:
+                result = self._load(digest)
+                if result is not None:
+                    self.near_hits += 1
+                    return result
+        self.misses += 1
+        return None
+
+    def put(self, digest: str, image_hash: int, result: dict):
+        now = time.time()
+        self._memory.set(digest, result)
+        with self._lock:
+            self._recent.append((image_hash, digest, now))
+        self._write(digest, image_hash, result, now)
+
+    def _write(self, digest: str, image_hash: int, result: dict, created_at: float):
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO diagnoses (content_hash, dhash, result, created_at) VALUES (?, ?, ?, ?)",
+                (digest, format(image_hash, "016x"), json.dumps(result), created_at),
+            )
+            self._db.commit()
+
+    # Async variants for the request path: SQLite reads and commits run on a
+    # worker thread; in-memory hits are answered on the event loop.
+
+    async def lookup_exact(self, digest: str):
+        result = self._memory.get(digest)
+        if result is not None:
+            self.exact_hits += 1
+            return result
+        return await asyncio.to_thread(self.get_exact, digest)
+
+    async def lookup_similar(self, image_hash: int):
+        return await asyncio.to_thread(self.find_similar, image_hash)
+
+    async def store(self, digest: str, image_hash: int, result: dict):
+        now = time.time()
+        self._memory.set(digest, result)
+        with self._lock:
+            self._recent.append((image_hash, digest, now))
+        await asyncio.to_thread(self._write, digest, image_hash, result, now)
+
+    def stats(self):
+        with self._lock:
+            recent = len(self._recent)
+        return {
+            "exact_hits": self.exact_hits,
+            "near_hits": self.near_hits,
+            "misses": self.misses,
+            "indexed": recent,
+            "threshold": self.threshold,
+        }
+
+
+def index_from_env() -> DiagnosisIndex:
+    return DiagnosisIndex(
+        db_path=os.getenv("crop_cache_db", "diagnosis_cache.sqlite3"),
+        threshold=int(os.getenv("crop_similarity_threshold", "5")),
+        max_age=float(os.getenv("crop_similarity_max_age", str(7 * 24 * 3600))),
+    )
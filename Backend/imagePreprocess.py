@@ -0,0 +1,173 @@
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image, ImageOps
+from imageIndex import dhash
+from metrics import stage
+import asyncio
+import contextvars
+import io
+import os
+import threading
+import time
+
+ORIENTATION_TAG = 0x0112
+# JPEG segments that carry metadata rather than pixels: APP1 (EXIF, XMP),
+# APP13 (IPTC/Photoshop) and comments
+METADATA_SEGMENTS = frozenset((0xE1, 0xED, 0xFE))
+START_OF_SCAN = 0xDA
+
+
+def strip_jpeg_metadata(data: bytes):
+    """
+    The JPEG with its metadata segments removed and the compressed image
+    data untouched, or None when the marker structure cannot be followed.
+    """
+    if data[:2] != b"\xff\xd8":
+        return None
+    parts, pos = [data[:2]], 2
+    while pos + 4 <= len(data):
+        if data[pos] != 0xFF:
+            return None
+        marker = data[pos + 1]
+        if marker == 0xFF:  # fill byte
+            pos += 1
+            continue
+        if marker == START_OF_SCAN:
+            parts.append(data[pos:])
+            return b"".join(parts)
+        if marker == 0x01 or 0xD0 <= marker <= 0xD8:  # markers without a length
+            parts.append(data[pos:pos + 2])
+            pos += 2
+            continue
+        end = pos + 2 + int.from_bytes(data[pos + 2:pos + 4], "big")
+        if end > len(data) or end < pos + 4:
+            return None
+        if marker not in METADATA_SEGMENTS:
+            parts.append(data[pos:end])
+        pos = end
+    return None
+
+
+class PreparedImage:
+    """
+    A model-ready JPEG plus what was learned while decoding it.
+    """
+
+    def __init__(self, data: bytes, width: int, height: int, image_hash: int, source_bytes: int):
+        self.data = data
+        self.width = width
+        self.height = height
+        self.image_hash = image_hash
+        self.source_bytes = source_bytes
+        self.mime_type = "image/jpeg"
+
+    def as_part(self):
+        """
+        Inline image part for ``generate_content``.
+        """
+        return {"mime_type": self.mime_type, "data": self.data}
+
+
+def preprocess_image(data: bytes, max_edge: int = 1024, quality: int = 85) -> PreparedImage:
+    """
+    Decode, orient, shrink and re-encode an upload for inference.
+
+    JPEGs are decoded in draft mode, letting libjpeg scale by 1/2, 1/4 or
+    1/8 while decoding, so a 12MP photo never materialises at full size.
+    ``reduce()`` then does a cheap integer box downscale and ``thumbnail``
+    the final resample. EXIF orientation is applied to the pixels and all
+    metadata is dropped on save. An upright JPEG that already fits keeps
+    its compressed data when re-encoding would not make it smaller, with
+    its metadata segments stripped.
+    """
+    img = Image.open(io.BytesIO(data))
+    # A JPEG that needs no resize or rotation may already be smaller than our encoding of it
+    reusable = (img.format == "JPEG" and max(img.size) <= max_edge and img.mode in ("RGB", "L")
+                and img.getexif().get(ORIENTATION_TAG, 1) == 1)
+    if img.format == "JPEG":
+        img.draft("RGB", (max_edge, max_edge))
+    img = ImageOps.exif_transpose(img)
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+    factor = max(img.size) // max_edge
+    if factor >= 2:
+        img = img.reduce(factor)
+    if max(img.size) > max_edge:
+        img.thumbnail((max_edge, max_edge), Image.Resampling.LANCZOS)
+    # Pillow writes a decoded comment back out unless it is dropped
+    img.info.pop("comment", None)
+    out = io.BytesIO()
+    img.save(out, "JPEG", quality=quality, optimize=True)
+    encoded = out.getvalue()
+    if reusable:
+        # Sent without re-encoding, but never with its EXIF (GPS, device) or XMP
+        stripped = strip_jpeg_metadata(data)
+        if stripped is not None and len(stripped) <= len(encoded):
+            encoded = stripped
+    return PreparedImage(encoded, img.width, img.height, dhash(img), len(data))
+
+
+class ImagePreprocessor:
+    """
+    Runs ``preprocess_image`` on a thread pool sized to the cores. Pillow
+    releases the GIL while decoding and resampling, so threads scale without
+    copying every upload into another process.
+    """
+
+    def __init__(self, max_edge: int = 1024, quality: int = 85, workers: int = None):
+        self.max_edge = max_edge
+        self.quality = quality
+        self.workers = workers or os.cpu_count() or 1
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="image")
+        self._lock = threading.Lock()
+        self._stats = {"images": 0, "bytes_in": 0, "bytes_out": 0, "seconds_total": 0.0}
+
+    def _run(self, data: bytes) -> PreparedImage:
+        started = time.perf_counter()
+        with stage("image_decode"):
+            prepared = preprocess_image(data, self.max_edge, self.quality)
+        with self._lock:
+            self._stats["images"] += 1
+            self._stats["bytes_in"] += len(data)
+            self._stats["bytes_out"] += len(prepared.data)
+            self._stats["seconds_total"] += time.perf_counter() - started
+        return prepared
+
+    async def prepare(self, data: bytes) -> PreparedImage:
+        loop = asyncio.get_running_loop()
+        ctx = contextvars.copy_context()
+        return await loop.run_in_executor(self._executor, ctx.run, self._run, data)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats.update({"max_edge": self.max_edge, "quality": self.quality, "workers": self.workers})
+        return stats
+
+
+_preprocessor = None
+
+
+def init_preprocessor():
+    global _preprocessor
+    if _preprocessor is None:
+        workers = os.getenv("image_workers")
+        _preprocessor = ImagePreprocessor(
+            max_edge=int(os.getenv("image_max_edge", "1024")),
+            quality=int(os.getenv("image_quality", "85")),
+            workers=int(workers) if workers else None,
+        )
+    return _preprocessor
+
+
+def get_preprocessor():
+    return _preprocessor if _preprocessor is not None else init_preprocessor()
+
+
+def close_preprocessor():
+    global _preprocessor
+    preprocessor, _preprocessor = _preprocessor, None
+    if preprocessor is not None:
+        preprocessor.shutdown()
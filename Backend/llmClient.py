@@ -0,0 +1,328 @@
+from dotenv import load_dotenv
+from metrics import LLM_CACHED_TOKENS, LLM_PROMPT_TOKENS, record_stage, stage
+import asyncio
+import os
+import random
+import time
+
+
+def retryable_errors():
+    """
+    Errors worth retrying: rate limiting and transient server trouble.
+    Resolved on first use, since google.api_core pulls in grpc.
+    """
+    from google.api_core import exceptions as google_exceptions  # type: ignore
+    return (
+        google_exceptions.ResourceExhausted,
+        google_exceptions.TooManyRequests,
+        google_exceptions.ServiceUnavailable,
+        google_exceptions.InternalServerError,
+        google_exceptions.DeadlineExceeded,
+    )
+
+
+_END = object()
+
+
+class _ThreadedStream:
+    """
+    Async iterator over a blocking streaming response, pulling each chunk
+    on a worker thread.
+    """
+
+    def __init__(self, response):
+        self._chunks = iter(response)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        chunk = await asyncio.to_thread(next, self._chunks, _END)
+        if chunk is _END:
+            raise StopAsyncIteration
+        return chunk
+
+
+class LLMUnavailable(Exception):
+    """
+    Raised when Gemini is not called or did not answer in time: the circuit
+    breaker is open, the request timed out, or retries were exhausted.
+    """
+
+
+class CircuitBreaker:
+    """
+    Stops calling Gemini after ``failure_threshold`` consecutive failures.
+    After ``reset_after`` seconds one trial call is let through; its
+    outcome closes the breaker again or re-opens it.
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_after: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_after = reset_after
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.rejected = 0
+        self._trial_in_flight = False
+
+    def allow(self) -> bool:
+        if self.state == "closed":
+            return True
+        if self.state == "open" and time.monotonic() - self.opened_at >= self.reset_after:
+            self.state = "half_open"
+        if self.state == "half_open" and not self._trial_in_flight:
+            self._trial_in_flight = True
+            return True
+        self.rejected += 1
+        return False
+
+    def record_success(self):
+        self.state = "closed"
+        self.failures = 0
+        self._trial_in_flight = False
+
+    def release_trial(self):
+        """
+        Let another trial through when the last one ended without a verdict
+        (e.g. a request error that says nothing about Gemini's health).
+        """
+        self._trial_in_flight = False
+
+    def record_failure(self):
+        self.failures += 1
+        self._trial_in_flight = False
+        if self.state == "half_open" or self.failures >= self.failure_threshold:
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+
+class LLMClient:
+    """
+    App-scoped async access to Gemini shared by ChatSystem and CropPhoto.
+
+    The SDK is configured once and models are built once per name. Every
+    call goes through a global semaphore and a per-endpoint one, runs under
+    a timeout, is retried with jittered exponential backoff on rate-limit
+    and transient errors, and is short-circuited while the breaker is open.
+    """
+
+    def __init__(self, api_key: str, max_concurrency: int = 16, endpoint_limits: dict = None,
+                 timeout: float = 60.0, max_retries: int = 3, backoff_base: float = 0.5,
+                 backoff_max: float = 8.0, breaker: CircuitBreaker = None, api_endpoint: str = None):
+        # A custom endpoint (e.g. the local fake in benchmarks/) is reached over
+        # REST; the SDK has no async REST client, so those calls run on threads.
+        self.api_endpoint = api_endpoint
+        # The SDK takes most of a second to import, so it is loaded here, at
+        # startup, rather than whenever a module happens to import this one
+        import google.generativeai as genai
+        self._genai = genai
+        self.retryable_errors = retryable_errors()
+        if api_endpoint:
+            genai.configure(api_key=api_key, transport="rest", client_options={"api_endpoint": api_endpoint})
+        else:
+            genai.configure(api_key=api_key)
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.breaker = breaker or CircuitBreaker()
+        self._models = {}
+        self._global = asyncio.Semaphore(max_concurrency)
+        self.max_concurrency = max_concurrency
+        self.endpoint_limits = dict(endpoint_limits or {})
+        self._endpoints = {name: asyncio.Semaphore(limit) for name, limit in self.endpoint_limits.items()}
+        self._in_flight = {}
+        self._stats = {"calls": 0, "retries": 0, "timeouts": 0, "failures": 0, "prompt_tokens": 0, "cached_prompt_tokens": 0}
+
+    def model(self, name: str, **kwargs):
+        key = (name, tuple(sorted(kwargs.items())))
+        if key not in self._models:
+            self._models[key] = self._genai.GenerativeModel(name, **kwargs)
+        return self._models[key]
+
+    async def _call(self, model, contents, **kwargs):
+        if self.api_endpoint:
+            return await asyncio.to_thread(model.generate_content, contents, **kwargs)
+        return await model.generate_content_async(contents, **kwargs)
+
+    async def _open_stream(self, model, contents, **kwargs):
+        if self.api_endpoint:
+            return _ThreadedStream(await asyncio.to_thread(model.generate_content, contents, stream=True, **kwargs))
+        return (await model.generate_content_async(contents, stream=True, **kwargs)).__aiter__()
+
+    def _endpoint_slot(self, endpoint: str):
+        if endpoint not in self._endpoints:
+            self._endpoints[endpoint] = asyncio.Semaphore(self.max_concurrency)
+        return self._endpoints[endpoint]
+
+    def _backoff(self, attempt: int) -> float:
+        # "Full jitter": a random wait up to the exponential ceiling
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    def _record_usage(self, endpoint: str, response):
+        """
+        Export the prompt tokens Gemini reports for a call.
+        """
+        usage = getattr(response, "usage_metadata", None)
+        prompt_tokens = getattr(usage, "prompt_token_count", 0) if usage else 0
+        if not prompt_tokens:
+            return
+        cached_tokens = getattr(usage, "cached_content_token_count", 0) or 0
+        LLM_PROMPT_TOKENS.observe(prompt_tokens, endpoint=endpoint)
+        if cached_tokens:
+            LLM_CACHED_TOKENS.inc(cached_tokens, endpoint=endpoint)
+        self._stats["prompt_tokens"] += prompt_tokens
+        self._stats["cached_prompt_tokens"] += cached_tokens
+
+    def _enter(self, endpoint: str) -> bool:
+        """
+        Admit a call past the breaker; True when it holds the half-open trial.
+        """
+        if not self.breaker.allow():
+            raise LLMUnavailable("Gemini is temporarily unavailable, please try again shortly.")
+        self._stats["calls"] += 1
+        # While half-open only the trial is let through
+        return self.breaker.state == "half_open"
+
+    async def generate(self, model_name: str, contents, endpoint: str = "default", model_kwargs: dict = None, **kwargs):
+        """
+        Await one ``generate_content`` call and return the SDK response.
+        """
+        trial = self._enter(endpoint)
+        try:
+            model = self.model(model_name, **(model_kwargs or {}))
+            async with self._endpoint_slot(endpoint), self._global:
+                self._in_flight[endpoint] = self._in_flight.get(endpoint, 0) + 1
+                try:
+                    for attempt in range(self.max_retries + 1):
+                        try:
+                            with stage("llm_call"):
+                                response = await asyncio.wait_for(self._call(model, contents, **kwargs), self.timeout)
+                            self.breaker.record_success()
+                            self._record_usage(endpoint, response)
+                            return response
+                        except self.retryable_errors as e:
+                            if attempt == self.max_retries:
+                                self._fail()
+                                raise LLMUnavailable(f"Gemini call failed after {attempt + 1} attempts: {e}") from e
+                            self._stats["retries"] += 1
+                            await asyncio.sleep(self._backoff(attempt))
+                        except asyncio.TimeoutError as e:
+                            self._stats["timeouts"] += 1
+                            self._fail()
+                            raise LLMUnavailable(f"Gemini did not answer within {self.timeout}s.") from e
+                finally:
+                    self._in_flight[endpoint] -= 1
+        finally:
+            # Only the call that took the half-open trial hands it back
+            if trial:
+                self.breaker.release_trial()
+
+    async def stream(self, model_name: str, contents, endpoint: str = "default", model_kwargs: dict = None, **kwargs):
+        """
+        Async-iterate over text chunks from a streaming call. Retries only
+        happen before the first chunk; afterwards each chunk must arrive
+        within the timeout.
+        """
+        trial = self._enter(endpoint)
+        try:
+            model = self.model(model_name, **(model_kwargs or {}))
+            async with self._endpoint_slot(endpoint), self._global:
+                self._in_flight[endpoint] = self._in_flight.get(endpoint, 0) + 1
+                call_started = time.perf_counter()
+                try:
+                    for attempt in range(self.max_retries + 1):
+                        started = False
+                        try:
+                            chunks = await asyncio.wait_for(self._open_stream(model, contents, **kwargs), self.timeout)
+                            last = None
+                            while True:
+                                try:
+                                    chunk = await asyncio.wait_for(chunks.__anext__(), self.timeout)
+                                except StopAsyncIteration:
+                                    break
+                                started = True
+                                last = chunk
+                                if chunk.text:
+                                    yield chunk.text
+                            self.breaker.record_success()
+                            # The final chunk carries the usage for the whole call
+                            self._record_usage(endpoint, last)
+                            return
+                        except self.retryable_errors as e:
+                            if started or attempt == self.max_retries:
+                                self._fail()
+                                raise LLMUnavailable(f"Gemini stream failed: {e}") from e
+                            self._stats["retries"] += 1
+                            await asyncio.sleep(self._backoff(attempt))
+                        except asyncio.TimeoutError as e:
+                            self._stats["timeouts"] += 1
+                            self._fail()
+                            raise LLMUnavailable(f"Gemini did not answer within {self.timeout}s.") from e
+                finally:
+                    record_stage("llm_call", time.perf_counter() - call_started)
+                    self._in_flight[endpoint] -= 1
+        finally:
+            if trial:
+                self.breaker.release_trial()
+
+    def _fail(self):
+        self._stats["failures"] += 1
+        self.breaker.record_failure()
+
+    def stats(self):
+        stats = dict(self._stats)
+        stats.update({
+            "in_flight": dict(self._in_flight),
+            "max_concurrency": self.max_concurrency,
+            "endpoint_limits": self.endpoint_limits,
+            "breaker_state": self.breaker.state,
+            "breaker_rejected": self.breaker.rejected,
+        })
+        return stats
+
+
+def _parse_limits(value: str) -> dict:
+    """
+    Parse ``chat=8,crop=4`` into ``{"chat": 8, "crop": 4}``.
+    """
+    limits = {}
+    for item in filter(None, (part.strip() for part in value.split(","))):
+        name, _, limit = item.partition("=")
+        limits[name.strip()] = int(limit)
+    return limits
+
+
+_client = None
+
+
+def init_llm_client():
+    """
+    Create the shared Gemini client. Called once at application startup.
+    """
+    global _client
+    if _client is None:
+        load_dotenv()
+        _client = LLMClient(
+            api_key=os.getenv("gemini_api"),
+            max_concurrency=int(os.getenv("llm_max_concurrency", "16")),
+            endpoint_limits=_parse_limits(os.getenv("llm_endpoint_limits", "chat=8,weather=4,crop=4")),
+            timeout=float(os.getenv("llm_timeout", "60")),
+            max_retries=int(os.getenv("llm_max_retries", "3")),
+            breaker=CircuitBreaker(
+                failure_threshold=int(os.getenv("llm_breaker_failures", "5")),
+                reset_after=float(os.getenv("llm_breaker_reset", "30")),
+            ),
+            api_endpoint=os.getenv("gemini_api_endpoint") or None,
+        )
+    return _client
+
+
+def get_llm_client():
+    return _client if _client is not None else init_llm_client()
+
+
+def close_llm_client():
+    global _client
+    _client = None
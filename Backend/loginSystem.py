@@ -1,212 +1,299 @@
 import psycopg2  # type: ignore
-import bcrypt  # type: ignore
 from dotenv import load_dotenv  # type: ignore
-from fastapi.responses import JSONResponse
-from createConnection import create_connection
+from fastapi.responses import JSONResponse, StreamingResponse
+from createConnection import pooled_connection
+from asyncDb import run_db
+from passwordHasher import get_hasher
+from profileCache import get_profile_cache, notify_invalidation
+from sessionTokens import get_session_tokens
+import base64
+import csv
+import datetime
+import io
+import json
 import os
 
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 500
+STREAM_BATCH_SIZE = 1000
+IMPORT_FIELDS = ("email", "password", "name", "country")
+
+
+def encode_cursor(created_at, userId) -> str:
+    """
+    Opaque keyset cursor for the last row of a page.
+    """
+    raw = json.dumps([created_at.isoformat(), str(userId)])
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor: str):
+    try:
+        created_at, userId = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        return datetime.datetime.fromisoformat(created_at), userId
+    except Exception as e:
+        raise ValueError("invalid cursor") from e
+
+
+def user_json(user) -> dict:
+    """
+    Public fields of a ``(userId, email, full_name, country, ...)`` row.
+    """
+    return {"userId": str(user[0]), "email": user[1], "full_name": user[2], "country": user[3]}
+
+
+def parse_user_import(text: str, content_type: str = ""):
+    """
+    Read a bulk import: CSV with a header row, or NDJSON with one object
+    per line. Columns are email, password, name (or full_name) and
+    country. Returns ``(rows, errors)``; each row and error carries its
+    1-based ``row`` number in the upload.
+    """
+    ndjson = "json" in content_type or (not content_type.startswith("text/csv") and text.lstrip().startswith("{"))
+    if ndjson:
+        records = []
+        for number, line in enumerate(text.splitlines(), 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                record = None
+            records.append((number, record if isinstance(record, dict) else None))
+    else:
+        records = list(enumerate(csv.DictReader(io.StringIO(text)), 1))
+
+    rows, errors = [], []
+    for number, record in records:
+        if record is None:
+            errors.append({"row": number, "reason": "unreadable"})
+            continue
+        record = {str(key).strip().lower(): value for key, value in record.items() if key is not None}
+        record.setdefault("name", record.get("full_name"))
+        row = {field: str(record.get(field) or "").strip() for field in IMPORT_FIELDS}
+        if not row["email"] or not row["password"]:
+            errors.append({"row": number, "email": row["email"] or None, "reason": "email and password are required"})
+            continue
+        row["row"] = number
+        rows.append(row)
+    return rows, errors
+
+
+def profile_response(profile: dict) -> JSONResponse:
+    return JSONResponse(status_code=200, content={"success": True, "user": profile})
+
 class AuthenticationSystem:
 
-    def register(self, password: str, email: str, name: str, country: str):
+    def register(self, hashed_password: str, email: str, name: str, country: str):
+        """
+        Insert a user whose password has already been hashed.
+        """
         try:
-            conn = create_connection()
-            if conn is None:
-                return JSONResponse(status_code=500, content={"success": False, "message": "Database connection failed."})
-
-            cursor = conn.cursor()
-            cursor.execute("SELECT * FROM users WHERE email=%s", (email,))
-            existing_user = cursor.fetchone()
-            if existing_user:
-                cursor.close()
-                conn.close()
-                return JSONResponse(status_code=409, content={"success": False, "message": "User with this email already exists."})
-
-            hashed_password = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
-            cursor.execute("""
-                INSERT INTO users (email, password, full_name, country)
-                VALUES (%s, %s, %s, %s)
-            """, (email, hashed_password.decode('utf-8'), name, country))
-
-            conn.commit()
-            cursor.close()
-            conn.close()
+            with pooled_connection() as conn, conn.cursor() as cursor:
+                cursor.execute("""
+                    INSERT INTO users (email, password, full_name, country)
+                    VALUES (%s, %s, %s, %s)
+                    ON CONFLICT (email) DO NOTHING
+                    RETURNING userId
+                """, (email, hashed_password, name, country))
+                if cursor.fetchone() is None:
+                    return JSONResponse(status_code=409, content={"success": False, "message": "User with this email already exists."})
+
+                conn.commit()
             return JSONResponse(status_code=201, content={"success": True, "message": "User registered successfully."})
 
         except psycopg2.Error as e:
             print(f"Database error: {e}")
-            if conn:
-                cursor.close()
-                conn.close()
             return JSONResponse(status_code=500, content={"success": False, "message": "Try again later!"})
 
-    def login(self, email: str, password: str):
-        try:
-            conn = create_connection()
-            if conn is None:
-                return JSONResponse(status_code=500, content={"success": False, "message": "Try again later!"})
+    def _existingEmails(self, emails: list) -> set:
+        with pooled_connection() as conn, conn.cursor() as cursor:
+            cursor.execute("SELECT email FROM users WHERE email = ANY(%s)", (emails,))
+            return {email for (email,) in cursor.fetchall()}
+
+    def _copyUsers(self, rows: list, hashes: list) -> set:
+        """
+        Load hashed import rows into a staging table with COPY and insert
+        them with one set-based statement. Returns the emails created.
+        """
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for row, hashed_password in zip(rows, hashes):
+            writer.writerow((row["row"], row["email"], hashed_password, row["name"] or None, row["country"] or None))
+        buffer.seek(0)
+
+        with pooled_connection() as conn, conn.cursor() as cursor:
+            cursor.execute("""
+                CREATE TEMP TABLE users_import (
+                    row_number INTEGER,
+                    email VARCHAR(255),
+                    password TEXT,
+                    full_name VARCHAR(255),
+                    country VARCHAR(100)
+                ) ON COMMIT DROP
+            """)
+            cursor.copy_expert("COPY users_import FROM STDIN WITH (FORMAT csv)", buffer)
+            cursor.execute("""
+                INSERT INTO users (email, password, full_name, country)
+                SELECT email, password, full_name, country FROM users_import ORDER BY row_number
+                ON CONFLICT (email) DO NOTHING
+                RETURNING email
+            """)
+            created = {email for (email,) in cursor.fetchall()}
+            conn.commit()
+        return created
 
-            cursor = conn.cursor()
+    def _loginRow(self, email: str):
+        with pooled_connection() as conn, conn.cursor() as cursor:
             cursor.execute("""
-                SELECT userId, email, password, full_name, country 
-                FROM users 
+                SELECT userId, email, password, full_name, country
+                FROM users
                 WHERE email = %s
             """, (email,))
-            user = cursor.fetchone()
-
-            if user is None:
-                cursor.close()
-                conn.close()
-                return JSONResponse(status_code=401, content={"success": False, "message": "Email or password is incorrect."})
-
-            user_id, email, hashed_password, full_name, country = user
-            if not bcrypt.checkpw(password.encode('utf-8'), hashed_password.encode('utf-8')):
-                return JSONResponse(status_code=401, content={"success": False, "message": "Email or password is incorrect."})
-
-            cursor.close()
-            conn.close()
-            return JSONResponse(status_code=200, content={
-                "success": True,
-                "message": "Login successful.",
-                "user": {
-                    "userId": str(user_id),
-                    "email": email,
-                    "full_name": full_name,
-                    "country": country
-                }
-            })
-
-        except psycopg2.Error as e:
-            print(f"Database error: {e}")
-            if conn:
-                cursor.close()
-                conn.close()
-            return JSONResponse(status_code=500, content={"success": False, "message": "Try again later!"})
-
-    def updatePassword(self, userId: str, old_password: str, new_password: str):
+            return cursor.fetchone()
+
+    def loginResponse(self, user_id, email: str, full_name: str, country: str):
+        # Signed token the app sends back as "Authorization: Bearer ..." instead of a raw userId
+        access_token, expires_at = get_session_tokens().issue(str(user_id))
+        return JSONResponse(status_code=200, content={
+            "success": True,
+            "message": "Login successful.",
+            "user": {
+                "userId": str(user_id),
+                "email": email,
+                "full_name": full_name,
+                "country": country
+            },
+            "access_token": access_token,
+            "token_type": "bearer",
+            "expires_at": expires_at
+        })
+
+    def _upgradeHash(self, userId, new_hash: str, old_hash: str):
+        """
+        Store a password re-hashed with the current cost factor. Only replaces
+        the row if the hash is unchanged, so a concurrent password change wins.
+        """
         try:
-            conn = create_connection()
-            if conn is None:
-                return JSONResponse(status_code=500, content={"success": False, "message": "Try again later!"})
+            with pooled_connection() as conn, conn.cursor() as cursor:
+                cursor.execute("UPDATE users SET password = %s WHERE userId = %s AND password = %s", (new_hash, userId, old_hash))
+                conn.commit()
+            get_hasher().record_rehash()
+        except psycopg2.Error as e:
+            # The login itself succeeded; the upgrade is retried on the next one
+            print(f"Database error while upgrading password hash: {e}")
 
-            cursor = conn.cursor()
+    def _passwordHash(self, userId: str):
+        with pooled_connection() as conn, conn.cursor() as cursor:
             cursor.execute("SELECT password FROM users WHERE userId = %s", (userId,))
             user = cursor.fetchone()
+        return user[0] if user else None
 
-            if user is None:
-                cursor.close()
-                conn.close()
-                return JSONResponse(status_code=404, content={"success": False, "message": "User not found."})
-
-            hashed_password = user[0]
-            if not bcrypt.checkpw(old_password.encode('utf-8'), hashed_password.encode('utf-8')):
-                cursor.close()
-                conn.close()
-                return JSONResponse(status_code=401, content={"success": False, "message": "Old password is incorrect."})
-
-            new_hashed_password = bcrypt.hashpw(new_password.encode('utf-8'), bcrypt.gensalt())
-            cursor.execute("UPDATE users SET password = %s WHERE userId = %s", (new_hashed_password.decode('utf-8'), userId))
+    def _setPassword(self, userId: str, hashed_password: str):
+        with pooled_connection() as conn, conn.cursor() as cursor:
+            cursor.execute("UPDATE users SET password = %s WHERE userId = %s", (hashed_password, userId))
+            notify_invalidation(cursor, userId)
             conn.commit()
-            cursor.close()
-            conn.close()
-            return JSONResponse(status_code=200, content={"success": True, "message": "Password updated successfully."})
-
-        except psycopg2.Error as e:
-            print(f"Database error: {e}")
-            if conn:
-                cursor.close()
-                conn.close()
-            return JSONResponse(status_code=500, content={"success": False, "message": "Try again later!"})
+        get_profile_cache().invalidate(userId)
 
     def updatinfo(self, name: str, email: str, userId: str, country: str):
+        if not all([name, email, userId, country]):
+            return JSONResponse(status_code=400, content={"success": False, "message": "Invalid input."})
         try:
-            conn = create_connection()
-            if conn is None or not all([name, email, userId, country]):
-                if conn:
-                    conn.close()
-                return JSONResponse(status_code=400, content={"success": False, "message": "Invalid input."})
-
-            cursor = conn.cursor()
-            cursor.execute("""
-                UPDATE users 
-                SET full_name = %s, email = %s, country = %s 
-                WHERE userId = %s
-            """, (name, email, country, userId))
-            conn.commit()
-            cursor.close()
-            conn.close()
+            with pooled_connection() as conn, conn.cursor() as cursor:
+                cursor.execute("""
+                    UPDATE users
+                    SET full_name = %s, email = %s, country = %s
+                    WHERE userId = %s
+                """, (name, email, country, userId))
+                notify_invalidation(cursor, userId)
+                conn.commit()
+            get_profile_cache().invalidate(userId)
             return JSONResponse(status_code=200, content={"success": True, "message": "User information updated successfully."})
 
         except psycopg2.Error as e:
             print(f"Database error: {e}")
-            if conn:
-                cursor.close()
-                conn.close()
             return JSONResponse(status_code=500, content={"success": False, "message": "Try again later!"})
 
     def deleteUser(self, userId: str):
         try:
-            conn = create_connection()
-            if conn is None:
-                return JSONResponse(status_code=500, content={"success": False, "message": "Try again later!"})
-
-            cursor = conn.cursor()
-            cursor.execute("DELETE FROM users WHERE userId = %s", (userId,))
-            conn.commit()
-            cursor.close()
-            conn.close()
+            with pooled_connection() as conn, conn.cursor() as cursor:
+                cursor.execute("DELETE FROM users WHERE userId = %s", (userId,))
+                notify_invalidation(cursor, userId)
+                conn.commit()
+            get_profile_cache().invalidate(userId)
             return JSONResponse(status_code=200, content={"success": True, "message": "User deleted successfully."})
 
         except psycopg2.Error as e:
             print(f"Database error: {e}")
-            if conn:
-                cursor.close()
-                conn.close()
             return JSONResponse(status_code=500, content={"success": False, "message": "Try again later!"})
 
-    def getAllUsers(self):
+    def _userFilters(self, country: str = None, after=None):
+        clauses, params = [], []
+        if country:
+            clauses.append("country = %s")
+            params.append(country)
+        if after is not None:
+            clauses.append("(created_at, userId) > (%s, %s)")
+            params.extend(after)
+        return ("WHERE " + " AND ".join(clauses)) if clauses else "", params
+
+    def getAllUsers(self, limit: int = DEFAULT_PAGE_SIZE, cursor: str = None, country: str = None):
+        """
+        Return one page of users ordered by (created_at, userId). Pass the
+        returned ``next_cursor`` back to fetch the following page.
+        """
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
         try:
-            conn = create_connection()
-            if conn is None:
-                return JSONResponse(status_code=500, content={"success": False, "message": "Try again later!"})
-
-            cursor = conn.cursor()
-            cursor.execute("SELECT userId, email, full_name, country FROM users")
-            users = cursor.fetchall()
-            user_list = [{
-                "userId": str(user[0]),
-                "email": user[1],
-                "full_name": user[2],
-                "country": user[3]
-            } for user in users]
+            after = decode_cursor(cursor) if cursor else None
+        except ValueError:
+            return JSONResponse(status_code=400, content={"success": False, "message": "Invalid cursor."})
+        try:
+            users = self.userBatch(country, after, limit + 1)
 
-            cursor.close()
-            conn.close()
-            return JSONResponse(status_code=200, content={"success": True, "users": user_list})
+            has_more = len(users) > limit
+            users = users[:limit]
+            user_list = [user_json(user) for user in users]
+            next_cursor = encode_cursor(users[-1][4], users[-1][0]) if has_more else None
+
+            return JSONResponse(status_code=200, content={"success": True, "users": user_list, "next_cursor": next_cursor})
 
         except psycopg2.Error as e:
             print(f"Database error: {e}")
-            if conn:
-                cursor.close()
-                conn.close()
             return JSONResponse(status_code=500, content={"success": False, "message": "Try again later!"})
 
+    def userBatch(self, country: str = None, after=None, limit: int = DEFAULT_PAGE_SIZE):
+        """
+        Up to ``limit`` user rows ordered by (created_at, userId), starting
+        after the ``(created_at, userId)`` key ``after``.
+        """
+        where, params = self._userFilters(country, after)
+        with pooled_connection() as conn, conn.cursor() as cur:
+            cur.execute(f"""
+                SELECT userId, email, full_name, country, created_at
+                FROM users
+                {where}
+                ORDER BY created_at, userId
+                LIMIT %s
+            """, (*params, limit))
+            return cur.fetchall()
+
     def getUserById(self, userId: str):
+        """
+        Load a profile from the database and fill the profile cache with it.
+        """
+        profiles = get_profile_cache()
+        generation = profiles.generation()
         try:
-            conn = create_connection()
-            if conn is None:
-                return JSONResponse(status_code=500, content={"success": False, "message": "Try again later!"})
-
-            cursor = conn.cursor()
-            cursor.execute("""
-                SELECT userId, email, full_name, country 
-                FROM users 
-                WHERE userId = %s
-            """, (userId,))
-            user = cursor.fetchone()
+            with pooled_connection() as conn, conn.cursor() as cursor:
+                cursor.execute("""
+                    SELECT userId, email, full_name, country
+                    FROM users
+                    WHERE userId = %s
+                """, (userId,))
+                user = cursor.fetchone()
 
             if user is None:
-                cursor.close()
-                conn.close()
                 return JSONResponse(status_code=404, content={"success": False, "message": "User not found."})
 
             user_data = {
@@ -215,14 +302,142 @@ class AuthenticationSystem:
                 "full_name": user[2],
                 "country": user[3]
             }
+            profiles.set(userId, user_data, generation)
+            return profile_response(user_data)
 
-            cursor.close()
-            conn.close()
-            return JSONResponse(status_code=200, content={"success": True, "user": user_data})
+        except psycopg2.Error as e:
+            print(f"Database error: {e}")
+            return JSONResponse(status_code=500, content={"success": False, "message": "Try again later!"})
+
+
+class AsyncAuthenticationSystem:
+    """
+    Awaitable facade over AuthenticationSystem for the FastAPI handlers.
+
+    Each query runs on the bounded DB executor, so a slow one only occupies
+    one DB thread instead of stalling the event loop for every request.
+    Password hashing is awaited between queries, outside the executor.
+    """
+
+    def __init__(self, auth: AuthenticationSystem = None):
+        self.auth = auth or AuthenticationSystem()
+
+    async def register(self, password: str, email: str, name: str, country: str):
+        # Hashed on the event loop, so no DB thread or connection waits on bcrypt
+        hashed_password = await get_hasher().hash(password)
+        return await run_db(self.auth.register, hashed_password, email, name, country)
+
+    async def login(self, email: str, password: str):
+        try:
+            user = await run_db(self.auth._loginRow, email)
+            if user is None:
+                return JSONResponse(status_code=401, content={"success": False, "message": "Email or password is incorrect."})
+
+            user_id, email, hashed_password, full_name, country = user
+            hasher = get_hasher()
+            if not await hasher.verify(password, hashed_password):
+                return JSONResponse(status_code=401, content={"success": False, "message": "Email or password is incorrect."})
+
+            if hasher.needs_rehash(hashed_password):
+                new_hash = await hasher.hash(password)
+                await run_db(self.auth._upgradeHash, user_id, new_hash, hashed_password)
+            return self.auth.loginResponse(user_id, email, full_name, country)
+
+        except psycopg2.Error as e:
+            print(f"Database error: {e}")
+            return JSONResponse(status_code=500, content={"success": False, "message": "Try again later!"})
+
+    async def bulkRegister(self, rows: list, errors: list = None):
+        """
+        Register many users at once. Passwords are hashed in the background
+        of interactive traffic, then the rows are COPY-loaded and inserted
+        in one statement. Emails already taken (or repeated within the
+        upload) are reported per row rather than failing the import.
+        """
+        errors = list(errors or [])
+        conflicts, first_rows = [], {}
+        for row in rows:
+            if row["email"] in first_rows:
+                conflicts.append({"row": row["row"], "email": row["email"], "reason": "duplicate in upload",
+                                  "first_row": first_rows[row["email"]]})
+            else:
+                first_rows[row["email"]] = row["row"]
+        unique = [row for row in rows if first_rows[row["email"]] == row["row"]]
+        try:
+            # Emails that already exist are not worth a bcrypt hash
+            existing = await run_db(self.auth._existingEmails, [row["email"] for row in unique])
+            fresh = [row for row in unique if row["email"] not in existing]
+            # Hashed before borrowing a connection so the pool is not held during bcrypt
+            hashes = await get_hasher().hash_many([row["password"] for row in fresh])
+            created = await run_db(self.auth._copyUsers, fresh, hashes) if fresh else set()
+        except psycopg2.Error as e:
+            print(f"Database error: {e}")
+            return JSONResponse(status_code=500, content={"success": False, "message": "Try again later!"})
+
+        conflicts.extend({"row": row["row"], "email": row["email"], "reason": "email already registered"}
+                         for row in unique if row["email"] not in created)
+        conflicts.sort(key=lambda conflict: conflict["row"])
+        return JSONResponse(status_code=200, content={
+            "success": True,
+            "received": len(rows) + len(errors),
+            "created": len(created),
+            "conflicts": conflicts,
+            "errors": errors,
+        })
+
+    async def updatePassword(self, userId: str, old_password: str, new_password: str):
+        try:
+            hashed_password = await run_db(self.auth._passwordHash, userId)
+            if hashed_password is None:
+                return JSONResponse(status_code=404, content={"success": False, "message": "User not found."})
+
+            hasher = get_hasher()
+            if not await hasher.verify(old_password, hashed_password):
+                return JSONResponse(status_code=401, content={"success": False, "message": "Old password is incorrect."})
+
+            new_hashed_password = await hasher.hash(new_password)
+            await run_db(self.auth._setPassword, userId, new_hashed_password)
+            return JSONResponse(status_code=200, content={"success": True, "message": "Password updated successfully."})
 
         except psycopg2.Error as e:
             print(f"Database error: {e}")
-            if conn:
-                cursor.close()
-                conn.close()
             return JSONResponse(status_code=500, content={"success": False, "message": "Try again later!"})
+
+    async def updatinfo(self, name: str, email: str, userId: str, country: str):
+        return await run_db(self.auth.updatinfo, name, email, userId, country)
+
+    async def deleteUser(self, userId: str):
+        return await run_db(self.auth.deleteUser, userId)
+
+    async def getAllUsers(self, limit: int = DEFAULT_PAGE_SIZE, cursor: str = None, country: str = None):
+        return await run_db(self.auth.getAllUsers, limit, cursor, country)
+
+    def streamAllUsers(self, country: str = None):
+        """
+        Stream every user as NDJSON. Each batch is a short keyset query on
+        the DB executor, so no pool connection is held while the client
+        reads and memory stays flat no matter how large the table is.
+        """
+        async def rows():
+            after = None
+            while True:
+                try:
+                    users = await run_db(self.auth.userBatch, country, after, STREAM_BATCH_SIZE)
+                except psycopg2.Error as e:
+                    print(f"Database error: {e}")
+                    yield json.dumps({"success": False, "message": "Try again later!"}) + "\n"
+                    return
+                for user in users:
+                    yield json.dumps(user_json(user)) + "\n"
+                if len(users) < STREAM_BATCH_SIZE:
+                    return
+                after = (users[-1][4], users[-1][0])
+
+        return StreamingResponse(rows(), media_type="application/x-ndjson")
+
+    async def getUserById(self, userId: str):
+        # Cached profiles are answered without leaving the event loop
+        profile = get_profile_cache().get(userId)
+        if profile is not None:
+            return profile_response(profile)
+        return await run_db(self.auth.getUserById, userId)
@@ -3,14 +3,91 @@
 # fast api login
 from fastapi import FastAPI, HTTPException # type: ignore
 from fastapi.middleware.cors import CORSMiddleware # type: ignore
-from loginSystem import AuthenticationSystem
-from chatSystem import ChatSystem
-from fastapi import FastAPI, File, UploadFile, Form
+from loginSystem import AsyncAuthenticationSystem, parse_user_import
+import chatSystem
+from fastapi import FastAPI, File, UploadFile, Form, Request, Header
+from fastapi.responses import JSONResponse, StreamingResponse, PlainTextResponse
+import hmac
+import json
 import os
-import shutil
-from crop_photo import CropPhoto # Assuming this is the correct import path for your CropPhoto class
-app = FastAPI()
-# CORS configuration
+import re
+import asyncio
+import time
+import crop_photo as crop_photo_module
+from contextlib import asynccontextmanager
+from createConnection import init_pool, close_pool, get_pool
+from asyncDb import init_db_executor, close_db_executor, get_db_executor
+from passwordHasher import init_hasher, close_hasher, get_hasher
+from llmClient import init_llm_client, close_llm_client, get_llm_client, LLMUnavailable
+from imagePreprocess import init_preprocessor, close_preprocessor, get_preprocessor
+from cropClassifier import init_classifier, close_classifier, get_classifier
+from cropJobs import runner_from_env
+from uploadIngest import UploadLimitMiddleware, UploadTooLarge, ingest_upload, ingest_stream, persist_upload
+from metrics import REGISTRY, MetricsMiddleware
+from rateLimit import RateLimitMiddleware, rate_limit_options_from_env
+from sessionTokens import TokenError, bearer_token, get_session_tokens
+from profileCache import get_profile_cache, start_profile_listener, stop_profile_listener
+from weatherAdvisory import advisories_from_env, read_forecast
+from diagnosisHistory import DiagnosisHistory, retention_from_env
+from profiler import ProfilerMiddleware, get_profiler, close_profiler
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Shared resources live as long as the app: opened at startup, released at
+    # shutdown. Under a preforking server this runs in each worker after the
+    # fork, so no connection, thread or SQLite handle is shared between them.
+    global ChatSystem, crop_photo, crop_jobs, weather_advisories
+    # The slow, independent pieces (connecting, bcrypt calibration, loading
+    # the Gemini SDK) start side by side
+    await asyncio.gather(
+        asyncio.to_thread(init_pool),
+        asyncio.to_thread(init_hasher),
+        asyncio.to_thread(init_llm_client),
+    )
+    start_profile_listener()
+    init_db_executor()
+    init_preprocessor()
+    init_classifier()
+    ChatSystem = chatSystem.ChatSystem()
+    weather_advisories = advisories_from_env(ChatSystem.model_name)
+    crop_photo = crop_photo_module.CropPhoto()
+    crop_jobs = runner_from_env(crop_photo, on_done=record_crop_job)
+    crop_jobs.start()
+    upload_retention.start()
+    yield
+    await upload_retention.stop()
+    await crop_jobs.stop()
+    await close_classifier()
+    close_preprocessor()
+    close_llm_client()
+    close_hasher()
+    close_db_executor()
+    stop_profile_listener()
+    close_pool()
+    close_profiler()
+
+
+app = FastAPI(lifespan=lifespan)
+MAX_UPLOAD_BYTES = int(os.getenv("crop_max_upload_bytes", str(15 * 1024 * 1024)))
+PERSIST_UPLOADS = os.getenv("crop_persist_uploads", "true").lower() in ("1", "true", "yes")
+BATCH_MAX_IMAGES = int(os.getenv("crop_batch_max_images", "50"))
+BATCH_GROUP_SIZE = int(os.getenv("crop_batch_group_size", "4"))
+IMPORT_MAX_ROWS = int(os.getenv("user_import_max_rows", "10000"))
+# Once every app version sends tokens, raw userId parameters can be refused
+REQUIRE_SESSION_TOKEN = os.getenv("require_session_token", "false").lower() in ("1", "true", "yes")
+# Operator secret for admin-only endpoints such as /users/import; unset disables them
+ADMIN_TOKEN = os.getenv("admin_token") or None
+# Oversized bodies are refused before they are spooled; the slack covers multipart framing
+app.add_middleware(UploadLimitMiddleware, limits={
+    "/crop": MAX_UPLOAD_BYTES + 64 * 1024,
+    "/crop/batch": int(os.getenv("crop_batch_max_request_bytes", str(100 * 1024 * 1024))),
+    "/users/import": int(os.getenv("user_import_max_bytes", str(10 * 1024 * 1024))),
+})
+# Throttled or shed requests are answered with 429 before their body is read
+if os.getenv("rate_limit_enabled", "true").lower() in ("1", "true", "yes"):
+    app.add_middleware(RateLimitMiddleware, **rate_limit_options_from_env())
+# CORS configuration, outside the limiters so browsers can read their 413s and 429s
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],  # Allow all origins for development; adjust in production
@@ -18,18 +95,243 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# Inside the metrics middleware, so profiles see the request's stage timings
+app.add_middleware(ProfilerMiddleware)
+# Outermost, so rejected uploads and errors are counted too
+app.add_middleware(MetricsMiddleware)
 # Initialize the login system
-login_system = AuthenticationSystem()
+login_system = AsyncAuthenticationSystem()
 UPLOAD_DIR = "uploads"
 os.makedirs(UPLOAD_DIR, exist_ok=True)
-ChatSystem = ChatSystem()
+diagnosis_history = DiagnosisHistory()
+upload_retention = retention_from_env(UPLOAD_DIR)
+# Built in lifespan
+ChatSystem = None
+crop_photo = None
+crop_jobs = None
+weather_advisories = None
+REGISTRY.register_stats("db_pool", lambda: get_pool().stats())
+REGISTRY.register_stats("db_executor", lambda: get_db_executor().stats())
+REGISTRY.register_stats("password_hasher", lambda: get_hasher().stats())
+REGISTRY.register_stats("profile_cache", lambda: get_profile_cache().stats())
+REGISTRY.register_stats("chat_cache", lambda: ChatSystem.cache.stats())
+REGISTRY.register_stats("chat_stream", lambda: ChatSystem.stream_stats)
+REGISTRY.register_stats("chat_memory", lambda: ChatSystem.memory.stats)
+REGISTRY.register_stats("weather_advisories", lambda: weather_advisories.stats())
+REGISTRY.register_stats("llm", lambda: get_llm_client().stats())
+REGISTRY.register_stats("crop_index", lambda: crop_photo.index.stats())
+REGISTRY.register_stats("image_preprocess", lambda: get_preprocessor().stats())
+REGISTRY.register_stats("crop_classifier", lambda: get_classifier().stats() if get_classifier() else {})
+REGISTRY.register_stats("diagnosis_history", diagnosis_history.stats)
+REGISTRY.register_stats("upload_retention", upload_retention.stats)
+REGISTRY.register_stats("crop_jobs", lambda: crop_jobs.queue.stats())
+REGISTRY.register_stats("profiler", lambda: get_profiler().stats())
+
+
+def upload_extension(filename):
+    """
+    Keep a short, safe extension from the client's filename (default .jpg).
+    """
+    ext = os.path.splitext(filename or "")[1].lower()
+    return ext if re.fullmatch(r"\.[a-z0-9]{1,5}", ext) else ".jpg"
+
+
+def upload_path(digest, filename):
+    return os.path.join(UPLOAD_DIR, digest + upload_extension(filename))
+
+
+def record_crop_job(user_id, digest, image_path, response, seconds):
+    """
+    Add a finished /crop/jobs analysis to the submitting user's history.
+    """
+    diagnosis_history.record_response(user_id, digest, image_path, response, crop_photo.model_name, seconds)
+
+
+async def read_crop_upload(request: Request, image: UploadFile = None):
+    """
+    Read a /crop style upload: a multipart "image" field or the raw body.
+    Returns the ingested upload and the client's filename (if any).
+    """
+    if image is not None:
+        return await ingest_upload(image, MAX_UPLOAD_BYTES), image.filename
+    return await ingest_stream(request.stream(), MAX_UPLOAD_BYTES), None
+
+
+def resolve_user(userId, authorization, require_token=False):
+    """
+    The user a request acts on: the subject of a valid bearer token, or
+    the raw userId parameter from app versions that predate tokens unless
+    require_token (or require_session_token) is set.
+    Returns ``(user_id, None)`` or ``(None, error_response)``.
+    """
+    token = bearer_token(authorization)
+    if token is None:
+        if require_token or REQUIRE_SESSION_TOKEN or not userId:
+            return None, JSONResponse(status_code=401, content={"success": False, "message": "Missing access token."})
+        return userId, None
+    try:
+        token_user = get_session_tokens().verify(token)
+    except TokenError as e:
+        return None, JSONResponse(status_code=401, content={"success": False, "message": str(e)})
+    if userId and userId != token_user:
+        return None, JSONResponse(status_code=403, content={"success": False, "message": "Token does not belong to this user."})
+    return token_user, None
+
+
+def history_user(userId, authorization):
+    """
+    The token-verified user an upload's diagnosis is filed under, or None
+    (recorded anonymously) without a valid bearer token.
+    """
+    user_id, error = resolve_user(userId, authorization, require_token=True)
+    return None if error else user_id
+
+
+def check_admin_token(token):
+    """
+    Admin-only endpoints answer 403 unless X-Admin-Token matches admin_token.
+    """
+    if not ADMIN_TOKEN or not token or not hmac.compare_digest(token.encode("utf-8"), ADMIN_TOKEN.encode("utf-8")):
+        return JSONResponse(status_code=403, content={"success": False, "message": "Admin token required."})
+    return None
+
+
+@app.get("/healthz")
+async def healthz():
+    """
+    Liveness probe: answers as soon as startup has finished, without
+    touching the database or Gemini.
+    """
+    return {"status": "ok"}
+
+
+@app.get("/stats")
+async def stats():
+    """
+    Endpoint for inspecting runtime statistics of the shared subsystems.
+    """
+    return {
+        "db_pool": get_pool().stats(),
+        "db_executor": get_db_executor().stats(),
+        "password_hasher": get_hasher().stats(),
+        "profile_cache": get_profile_cache().stats(),
+        "chat_cache": ChatSystem.cache.stats(),
+        "chat_stream": ChatSystem.stream_stats,
+        "chat_memory": ChatSystem.memory.stats,
+        "weather_advisories": weather_advisories.stats(),
+        "llm": get_llm_client().stats(),
+        "crop_index": crop_photo.index.stats(),
+        "image_preprocess": get_preprocessor().stats(),
+        "crop_classifier": get_classifier().stats() if get_classifier() else None,
+        "crop_jobs": await asyncio.to_thread(crop_jobs.queue.stats),
+        "diagnosis_history": diagnosis_history.stats(),
+        "upload_retention": upload_retention.stats(),
+        "profiler": get_profiler().stats(),
+    }
+
+
+@app.get("/metrics")
+async def metrics():
+    """
+    Endpoint for Prometheus scraping: per-route latency, status counts,
+    in-flight requests, per-stage timings and the /stats gauges.
+    """
+    body = await asyncio.to_thread(REGISTRY.render)
+    return PlainTextResponse(body, media_type="text/plain; version=0.0.4")
+
+
+def check_profiler_token(token):
+    """
+    The admin profiler endpoints exist only when profiler_token is set.
+    """
+    profiler = get_profiler()
+    if not profiler.token:
+        return JSONResponse(status_code=404, content={"detail": "Not Found"})
+    if not profiler.check_token(token):
+        return JSONResponse(status_code=403, content={"success": False, "message": "Invalid profiler token."})
+    return None
+
+
+@app.get("/admin/profiler")
+async def profiler_status(x_profiler_token: str = Header(None)):
+    """
+    Endpoint for the profiler settings and the captures in its ring buffer.
+    """
+    error = check_profiler_token(x_profiler_token)
+    if error:
+        return error
+    profiler = get_profiler()
+    return {
+        "success": True,
+        "settings": profiler.stats(),
+        "captures": [profile.summary() for profile in reversed(profiler.captures)],
+    }
+
+
+@app.post("/admin/profiler")
+async def configure_profiler(x_profiler_token: str = Header(None), slow_ms: float = None,
+                             profile_next: int = None, route: str = None):
+    """
+    Endpoint for changing the profiler at runtime: slow_ms sets the
+    slow-request threshold (0 turns capture off), profile_next samples the
+    next N requests, optionally only those whose path starts with route.
+    Settings apply to this worker process only.
+    """
+    error = check_profiler_token(x_profiler_token)
+    if error:
+        return error
+    profiler = get_profiler()
+    profiler.configure(slow_ms, profile_next, route)
+    return {"success": True, "settings": profiler.stats()}
+
+
+@app.delete("/admin/profiler/captures")
+async def clear_profiles(x_profiler_token: str = Header(None)):
+    """
+    Endpoint for emptying the capture ring buffer.
+    """
+    error = check_profiler_token(x_profiler_token)
+    if error:
+        return error
+    get_profiler().clear()
+    return {"success": True}
+
+
+@app.get("/admin/profiler/folded")
+async def merged_profile(x_profiler_token: str = Header(None), route: str = None, kind: str = None):
+    """
+    Endpoint for all captures (optionally of one route template or kind)
+    merged into folded stacks, for flamegraph.pl, speedscope or inferno.
+    """
+    error = check_profiler_token(x_profiler_token)
+    if error:
+        return error
+    return PlainTextResponse(get_profiler().folded(route, kind))
+
+
+@app.get("/admin/profiler/captures/{capture_id}")
+async def get_profile(capture_id: str, x_profiler_token: str = Header(None), format: str = "json"):
+    """
+    Endpoint for one capture: its summary and stacks as JSON, or with
+    format=folded the stacks alone as a flamegraph-ready download.
+    """
+    error = check_profiler_token(x_profiler_token)
+    if error:
+        return error
+    profile = get_profiler().capture(capture_id)
+    if profile is None:
+        return JSONResponse(status_code=404, content={"success": False, "message": "Capture not found."})
+    if format == "folded":
+        return PlainTextResponse(profile.folded(), headers={
+            "Content-Disposition": f'attachment; filename="profile-{profile.id}.folded"'})
+    return {"success": True, **profile.summary(), "stacks": profile.stacks}
 @app.post("/login")
 async def login(email: str, password: str):
     """
     Endpoint for user login.
     """
     try:
-        response = login_system.login(email, password)
+        response = await login_system.login(email, password)
         return response
     except Exception as e:
         return HTTPException(status_code=500, detail=str(e))
@@ -40,22 +342,49 @@ async def register(email: str, password: str, name: str, country: str):
     """
     try:
         print(f"Registering user: {email}, Name: {name}, Country: {country}")
-        response = login_system.register(password, email, name, country)
+        response = await login_system.register(password, email, name, country)
         return response
     except Exception as e:
         return HTTPException(status_code=500, detail=str(e))
+@app.post("/users/import")
+async def import_users(request: Request, x_admin_token: str = Header(None)):
+    """
+    Endpoint for registering many users at once, e.g. a cooperative's
+    members. Requires the X-Admin-Token header. The body is CSV with a
+    header row (email,password,name,country) or NDJSON with one such
+    object per line. The response lists the rows that were not created and why.
+    """
+    error = check_admin_token(x_admin_token)
+    if error:
+        return error
+    try:
+        text = (await request.body()).decode("utf-8-sig")
+    except UnicodeDecodeError:
+        return JSONResponse(status_code=400, content={"success": False, "message": "The upload must be UTF-8 text."})
+    rows, errors = parse_user_import(text, request.headers.get("content-type", "").lower())
+    if len(rows) + len(errors) > IMPORT_MAX_ROWS:
+        return JSONResponse(status_code=413, content={"success": False, "message": f"At most {IMPORT_MAX_ROWS} rows per import."})
+    if not rows and not errors:
+        return JSONResponse(status_code=400, content={"success": False, "message": "No rows to import."})
+    try:
+        return await login_system.bulkRegister(rows, errors)
+    except Exception as e:
+        return HTTPException(status_code=500, detail=str(e))
 @app.put("/updateInfo")
-async def update_info(email: str, name: str, country: str, userId: str):
+async def update_info(email: str, name: str, country: str, userId: str = None, authorization: str = Header(None)):
     """
     Endpoint for updating user information.
     """
+    userId, error = resolve_user(userId, authorization)
+    if error:
+        return error
     try:
-        response = login_system.updatinfo(name, email, userId,country)
+        response = await login_system.updatinfo(name, email, userId,country)
         return response
     except Exception as e:
         return HTTPException(status_code=500, detail=str(e))
 @app.put("/updatePassword")
-async def update_password(userId: str, old_password: str, new_password: str):
+async def update_password(old_password: str, new_password: str, userId: str = None, authorization: str = Header(None)):
     """_summary_
 
     Args:
@@ -63,76 +392,306 @@ async def update_password(userId: str, old_password: str, new_password: str):
         old_password (str): _description_
         new_password (str): _description_
     """
+    userId, error = resolve_user(userId, authorization)
+    if error:
+        return error
     try:
-        response = login_system.updatePassword(userId, old_password, new_password)
+        response = await login_system.updatePassword(userId, old_password, new_password)
         return response
     except Exception as e:
         return HTTPException(status_code=500, detail=str(e))
 @app.delete("/deleteUser")
-async def delete_user(userId: str):
+async def delete_user(userId: str = None, authorization: str = Header(None)):
     """
     Endpoint for deleting a user.
     """
+    userId, error = resolve_user(userId, authorization)
+    if error:
+        return error
     try:
-        response = login_system.deleteUser(userId)
+        response = await login_system.deleteUser(userId)
         return response
     except Exception as e:
         return HTTPException(status_code=500, detail=str(e))
 @app.get("/getUserInfo")
-async def get_user_info(userId: str):
+async def get_user_info(userId: str = None, authorization: str = Header(None)):
     """
     Endpoint for retrieving user information.
+    Pass the access token from /login as "Authorization: Bearer <token>";
+    profiles are served from an in-process cache.
     """
+    userId, error = resolve_user(userId, authorization)
+    if error:
+        return error
     try:
-        response = login_system.getUserById(userId)
+        response = await login_system.getUserById(userId)
         return response
     except Exception as e:
         return HTTPException(status_code=500, detail=str(e))
 @app.get("/getAllUsers")
-async def get_all_users():
+async def get_all_users(limit: int = 100, cursor: str = None, country: str = None, stream: bool = False,
+                        x_admin_token: str = Header(None)):
     """
-    Endpoint for retrieving all users.
+    Admin endpoint for retrieving users, one keyset page at a time.
+    With stream=true every matching user is sent as NDJSON instead.
     """
+    error = check_admin_token(x_admin_token)
+    if error:
+        return error
     try:
-        response = login_system.getAllUsers()
+        if stream:
+            return login_system.streamAllUsers(country)
+        response = await login_system.getAllUsers(limit, cursor, country)
         return response
     except Exception as e:
         return HTTPException(status_code=500, detail=str(e))
     
 # chat system
 
+@app.delete("/chat/session")
+async def clear_chat_session(user_id: str = None, authorization: str = Header(None)):
+    """
+    Endpoint for forgetting a user's server-side conversation history.
+    Needs the user's bearer token.
+    """
+    user_id, error = resolve_user(user_id, authorization, require_token=True)
+    if error:
+        return error
+    try:
+        await ChatSystem.memory.clear(user_id)
+        return {"success": True, "message": "Conversation cleared."}
+    except Exception as e:
+        return HTTPException(status_code=500, detail=str(e))
+
 @app.get("/weather-discription")
-async def weather_description(user_input: str):
+async def weather_description(user_input: str = "", region: str = None, temperature: float = None,
+                              rain: float = None, humidity: float = None):
     """
     Endpoint for getting weather-related advice.
+    A structured forecast (region, temperature in °C, rain in mm, humidity
+    in %), given as parameters or as a JSON user_input, is answered from
+    the precomputed regional advisories; anything else is sent to the
+    model as free text.
     """
+    payload = {"region": region, "temperature": temperature, "rain": rain, "humidity": humidity}
+    if region is None and user_input.lstrip().startswith("{"):
+        try:
+            payload = json.loads(user_input)
+        except ValueError:
+            payload = {}
     try:
-        response = ChatSystem.weather(user_input)
+        read_forecast(payload)
+        structured = True
+    except (AttributeError, TypeError, ValueError):
+        structured = False  # not a structured forecast
+    if structured:
+        try:
+            advice, source = await weather_advisories.advise(payload)
+            return JSONResponse(content={"status": "success", "message": advice}, status_code=200,
+                                headers={"X-Advisory-Source": source})
+        except LLMUnavailable as e:
+            return JSONResponse(content={"status": "error", "message": str(e)}, status_code=503)
+        except Exception as e:
+            return JSONResponse(content={"status": "error", "message": str(e)}, status_code=500)
+    if not user_input.strip():
+        return JSONResponse(content={"status": "error", "message": "Send a forecast or a question."}, status_code=400)
+    try:
+        response = await ChatSystem.weather(user_input)
         return response
     except Exception as e:
         return HTTPException(status_code=500, detail=str(e))
+
+
+@app.post("/weather-advisories/batch")
+async def weather_advisories_batch(request: Request, refresh: bool = False):
+    """
+    Endpoint for precomputing advisories from a JSON list of forecasts,
+    e.g. posted by a scheduler whenever the forecast data is updated.
+    Only buckets without stored advice (all of them with refresh=true)
+    are sent to the model.
+    """
+    try:
+        payloads = await request.json()
+    except ValueError:
+        return JSONResponse(status_code=400, content={"success": False, "message": "Body must be a JSON list of forecasts."})
+    if isinstance(payloads, dict):
+        payloads = payloads.get("forecasts")
+    if not isinstance(payloads, list):
+        return JSONResponse(status_code=400, content={"success": False, "message": "Body must be a JSON list of forecasts."})
+    try:
+        return {"success": True, **await weather_advisories.generate_batch(payloads, refresh)}
+    except Exception as e:
+        return JSONResponse(status_code=500, content={"success": False, "message": str(e)})
+
+
 @app.post("/chat")
-async def chat(user_input: str, user_history: str = ""):
+async def chat(user_input: str, user_history: str = "", stream: bool = False, format: str = "sse", user_id: str = None,
+               authorization: str = Header(None)):
     """
     Endpoint for chatting with the AgriBuddy system.
+    With a bearer token the conversation history is kept on the server and
+    user_history is ignored; a user_id without a token is refused. With stream=true the answer is
+    sent as it is generated, as Server-Sent Events (format=sse) or NDJSON
+    (format=ndjson).
     """
+    if user_id or authorization:
+        user_id, error = resolve_user(user_id, authorization, require_token=True)
+        if error:
+            return error
     try:
-        response = ChatSystem.chat(user_input, user_history)
+        if stream:
+            return await ChatSystem.chat_stream(user_input, user_history, format, user_id)
+        response = await ChatSystem.chat(user_input, user_history, user_id)
      
         return response
     except Exception as e:
         return HTTPException(status_code=500, detail=str(e))
 @app.post("/crop")
-async def crop(image: UploadFile = File(...) ):
+async def crop(request: Request, image: UploadFile = File(None), userId: str = None, authorization: str = Header(None)):
     """
     Endpoint for analyzing crop images.
+    Accepts a multipart "image" field, or the raw image bytes as the request
+    body (e.g. Content-Type: image/jpeg), which is streamed without buffering
+    to a temp file first. With a bearer token the diagnosis is added to
+    the user's history.
     """
     try:
-        file_path = os.path.join(UPLOAD_DIR, image.filename)
-        with open(file_path, "wb") as buffer:
-            shutil.copyfileobj(image.file, buffer)
-        crop_photo = CropPhoto(file_path)
-        response = crop_photo.crop()
+        upload, filename = await read_crop_upload(request, image)
+        if not upload.size:
+            return JSONResponse(status_code=400, content={"crop_name": "unknown", "description": "No image was uploaded."})
+
+        persisting = None
+        file_path = None
+        if PERSIST_UPLOADS:
+            # Stored under the content hash: re-uploads dedupe and same-named files no longer collide
+            file_path = upload_path(upload.digest, filename)
+            persisting = asyncio.create_task(persist_upload(file_path, upload.data))
+        try:
+            # The in-memory bytes go straight to preprocessing; the disk copy is written alongside
+            started = time.perf_counter()
+            response = await crop_photo.diagnose(upload.data, upload.digest)
+            seconds = time.perf_counter() - started
+            if persisting is not None:
+                try:
+                    await persisting
+                except OSError as e:
+                    # The stored copy is a convenience; the diagnosis is still answered
+                    print(f"Could not store upload {file_path}: {e}")
+                    file_path = None
+        finally:
+            if persisting is not None and not persisting.done():
+                persisting.cancel()
+        # Filed only once the write has settled, so history never points at a missing image
+        diagnosis_history.record_response(history_user(userId, authorization), upload.digest, file_path, response,
+                                          crop_photo.model_name, seconds)
         return response
+    except UploadTooLarge as e:
+        return JSONResponse(status_code=413, content={"crop_name": "unknown", "description": e.detail})
+    except Exception as e:
+        return HTTPException(status_code=500, detail=str(e))
+@app.post("/crop/batch")
+async def crop_batch(images: list[UploadFile] = File(...), userId: str = None, authorization: str = Header(None)):
+    """
+    Endpoint for analyzing many crop images in one request.
+    Streams one NDJSON line per image as soon as its diagnosis is ready:
+    the usual crop_name/growth_stage/health_status/recommendations fields
+    plus "index" (position in the upload) and "filename".
+    """
+    if len(images) > BATCH_MAX_IMAGES:
+        return JSONResponse(status_code=413, content={"success": False, "message": f"At most {BATCH_MAX_IMAGES} images per batch."})
+    try:
+        # Uploads are read before streaming starts; FastAPI closes them once the handler returns
+        uploads = [await ingest_upload(image, MAX_UPLOAD_BYTES) for image in images]
+    except UploadTooLarge as e:
+        return JSONResponse(status_code=413, content={"success": False, "message": e.detail})
+    filenames = [image.filename for image in images]
+    user_id = history_user(userId, authorization)
+
+    if PERSIST_UPLOADS:
+        # The same photo twice in one batch is written once
+        to_persist = {}
+        for upload, filename in zip(uploads, filenames):
+            to_persist.setdefault(upload_path(upload.digest, filename), upload.data)
+        try:
+            await asyncio.gather(*(persist_upload(path, data) for path, data in to_persist.items()))
+        except OSError as e:
+            return JSONResponse(status_code=500, content={"success": False, "message": f"Could not store the uploads: {e}"})
+
+    async def results():
+        started = time.perf_counter()
+        async for index, cache, data in crop_photo.diagnose_batch(
+            [(upload.data, upload.digest) for upload in uploads], BATCH_GROUP_SIZE
+        ):
+            if isinstance(data, dict) and data.get("crop_name") != "unknown":
+                upload = uploads[index]
+                diagnosis_history.record(
+                    user_id, upload.digest, upload_path(upload.digest, filenames[index]) if PERSIST_UPLOADS else None,
+                    data, "local" if data.get("source") == "local" else crop_photo.model_name, cache,
+                    time.perf_counter() - started,
+                )
+            line = {"index": index, "filename": filenames[index], "cache": cache}
+            line.update(data if isinstance(data, dict) else {"crop_name": "unknown", "raw_response": data})
+            yield json.dumps(line) + "\n"
+
+    return StreamingResponse(results(), media_type="application/x-ndjson")
+@app.post("/crop/jobs", status_code=202)
+async def submit_crop_job(request: Request, image: UploadFile = File(None), userId: str = None,
+                          authorization: str = Header(None)):
+    """
+    Endpoint for queueing a crop analysis. Takes the same upload as /crop
+    and returns a job id at once; fetch the result from /crop/jobs/{job_id}.
+    With a bearer token the finished diagnosis is added to the user's
+    history.
+    """
+    try:
+        upload, filename = await read_crop_upload(request, image)
+        if not upload.size:
+            return JSONResponse(status_code=400, content={"success": False, "message": "No image was uploaded."})
+        # Workers read the image back from disk, so jobs always persist it
+        file_path = upload_path(upload.digest, filename)
+        await persist_upload(file_path, upload.data)
+        user_id = history_user(userId, authorization)
+        job_id = await crop_jobs.submit(file_path, upload.digest, user_id)
+        return {"success": True, "job_id": job_id, "status": "queued"}
+    except UploadTooLarge as e:
+        return JSONResponse(status_code=413, content={"success": False, "message": e.detail})
+    except Exception as e:
+        return HTTPException(status_code=500, detail=str(e))
+@app.get("/diagnoses")
+async def list_diagnoses(userId: str = None, authorization: str = Header(None), limit: int = 20, cursor: str = None):
+    """
+    Endpoint for a user's diagnosis history, newest first.
+    Needs the user's bearer token. Pass the returned next_cursor back as
+    cursor for the next page.
+    """
+    userId, error = resolve_user(userId, authorization, require_token=True)
+    if error:
+        return error
+    try:
+        return {"success": True, **await diagnosis_history.for_user(userId, limit, cursor)}
+    except ValueError:
+        return JSONResponse(status_code=400, content={"success": False, "message": "Invalid cursor."})
+    except Exception as e:
+        return HTTPException(status_code=500, detail=str(e))
+@app.get("/diagnoses/outbreaks")
+async def diagnosis_outbreaks(country: str, days: float = 14, crop: str = None):
+    """
+    Endpoint for crop problems reported in a country over the last days
+    (at most 365), most reported first.
+    """
+    try:
+        days = min(max(days, 0), 365)
+        outbreaks = await diagnosis_history.outbreaks(country, days, crop)
+        return {"success": True, "country": country, "days": days, "outbreaks": outbreaks}
     except Exception as e:
-        return HTTPException(status_code=500, detail=str(e))
\ No newline at end of file
+        return HTTPException(status_code=500, detail=str(e))
+@app.get("/crop/jobs/{job_id}")
+async def get_crop_job(job_id: str, wait: float = 0):
+    """
+    Endpoint for fetching a queued crop analysis. With wait > 0 (seconds,
+    at most 30) the request long-polls until the job finishes.
+    """
+    job = await crop_jobs.get(job_id, min(max(wait, 0), 30))
+    if job is None:
+        return JSONResponse(status_code=404, content={"success": False, "message": "Job not found."})
+    return {"success": True, **job}
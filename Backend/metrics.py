@@ -0,0 +1,231 @@
+from bisect import bisect_left
+from contextlib import contextmanager
+import contextvars
+import threading
+import time
+
+PREFIX = "smartfarmer_"
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+TOKEN_BUCKETS = (50, 100, 250, 500, 1000, 2000, 4000, 8000, 16000, 32000)
+
+# Stage timings of the request being served, e.g. [("db_query", 0.004), ...]
+request_stages = contextvars.ContextVar("request_stages", default=None)
+# The profiler.RequestProfile of the request being served, when it is profiled
+active_profile = contextvars.ContextVar("active_profile", default=None)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs.extend(f'{name}="{_escape(value)}"' for name, value in extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labelnames=()):
+        self.name = PREFIX + name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(labels.get(name, "") for name in self.labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in items:
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {value}")
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = [(key, (list(counts), total, count)) for key, (counts, total, count) in self._values.items()]
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, [('le', le)])} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def register_stats(self, subsystem: str, stats_fn):
+        """
+        Expose the numeric values of a subsystem's ``stats()`` dict as gauges,
+        read at scrape time.
+        """
+        self._collectors.append((subsystem, stats_fn))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for subsystem, stats_fn in self._collectors:
+            try:
+                stats = stats_fn()
+            except Exception as e:
+                print(f"Could not collect {subsystem} stats: {e}")
+                continue
+            for key, value in _flatten(stats):
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    continue
+                name = f"{PREFIX}{subsystem}_{key}"
+                lines.append(f"# TYPE {name} gauge")
+                lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def _flatten(stats, prefix=""):
+    for key, value in stats.items():
+        if isinstance(value, dict):
+            yield from _flatten(value, f"{prefix}{key}_")
+        else:
+            yield f"{prefix}{key}", value
+
+
+REGISTRY = Registry()
+
+HTTP_REQUESTS = REGISTRY.register(Counter("http_requests_total", "HTTP requests by route and status.", ("method", "route", "status")))
+HTTP_LATENCY = REGISTRY.register(Histogram("http_request_duration_seconds", "HTTP request latency by route.", ("method", "route")))
+HTTP_IN_FLIGHT = REGISTRY.register(Gauge("http_requests_in_flight", "HTTP requests currently being served."))
+HTTP_ERRORS = REGISTRY.register(Counter("http_request_errors_total", "Requests that failed with a 5xx or an exception.", ("route", "kind")))
+STAGE_LATENCY = REGISTRY.register(Histogram("stage_duration_seconds", "Time spent in each processing stage.", ("stage",)))
+CHAT_TTFT = REGISTRY.register(Histogram("chat_time_to_first_token_seconds", "Time to the first streamed /chat token."))
+LLM_PROMPT_TOKENS = REGISTRY.register(Histogram("llm_prompt_tokens", "Prompt tokens billed per Gemini call.", ("endpoint",), TOKEN_BUCKETS))
+LLM_CACHED_TOKENS = REGISTRY.register(Counter("llm_cached_prompt_tokens_total", "Prompt tokens served from Gemini's context cache.", ("endpoint",)))
+PROMPT_TRUNCATIONS = REGISTRY.register(Counter("prompt_truncations_total", "User inputs cut down to the token budget.", ("endpoint",)))
+
+
+def record_stage(name: str, seconds: float):
+    STAGE_LATENCY.observe(seconds, stage=name)
+    stages = request_stages.get()
+    if stages is not None:
+        stages.append((name, seconds))
+
+
+@contextmanager
+def stage(name: str):
+    """
+    Time a block as one processing stage (db_connect, db_query, hash,
+    llm_call, image_decode, ...). Inside a profiled request, the thread
+    running the block is sampled along with the request.
+    """
+    profile = active_profile.get()
+    if profile is not None:
+        profile.attach_thread()
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(name, time.perf_counter() - started)
+        if profile is not None:
+            profile.detach_thread()
+
+
+class MetricsMiddleware:
+    """
+    Records latency, status, in-flight count and errors for every request,
+    labelled with the route template (``/crop/jobs/{job_id}``) rather than
+    the raw path so label cardinality stays bounded.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        status = 500
+        started = time.perf_counter()
+        token = request_stages.set([])
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        HTTP_IN_FLIGHT.inc()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        except Exception:
+            HTTP_ERRORS.inc(route=self._route(scope), kind="exception")
+            raise
+        finally:
+            HTTP_IN_FLIGHT.dec()
+            request_stages.reset(token)
+            route = self._route(scope)
+            HTTP_LATENCY.observe(time.perf_counter() - started, method=scope["method"], route=route)
+            HTTP_REQUESTS.inc(method=scope["method"], route=route, status=status)
+            if status >= 500:
+                HTTP_ERRORS.inc(route=route, kind="status")
+
+    @staticmethod
+    def _route(scope):
+        route = scope.get("route")
+        return getattr(route, "path", "unmatched")
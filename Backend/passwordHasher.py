@@ -0,0 +1,205 @@
+from concurrent.futures import ProcessPoolExecutor
+from metrics import stage
+import asyncio
+import bcrypt  # type: ignore
+import math
+import os
+import threading
+import time
+
+MIN_ROUNDS = 10
+MAX_ROUNDS = 16
+# Bulk hashing sends this many passwords per pool task
+BULK_CHUNK = 4
+
+
+def _hashpw(password: bytes, rounds: int) -> str:
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds)).decode('utf-8')
+
+
+def _hashpw_many(passwords, rounds: int) -> list:
+    return [_hashpw(password, rounds) for password in passwords]
+
+
+def _checkpw(password: bytes, hashed: bytes) -> bool:
+    return bcrypt.checkpw(password, hashed)
+
+
+def hash_rounds(hashed: str) -> int:
+    """
+    Read the cost factor out of a ``$2b$<rounds>$...`` bcrypt hash.
+    """
+    try:
+        return int(hashed.split('$')[2])
+    except (IndexError, ValueError):
+        return 0
+
+
+def calibrate_rounds(target_ms: float) -> int:
+    """
+    Return the cost factor whose hash takes closest to ``target_ms`` in
+    this process. Each extra round doubles the cost, so one hash at the
+    minimum cost is enough to extrapolate.
+    """
+    started = time.perf_counter()
+    _hashpw(b"calibration", MIN_ROUNDS)
+    base_ms = max((time.perf_counter() - started) * 1000, 0.001)
+    extra = round(math.log2(target_ms / base_ms)) if target_ms > base_ms else 0
+    return max(MIN_ROUNDS, min(MAX_ROUNDS, MIN_ROUNDS + extra))
+
+
+class PasswordHasher:
+    """
+    Runs bcrypt on a process pool sized to the machine's cores.
+
+    bcrypt is pure CPU work, so keeping it in separate processes means
+    logins hash in parallel and never hold the GIL the server needs. The
+    cost factor comes from ``bcrypt_rounds`` when set, otherwise it is
+    calibrated at startup so one hash takes about ``bcrypt_target_ms``.
+    ``hash`` and ``verify`` are awaited from the event loop; callers should
+    not hold a DB thread or connection while they wait.
+    """
+
+    def __init__(self, rounds: int = None, target_ms: float = 250.0, workers: int = None):
+        self.workers = workers or os.cpu_count() or 1
+        self.target_ms = target_ms
+        self.rounds = rounds
+        self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._stats = {
+            "hashes": 0,
+            "verifies": 0,
+            "rehashes": 0,
+            "seconds_total": 0.0,
+            "seconds_max": 0.0,
+        }
+
+    def calibrate(self):
+        """
+        Pick the cost factor whose hash time is closest to the target,
+        measured on a pool worker.
+        """
+        if self.rounds:
+            return self.rounds
+        self.rounds = self._executor.submit(calibrate_rounds, self.target_ms).result()
+        print(f"bcrypt cost calibrated to {self.rounds} rounds (target {self.target_ms:.0f} ms).")
+        return self.rounds
+
+    async def _run(self, fn, *args):
+        with self._lock:
+            self._pending += 1
+        started = time.perf_counter()
+        try:
+            with stage("hash"):
+                # Awaited on the event loop, so no thread waits out the hash
+                return await asyncio.wrap_future(self._executor.submit(fn, *args))
+        finally:
+            elapsed = time.perf_counter() - started
+            with self._lock:
+                self._pending -= 1
+                self._stats["seconds_total"] += elapsed
+                self._stats["seconds_max"] = max(self._stats["seconds_max"], elapsed)
+
+    async def hash(self, password: str) -> str:
+        rounds = self.rounds or self.calibrate()
+        with self._lock:
+            self._stats["hashes"] += 1
+        return await self._run(_hashpw, password.encode('utf-8'), rounds)
+
+    async def hash_many(self, passwords) -> list:
+        """
+        Hash a batch of passwords in input order. Work goes to the pool in
+        small chunks, with at most half the workers busy on the batch, so
+        interactive logins queue behind one chunk at most, not the whole batch.
+        """
+        rounds = self.rounds or self.calibrate()
+        encoded = [password.encode('utf-8') for password in passwords]
+        if not encoded:
+            return []
+        chunks = [encoded[i:i + BULK_CHUNK] for i in range(0, len(encoded), BULK_CHUNK)]
+        results = [None] * len(chunks)
+        slots = asyncio.Semaphore(max(1, self.workers // 2))
+        with self._lock:
+            self._stats["hashes"] += len(encoded)
+            self._pending += len(encoded)
+        started = time.perf_counter()
+
+        async def run_chunk(index, chunk):
+            try:
+                async with slots:
+                    results[index] = await asyncio.wrap_future(self._executor.submit(_hashpw_many, chunk, rounds))
+            finally:
+                # Each chunk leaves the queue exactly once, hashed, failed or cancelled
+                with self._lock:
+                    self._pending -= len(chunk)
+
+        try:
+            with stage("hash"):
+                outcomes = await asyncio.gather(
+                    *(run_chunk(index, chunk) for index, chunk in enumerate(chunks)), return_exceptions=True
+                )
+            for outcome in outcomes:
+                if isinstance(outcome, BaseException):
+                    raise outcome
+            return [hashed for chunk in results for hashed in chunk]
+        finally:
+            elapsed = time.perf_counter() - started
+            with self._lock:
+                # seconds_max stays a per-call figure for single hashes
+                self._stats["seconds_total"] += elapsed
+
+    async def verify(self, password: str, hashed: str) -> bool:
+        with self._lock:
+            self._stats["verifies"] += 1
+        return await self._run(_checkpw, password.encode('utf-8'), hashed.encode('utf-8'))
+
+    def needs_rehash(self, hashed: str) -> bool:
+        """
+        True when the stored hash is weaker than the current cost factor.
+        """
+        return self.rounds is not None and hash_rounds(hashed) < self.rounds
+
+    def record_rehash(self):
+        with self._lock:
+            self._stats["rehashes"] += 1
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats.update({"rounds": self.rounds, "workers": self.workers, "queue_depth": self._pending})
+            return stats
+
+
+_hasher = None
+
+
+def init_hasher():
+    """
+    Create and calibrate the shared hasher. Called once at application startup.
+    """
+    global _hasher
+    if _hasher is None:
+        rounds = os.getenv("bcrypt_rounds")
+        workers = os.getenv("bcrypt_workers")
+        _hasher = PasswordHasher(
+            rounds=int(rounds) if rounds else None,
+            target_ms=float(os.getenv("bcrypt_target_ms", "250")),
+            workers=int(workers) if workers else None,
+        )
+        _hasher.calibrate()
+    return _hasher
+
+
+def get_hasher():
+    return _hasher if _hasher is not None else init_hasher()
+
+
+def close_hasher():
+    global _hasher
+    hasher, _hasher = _hasher, None
+    if hasher is not None:
+        hasher.shutdown()
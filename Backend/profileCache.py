@@ -0,0 +1,152 @@
+import psycopg2  # type: ignore
+import psycopg2.extensions  # type: ignore
+from responseCache import LRUCache
+from createConnection import get_pool
+import os
+import select
+import threading
+
+CHANNEL = "user_profile_invalidate"
+
+
+class ProfileCache:
+    """
+    Read-through cache of user profiles (the /getUserInfo payload).
+
+    Writers call ``invalidate`` after changing a user. A read that started
+    before an invalidation does not store its possibly stale row: every
+    invalidation bumps a generation counter, and ``set`` is skipped when
+    the counter moved since the read began.
+    """
+
+    def __init__(self, max_entries: int = 10000, ttl: float = 300.0):
+        self.cache = LRUCache(max_entries, ttl)
+        self._generation = 0
+        self._lock = threading.Lock()
+        self.invalidations = 0
+        self.remote_invalidations = 0
+
+    def get(self, user_id: str):
+        return self.cache.get(str(user_id))
+
+    def generation(self) -> int:
+        return self._generation
+
+    def set(self, user_id: str, profile: dict, generation: int):
+        with self._lock:
+            if generation == self._generation:
+                self.cache.set(str(user_id), profile)
+
+    def invalidate(self, user_id: str, remote: bool = False):
+        with self._lock:
+            self._generation += 1
+            self.cache.delete(str(user_id))
+            if remote:
+                self.remote_invalidations += 1
+            else:
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self.cache.clear()
+
+    def stats(self):
+        stats = self.cache.stats()
+        stats.update({"invalidations": self.invalidations, "remote_invalidations": self.remote_invalidations})
+        return stats
+
+
+def notify_invalidation(cursor, user_id: str):
+    """
+    Queue a NOTIFY for other workers on the caller's transaction; it is
+    delivered when that transaction commits. A no-op unless cross-worker
+    invalidation is on.
+    """
+    if _listener is None:
+        return
+    cursor.execute("SELECT pg_notify(%s, %s)", (CHANNEL, str(user_id)))
+
+
+class InvalidationListener:
+    """
+    Background thread that LISTENs for profile invalidations from other
+    workers on its own connection (outside the pool). After a lost
+    connection the whole cache is cleared, since notifications may have
+    been missed.
+    """
+
+    def __init__(self, profiles: ProfileCache, dsn: str, poll_interval: float = 5.0):
+        self.profiles = profiles
+        self.dsn = dsn
+        self.poll_interval = poll_interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="profile-listener", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.poll_interval + 1)
+
+    def _run(self):
+        backoff = 1.0
+        while not self._stop.is_set():
+            conn = None
+            try:
+                conn = psycopg2.connect(self.dsn)
+                conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                with conn.cursor() as cursor:
+                    cursor.execute(f"LISTEN {CHANNEL}")
+                self.profiles.clear()
+                backoff = 1.0
+                while not self._stop.is_set():
+                    if select.select([conn], [], [], self.poll_interval) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        self.profiles.invalidate(conn.notifies.pop(0).payload, remote=True)
+            except psycopg2.Error as e:
+                print(f"Profile cache listener error: {e}")
+                self.profiles.clear()
+                self._stop.wait(backoff)
+                backoff = min(backoff * 2, 60.0)
+            finally:
+                if conn is not None:
+                    conn.close()
+
+
+_profiles = None
+_listener = None
+
+
+def get_profile_cache() -> ProfileCache:
+    global _profiles
+    if _profiles is None:
+        _profiles = ProfileCache(
+            max_entries=int(os.getenv("profile_cache_size", "10000")),
+            ttl=float(os.getenv("profile_cache_ttl", "300")),
+        )
+    return _profiles
+
+
+def start_profile_listener():
+    """
+    Start cross-worker invalidation when ``profile_cache_listen`` is set.
+    Called once at application startup.
+    """
+    global _listener
+    if _listener is None and os.getenv("profile_cache_listen", "false").lower() in ("1", "true", "yes"):
+        _listener = InvalidationListener(get_profile_cache(), get_pool().dsn)
+        _listener.start()
+    return _listener
+
+
+def stop_profile_listener():
+    global _listener
+    listener, _listener = _listener, None
+    if listener is not None:
+        listener.stop()
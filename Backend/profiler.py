@@ -0,0 +1,411 @@
+from collections import deque
+from metrics import REGISTRY, Counter, active_profile, request_stages
+import asyncio
+import concurrent.futures
+import contextvars
+import functools
+import hmac
+import os
+import sys
+import threading
+import time
+import uuid
+
+PROFILES = REGISTRY.register(Counter("profiles_captured_total", "Request profiles kept in the ring buffer.", ("kind",)))
+PROFILE_HEADER = b"x-profile"
+MAX_STACK_DEPTH = 128
+# Leaf functions of threads that are only waiting for work
+IDLE_FUNCTIONS = frozenset(("wait", "select", "poll", "_worker", "get", "accept", "_wait_for_tstate_lock"))
+# Work items of ThreadPoolExecutor run in a ``run`` method defined in this file
+THREAD_POOL_FILE = os.path.join(os.path.dirname(concurrent.futures.__file__), "thread.py")
+
+
+def _frame_name(code) -> str:
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def _folded(frame, prefix: str = None) -> str:
+    """
+    One stack as a flamegraph "folded" line, root first.
+    """
+    names = []
+    while frame is not None and len(names) < MAX_STACK_DEPTH:
+        names.append(_frame_name(frame.f_code))
+        frame = frame.f_back
+    if prefix:
+        names.append(prefix)
+    return ";".join(reversed(names))
+
+
+def _await_stack(coro) -> str:
+    """
+    Where a suspended task is waiting, as a folded line: the chain of
+    coroutines from the task's own down to the innermost ``await``.
+    """
+    names = ["awaiting"]
+    while coro is not None and len(names) < MAX_STACK_DEPTH:
+        frame = getattr(coro, "cr_frame", None) or getattr(coro, "gi_frame", None) or getattr(coro, "ag_frame", None)
+        if frame is None:
+            break
+        names.append(_frame_name(frame.f_code))
+        coro = getattr(coro, "cr_await", None) or getattr(coro, "gi_yieldfrom", None) or getattr(coro, "ag_await", None)
+    return ";".join(names) if len(names) > 1 else None
+
+
+def _work_item_profile(frame):
+    """
+    The profile of the request an executor thread is working for. asyncio's
+    to_thread, run_db and the image pool all run their function through
+    ``Context.run`` on a copy of the request's context, which the work item
+    on the thread's stack still holds. Found by duck typing rather than
+    the executor's private classes; anything unrecognised yields None and
+    the thread is only sampled inside ``metrics.stage`` blocks.
+    """
+    while frame is not None:
+        code = frame.f_code
+        if code.co_name == "run" and code.co_filename == THREAD_POOL_FILE:
+            fn = getattr(frame.f_locals.get("self"), "fn", None)
+            if isinstance(fn, functools.partial):
+                fn = fn.func
+            context = getattr(fn, "__self__", None)
+            return context.get(active_profile) if isinstance(context, contextvars.Context) else None
+        frame = frame.f_back
+    return None
+
+
+class RequestProfile:
+    """
+    Samples and stage timings of one request: its frames while the event
+    loop runs them, the awaits it is suspended in otherwise, and the
+    executor threads working for it. Threads that are not executor workers
+    register themselves inside ``metrics.stage`` blocks.
+    """
+
+    def __init__(self, kind: str, method: str, path: str, sampling: bool, loop, marker):
+        self.id = uuid.uuid4().hex[:12]
+        self.kind = kind
+        self.method = method
+        self.path = path
+        self.route = path
+        self.status = None
+        self.sampling = sampling
+        self.loop = loop
+        self.loop_thread = threading.get_ident()
+        self.marker = marker  # this request's middleware frame, to recognise it on the loop's stack
+        self.task = asyncio.current_task()
+        self.started = time.perf_counter()
+        self.started_at = time.time()
+        self.duration = None
+        self.stages = []
+        self.stacks = {}
+        self.samples = 0
+        self.threads = {}  # thread ident -> nesting depth
+        self._threads_lock = threading.Lock()
+
+    def attach_thread(self):
+        ident = threading.get_ident()
+        if ident != self.loop_thread:
+            with self._threads_lock:
+                self.threads[ident] = self.threads.get(ident, 0) + 1
+
+    def detach_thread(self):
+        ident = threading.get_ident()
+        with self._threads_lock:
+            depth = self.threads.get(ident, 0) - 1
+            if depth > 0:
+                self.threads[ident] = depth
+            else:
+                self.threads.pop(ident, None)
+
+    def attached_threads(self):
+        with self._threads_lock:
+            return list(self.threads)
+
+    def add_sample(self, stack: str):
+        self.stacks[stack] = self.stacks.get(stack, 0) + 1
+        self.samples += 1
+
+    def folded(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in sorted(self.stacks.items()))
+
+    def summary(self) -> dict:
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "method": self.method,
+            "route": self.route,
+            "path": self.path,
+            "status": self.status,
+            "started_at": self.started_at,
+            "duration_ms": round(self.duration * 1000, 1) if self.duration is not None else None,
+            "samples": self.samples,
+            "stages": [{"stage": name, "ms": round(seconds * 1000, 2)} for name, seconds in self.stages],
+        }
+
+
+class Profiler:
+    """
+    Opt-in sampling profiler for requests.
+
+    A request is profiled when it carries ``X-Profile: <profiler_token>``,
+    when an admin has asked for the next N requests, or, with
+    ``slow_ms`` set, when it runs long: sampling of every request starts
+    once it has run for half the threshold, and those that end up over it
+    are kept. One background thread samples stacks every ``interval_ms``
+    and sleeps while nothing is being profiled. Samples are wall-clock:
+    time a request spends awaiting (a model call, a database query) shows
+    up under ``awaiting``, next to the threads doing that work. Finished
+    profiles go into a ring buffer of ``capacity`` entries.
+    """
+
+    def __init__(self, token: str = None, slow_ms: float = 0, interval_ms: float = 10, capacity: int = 50):
+        self.token = token
+        self.slow_ms = slow_ms
+        self.interval = interval_ms / 1000
+        self.captures = deque(maxlen=capacity)
+        self.profile_next = 0
+        self.profile_route = None
+        self._in_flight = {}  # id -> RequestProfile
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self.stats_counts = {"profiled": 0, "slow_captured": 0, "samples": 0}
+
+    @property
+    def active(self) -> bool:
+        return bool(self.slow_ms > 0 or self.profile_next > 0 or self.token)
+
+    def check_token(self, value) -> bool:
+        return bool(self.token and value and hmac.compare_digest(str(value).encode("utf-8"), self.token.encode("utf-8")))
+
+    def configure(self, slow_ms: float = None, profile_next: int = None, route: str = None):
+        with self._lock:
+            if slow_ms is not None:
+                self.slow_ms = max(0.0, slow_ms)
+            if profile_next is not None:
+                self.profile_next = max(0, profile_next)
+                self.profile_route = route or None
+
+    def _requested(self, scope) -> str:
+        """
+        Why this request should be sampled from the start, if at all.
+        """
+        if self.token:
+            for name, value in scope.get("headers") or []:
+                if name == PROFILE_HEADER and self.check_token(value.decode("latin-1")):
+                    return "header"
+        if self.profile_next > 0 and (self.profile_route is None or scope["path"].startswith(self.profile_route)):
+            with self._lock:
+                if self.profile_next > 0:
+                    self.profile_next -= 1
+                    return "admin"
+        return None
+
+    def begin(self, scope, marker):
+        kind = self._requested(scope)
+        if kind is None and self.slow_ms <= 0:
+            return None
+        profile = RequestProfile(kind or "slow", scope["method"], scope["path"], kind is not None,
+                                 asyncio.get_running_loop(), marker)
+        with self._lock:
+            self._in_flight[profile.id] = profile
+        self._ensure_thread()
+        self._wakeup.set()
+        return profile
+
+    def finish(self, profile: RequestProfile, route: str, status: int, stages):
+        with self._lock:
+            self._in_flight.pop(profile.id, None)
+        profile.duration = time.perf_counter() - profile.started
+        profile.route = route
+        profile.status = status
+        profile.stages = list(stages or [])
+        profile.marker = None
+        profile.loop = None
+        profile.task = None
+        if profile.kind == "slow":
+            if profile.duration * 1000 < self.slow_ms:
+                return
+            self.stats_counts["slow_captured"] += 1
+        else:
+            self.stats_counts["profiled"] += 1
+        self.captures.append(profile)
+        PROFILES.inc(kind=profile.kind)
+
+    def _ensure_thread(self):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+                    self._thread.start()
+
+    def _loop_owner(self, profiles, frame):
+        """
+        The profile whose task is running on the event loop right now.
+        """
+        loop = profiles[0].loop
+        task = asyncio.current_task(loop) if loop is not None else None
+        if task is not None and hasattr(task, "get_context"):
+            # Python 3.12+: also covers tasks the request spawned (e.g. streaming bodies)
+            return task.get_context().get(active_profile)
+        markers = {id(profile.marker): profile for profile in profiles if profile.marker is not None}
+        while frame is not None:
+            if id(frame) in markers:
+                return markers[id(frame)]
+            frame = frame.f_back
+        return None
+
+    def _sample(self, profiles):
+        sampling = [profile for profile in profiles if profile.sampling]
+        if not sampling:
+            return
+        frames = sys._current_frames()
+        frames.pop(threading.get_ident(), None)
+        loop_frame = frames.pop(sampling[0].loop_thread, None)
+        owner = self._loop_owner(profiles, loop_frame) if loop_frame is not None else None
+        for profile in sampling:
+            if profile is owner:
+                profile.add_sample(_folded(loop_frame, "event-loop"))
+            elif profile.task is not None:
+                # Not running right now: count the wall-clock time where it is waiting
+                stack = _await_stack(profile.task.get_coro())
+                if stack:
+                    profile.add_sample(stack)
+
+        attached = {ident: profile for profile in sampling for ident in profile.attached_threads()}
+        names = None
+        for ident, frame in frames.items():
+            if frame.f_code.co_name in IDLE_FUNCTIONS:
+                continue
+            profile = _work_item_profile(frame) or attached.get(ident)
+            if profile is None or not profile.sampling:
+                continue
+            if names is None:
+                names = {thread.ident: thread.name for thread in threading.enumerate()}
+            profile.add_sample(_folded(frame, names.get(ident, "thread")))
+        self.stats_counts["samples"] += 1
+
+    def _run(self):
+        while not self._stop.is_set():
+            with self._lock:
+                profiles = list(self._in_flight.values())
+            if not profiles:
+                self._wakeup.clear()
+                self._wakeup.wait(1.0)
+                continue
+            if self.slow_ms > 0:
+                # Slow requests are sampled from half the threshold on
+                start_after = self.slow_ms / 2000
+                now = time.perf_counter()
+                for profile in profiles:
+                    if not profile.sampling and now - profile.started >= start_after:
+                        profile.sampling = True
+            try:
+                self._sample(profiles)
+            except Exception as e:
+                print(f"Profiler sampling error: {e}")
+            time.sleep(self.interval)
+
+    def stop(self):
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout=1)
+
+    def capture(self, capture_id: str):
+        for profile in self.captures:
+            if profile.id == capture_id:
+                return profile
+        return None
+
+    def folded(self, route: str = None, kind: str = None) -> str:
+        """
+        All matching captures merged into one folded-stacks document.
+        """
+        merged = {}
+        for profile in list(self.captures):
+            if (route is None or profile.route == route) and (kind is None or profile.kind == kind):
+                for stack, count in profile.stacks.items():
+                    merged[stack] = merged.get(stack, 0) + count
+        return "".join(f"{stack} {count}\n" for stack, count in sorted(merged.items()))
+
+    def clear(self):
+        self.captures.clear()
+
+    def stats(self):
+        stats = dict(self.stats_counts)
+        stats.update({
+            "slow_ms": self.slow_ms,
+            "interval_ms": self.interval * 1000,
+            "profile_next": self.profile_next,
+            "in_flight": len(self._in_flight),
+            "captures": len(self.captures),
+            "capacity": self.captures.maxlen,
+        })
+        return stats
+
+
+class ProfilerMiddleware:
+    """
+    Starts and finishes request profiles. When nothing asks for profiling
+    it passes requests straight through. Profiled responses carry an
+    ``X-Profile-Id`` header naming their capture.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        profiler = get_profiler()
+        if scope["type"] != "http" or not profiler.active:
+            return await self.app(scope, receive, send)
+        profile = profiler.begin(scope, sys._getframe())
+        if profile is None:
+            return await self.app(scope, receive, send)
+
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                if profile.kind != "slow":
+                    message["headers"] = list(message.get("headers", [])) + [(b"x-profile-id", profile.id.encode())]
+            await send(message)
+
+        token = active_profile.set(profile)
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            active_profile.reset(token)
+            route = getattr(scope.get("route"), "path", "unmatched")
+            profiler.finish(profile, route, status, request_stages.get())
+
+
+_profiler = None
+
+
+def get_profiler() -> Profiler:
+    """
+    The shared profiler, configured from ``profiler_token`` (enables the
+    X-Profile header and the admin endpoints), ``profiler_slow_ms``
+    (0 = no slow-request capture), ``profiler_interval_ms`` and
+    ``profiler_buffer``.
+    """
+    global _profiler
+    if _profiler is None:
+        _profiler = Profiler(
+            token=os.getenv("profiler_token") or None,
+            slow_ms=float(os.getenv("profiler_slow_ms", "0")),
+            interval_ms=float(os.getenv("profiler_interval_ms", "10")),
+            capacity=int(os.getenv("profiler_buffer", "50")),
+        )
+    return _profiler
+
+
+def close_profiler():
+    global _profiler
+    profiler, _profiler = _profiler, None
+    if profiler is not None:
+        profiler.stop()
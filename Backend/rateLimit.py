@@ -0,0 +1,233 @@
+from collections import OrderedDict
+from asyncDb import run_db
+from createConnection import pooled_connection
+from metrics import REGISTRY, Counter
+from sessionTokens import TokenError, bearer_token, get_session_tokens
+import json
+import math
+import os
+import threading
+import time
+
+RATE_LIMITED = REGISTRY.register(Counter("rate_limited_total", "Requests rejected with 429.", ("route_class", "reason")))
+
+# (method or None, path prefix, route class); first match wins
+ROUTE_CLASSES = (
+    (None, "/login", "auth"),
+    (None, "/register", "auth"),
+    (None, "/users/import", "auth"),
+    (None, "/updatePassword", "auth"),
+    (None, "/chat", "llm"),
+    (None, "/weather-discription", "llm"),
+    (None, "/weather-advisories", "llm"),
+    ("GET", "/crop/jobs", "default"),
+    (None, "/crop", "crop"),
+)
+EXEMPT_PATHS = ("/stats", "/metrics", "/healthz")
+DEFAULT_LIMITS = {"auth": "10/60", "llm": "30/60", "crop": "20/60", "default": "600/60"}
+DEFAULT_MAX_IN_FLIGHT = {"auth": 32, "llm": 64, "crop": 32, "default": 0}
+
+
+def parse_limit(value: str):
+    """
+    Parse ``"10/60"`` (10 requests per 60 seconds) into ``(capacity, rate)``
+    for a token bucket: a burst of 10, refilled at 10/60 tokens per second.
+    """
+    count, _, seconds = value.partition("/")
+    capacity = float(count)
+    return capacity, capacity / float(seconds or 1)
+
+
+class LocalBucketStore:
+    """
+    Token buckets kept in this process. Least recently used keys are
+    dropped past ``max_keys`` so memory stays bounded.
+    """
+
+    def __init__(self, max_keys: int = 100000):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()  # key -> (tokens, updated)
+        self._lock = threading.Lock()
+
+    def _take(self, key: str, capacity: float, rate: float) -> float:
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated) * rate)
+            retry_after = 0.0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                retry_after = (1 - tokens) / rate
+            self._buckets[key] = (tokens, now)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+            return retry_after
+
+    async def take(self, key: str, capacity: float, rate: float) -> float:
+        """
+        Spend one token; return 0 if allowed, else seconds until one is available.
+        """
+        return self._take(key, capacity, rate)
+
+
+class PostgresBucketStore:
+    """
+    Token buckets in the ``rate_limits`` table, so the limits hold across
+    worker processes and hosts. Each check is one atomic upsert timed by
+    the database clock.
+    """
+
+    PURGE_EVERY = 10000
+
+    def __init__(self):
+        self._calls = 0
+
+    def _take(self, key: str, capacity: float, rate: float) -> float:
+        self._calls += 1
+        with pooled_connection() as conn, conn.cursor() as cursor:
+            cursor.execute("""
+                WITH now AS (SELECT extract(epoch FROM clock_timestamp()) AS ts)
+                INSERT INTO rate_limits AS r (key, tokens, updated_at, allowed)
+                SELECT %(key)s, %(capacity)s - 1, now.ts, TRUE FROM now
+                ON CONFLICT (key) DO UPDATE SET
+                    tokens = CASE
+                        WHEN LEAST(%(capacity)s, r.tokens + (EXCLUDED.updated_at - r.updated_at) * %(rate)s) >= 1
+                        THEN LEAST(%(capacity)s, r.tokens + (EXCLUDED.updated_at - r.updated_at) * %(rate)s) - 1
+                        ELSE LEAST(%(capacity)s, r.tokens + (EXCLUDED.updated_at - r.updated_at) * %(rate)s)
+                    END,
+                    allowed = LEAST(%(capacity)s, r.tokens + (EXCLUDED.updated_at - r.updated_at) * %(rate)s) >= 1,
+                    updated_at = EXCLUDED.updated_at
+                RETURNING allowed, tokens
+            """, {"key": key, "capacity": capacity, "rate": rate})
+            allowed, tokens = cursor.fetchone()
+            if self._calls % self.PURGE_EVERY == 0:
+                # Buckets idle for a day are full again; dropping them changes nothing
+                cursor.execute("DELETE FROM rate_limits WHERE updated_at < extract(epoch FROM clock_timestamp()) - 86400")
+            conn.commit()
+        return 0.0 if allowed else (1 - tokens) / rate
+
+    async def take(self, key: str, capacity: float, rate: float) -> float:
+        try:
+            return await run_db(self._take, key, capacity, rate)
+        except Exception as e:
+            # Fail open: an unreachable limiter must not take the API down with it
+            print(f"Rate limiter error: {e}")
+            return 0.0
+
+
+class RateLimitMiddleware:
+    """
+    Per-IP and per-user token buckets with a separate budget per route
+    class (auth, llm, crop, default), plus admission control: each class
+    has a cap on requests in flight, and requests over it are turned away
+    at once instead of queueing behind the others. Rejections are 429 with
+    a Retry-After header, sent before the body is read.
+
+    Users are only told apart by a valid bearer token. Query parameters
+    such as email are not trusted, so nobody can drain another user's
+    budget (or lock them out of /login) by naming them.
+    """
+
+    def __init__(self, app, store=None, limits: dict = None, max_in_flight: dict = None, trust_proxy: bool = False):
+        self.app = app
+        self.store = store or LocalBucketStore()
+        self.limits = {name: parse_limit(value) for name, value in (limits or DEFAULT_LIMITS).items()}
+        self.max_in_flight = dict(max_in_flight or DEFAULT_MAX_IN_FLIGHT)
+        self.trust_proxy = trust_proxy
+        self._in_flight = {}
+
+    @staticmethod
+    def route_class(method: str, path: str):
+        if path.startswith(EXEMPT_PATHS):
+            return None
+        for rule_method, prefix, name in ROUTE_CLASSES:
+            if (rule_method is None or rule_method == method) and path.startswith(prefix):
+                return name
+        return "default"
+
+    def _client_ip(self, scope):
+        if self.trust_proxy:
+            for name, value in scope.get("headers") or []:
+                if name == b"x-forwarded-for":
+                    return value.decode("latin-1").split(",")[0].strip()
+        client = scope.get("client")
+        return client[0] if client else "unknown"
+
+    @staticmethod
+    def _user(scope):
+        for name, value in scope.get("headers") or []:
+            if name == b"authorization":
+                token = bearer_token(value.decode("latin-1"))
+                try:
+                    return get_session_tokens().verify(token) if token else None
+                except TokenError:
+                    return None
+        return None
+
+    async def _check_rate(self, scope, route_class):
+        limit = self.limits.get(route_class) or self.limits.get("default")
+        if limit is None:
+            return 0.0
+        capacity, rate = limit
+        keys = [f"{route_class}:ip:{self._client_ip(scope)}"]
+        user = self._user(scope)
+        if user:
+            keys.append(f"{route_class}:user:{user}")
+        retry_after = 0.0
+        for key in keys:
+            retry_after = max(retry_after, await self.store.take(key, capacity, rate))
+        return retry_after
+
+    async def __call__(self, scope, receive, send):
+        route_class = self.route_class(scope["method"], scope["path"]) if scope["type"] == "http" else None
+        if route_class is None:
+            return await self.app(scope, receive, send)
+
+        cap = self.max_in_flight.get(route_class, 0)
+        if cap and self._in_flight.get(route_class, 0) >= cap:
+            RATE_LIMITED.inc(route_class=route_class, reason="admission")
+            return await self._reject(send, 1.0, "Server is busy, please retry shortly.")
+
+        retry_after = await self._check_rate(scope, route_class)
+        if retry_after > 0:
+            RATE_LIMITED.inc(route_class=route_class, reason="rate")
+            return await self._reject(send, retry_after, "Too many requests, please slow down.")
+
+        self._in_flight[route_class] = self._in_flight.get(route_class, 0) + 1
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self._in_flight[route_class] -= 1
+
+    async def _reject(self, send, retry_after: float, message: str):
+        seconds = max(1, math.ceil(retry_after))
+        body = json.dumps({"detail": message, "retry_after": seconds}).encode("utf-8")
+        await send({
+            "type": "http.response.start",
+            "status": 429,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode()),
+                (b"retry-after", str(seconds).encode()),
+            ],
+        })
+        await send({"type": "http.response.body", "body": body})
+
+
+def rate_limit_options_from_env() -> dict:
+    """
+    Middleware options from ``rate_limit_<class>`` (e.g. ``10/60``),
+    ``admission_<class>`` (max in flight, 0 = unlimited),
+    ``rate_limit_backend`` (``local`` or ``postgres``) and
+    ``rate_limit_trust_proxy``.
+    """
+    limits = {name: os.getenv(f"rate_limit_{name}", value) for name, value in DEFAULT_LIMITS.items()}
+    max_in_flight = {name: int(os.getenv(f"admission_{name}", str(value))) for name, value in DEFAULT_MAX_IN_FLIGHT.items()}
+    backend = os.getenv("rate_limit_backend", "local").lower()
+    return {
+        "store": PostgresBucketStore() if backend == "postgres" else LocalBucketStore(),
+        "limits": limits,
+        "max_in_flight": max_in_flight,
+        "trust_proxy": os.getenv("rate_limit_trust_proxy", "false").lower() in ("1", "true", "yes"),
+    }
@@ -0,0 +1,175 @@
+from collections import OrderedDict
+import asyncio
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+
+
+def normalize_prompt(prompt: str) -> str:
+    """
+    Collapse case and whitespace so trivially different prompts share a key.
+    """
+    return re.sub(r"\s+", " ", prompt).strip().lower()
+
+
+class LRUCache:
+    """
+    Thread-safe in-process LRU cache whose entries expire after ``ttl`` seconds.
+    """
+
+    def __init__(self, max_entries: int = 1024, ttl: float = 3600.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._data = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._data[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl: float = None):
+        with self._lock:
+            self._data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._data),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+
+class ResponseCache:
+    """
+    Cache of model responses keyed on the model name and normalized prompt.
+
+    Lookups hit the in-process LRU first. When ``db_path`` is set, entries
+    are also written to a SQLite file so they survive restarts and are
+    shared by every worker on the host.
+    """
+
+    def __init__(self, max_entries: int = 1024, ttl: float = 3600.0, db_path: str = None):
+        self.memory = LRUCache(max_entries, ttl)
+        self.ttl = ttl
+        self.db_path = db_path
+        self.disk_hits = 0
+        self._db = None
+        self._db_lock = threading.Lock()
+        if db_path:
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    expires_at REAL NOT NULL
+                )
+            """)
+            self._db.execute("CREATE INDEX IF NOT EXISTS responses_expires_at_idx ON responses (expires_at)")
+            self._db.commit()
+
+    @staticmethod
+    def key(model: str, prompt: str) -> str:
+        return hashlib.sha256(f"{model}\0{normalize_prompt(prompt)}".encode('utf-8')).hexdigest()
+
+    def get(self, key: str):
+        value = self.memory.get(key)
+        if value is not None or self._db is None:
+            return value
+        return self._disk_get(key)
+
+    def _disk_get(self, key: str):
+        with self._db_lock:
+            row = self._db.execute(
+                "SELECT value, expires_at FROM responses WHERE key = ? AND expires_at > ?", (key, time.time())
+            ).fetchone()
+        if row is None:
+            return None
+        self.disk_hits += 1
+        self.memory.set(key, row[0], ttl=row[1] - time.time())
+        return row[0]
+
+    def set(self, key: str, value: str):
+        self.memory.set(key, value)
+        if self._db is not None:
+            self._disk_set(key, value)
+
+    def _disk_set(self, key: str, value: str):
+        with self._db_lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, value, time.time() + self.ttl),
+            )
+            self._db.execute("DELETE FROM responses WHERE expires_at <= ?", (time.time(),))
+            self._db.commit()
+
+    async def lookup(self, key: str):
+        """
+        ``get`` for async callers: memory hits are answered on the event
+        loop, the SQLite read runs on a worker thread.
+        """
+        value = self.memory.get(key)
+        if value is not None or self._db is None:
+            return value
+        return await asyncio.to_thread(self._disk_get, key)
+
+    async def store(self, key: str, value: str):
+        """
+        ``set`` for async callers; the SQLite write and commit run on a
+        worker thread.
+        """
+        self.memory.set(key, value)
+        if self._db is not None:
+            await asyncio.to_thread(self._disk_set, key, value)
+
+    def stats(self):
+        stats = self.memory.stats()
+        stats["disk_hits"] = self.disk_hits
+        stats["disk_enabled"] = self._db is not None
+        return stats
+
+
+def cache_from_env(prefix: str) -> ResponseCache:
+    """
+    Build a cache from ``<prefix>_size``, ``<prefix>_ttl`` and ``<prefix>_db``.
+    """
+    return ResponseCache(
+        max_entries=int(os.getenv(f"{prefix}_size", "1024")),
+        ttl=float(os.getenv(f"{prefix}_ttl", "3600")),
+        db_path=os.getenv(f"{prefix}_db") or None,
+    )
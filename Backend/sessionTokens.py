@@ -0,0 +1,101 @@
+from dotenv import load_dotenv  # type: ignore
+import base64
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import time
+
+
+class TokenError(Exception):
+    """
+    Raised for a token that is malformed, forged or expired.
+    """
+
+
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+
+def _b64decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+class SessionTokens:
+    """
+    Signed, expiring access tokens (``<payload>.<HMAC-SHA256>``, base64url).
+
+    A token carries the user id and its expiry, so it is checked with one
+    HMAC and no database lookup. Tokens signed with any of
+    ``previous_secrets`` are still accepted, which allows rotating the
+    secret without logging everyone out.
+    """
+
+    def __init__(self, secret: str, ttl: float = 12 * 3600, previous_secrets=()):
+        self.ttl = ttl
+        self._keys = [key.encode("utf-8") for key in (secret, *previous_secrets) if key]
+
+    def _sign(self, key: bytes, payload: bytes) -> str:
+        return _b64encode(hmac.new(key, payload, hashlib.sha256).digest())
+
+    def issue(self, user_id: str):
+        """
+        Return ``(token, expires_at)`` for a user, ``expires_at`` in epoch seconds.
+        """
+        expires_at = int(time.time() + self.ttl)
+        payload = _b64encode(json.dumps({"sub": user_id, "exp": expires_at}, separators=(",", ":")).encode("utf-8"))
+        return f"{payload}.{self._sign(self._keys[0], payload.encode('ascii'))}", expires_at
+
+    def verify(self, token: str) -> str:
+        """
+        Return the user id of a valid token; raise TokenError otherwise.
+        """
+        payload, _, signature = (token or "").partition(".")
+        if not payload or not signature:
+            raise TokenError("Malformed token.")
+        try:
+            # Tokens are base64url; anything else (e.g. non-ASCII header bytes) is malformed
+            payload_bytes = payload.encode("ascii")
+            signature_bytes = signature.encode("ascii")
+        except UnicodeError as e:
+            raise TokenError("Malformed token.") from e
+        if not any(hmac.compare_digest(signature_bytes, self._sign(key, payload_bytes).encode("ascii")) for key in self._keys):
+            raise TokenError("Invalid token signature.")
+        try:
+            claims = json.loads(_b64decode(payload))
+            expires_at, user_id = claims.get("exp", 0), claims["sub"]
+        except (ValueError, TypeError, KeyError, AttributeError) as e:
+            raise TokenError("Malformed token.") from e
+        if expires_at < time.time():
+            raise TokenError("Token has expired.")
+        return user_id
+
+
+_tokens = None
+
+
+def get_session_tokens():
+    """
+    The shared token signer, configured from ``session_secret``,
+    ``session_secret_previous`` (comma separated) and ``session_token_ttl``.
+    """
+    global _tokens
+    if _tokens is None:
+        load_dotenv()
+        secret = os.getenv("session_secret")
+        if not secret:
+            # Tokens then only verify in this process and die with it
+            print("session_secret is not set; using a random per-process secret.")
+            secret = secrets.token_urlsafe(32)
+        previous = [key.strip() for key in os.getenv("session_secret_previous", "").split(",") if key.strip()]
+        _tokens = SessionTokens(secret, float(os.getenv("session_token_ttl", str(12 * 3600))), previous)
+    return _tokens
+
+
+def bearer_token(authorization: str):
+    """
+    Extract the token from an ``Authorization: Bearer <token>`` header value.
+    """
+    scheme, _, token = (authorization or "").partition(" ")
+    return token.strip() if scheme.lower() == "bearer" and token.strip() else None
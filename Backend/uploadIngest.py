@@ -0,0 +1,145 @@
+from fastapi import HTTPException
+import asyncio
+import hashlib
+import os
+import tempfile
+
+CHUNK_SIZE = 256 * 1024
+
+
+class UploadTooLarge(HTTPException):
+    """
+    An HTTPException so it becomes a 413 wherever it is raised, including
+    while FastAPI is still parsing a multipart body.
+    """
+
+    def __init__(self, limit: int):
+        super().__init__(status_code=413, detail=f"Upload exceeds the {limit} byte limit.")
+        self.limit = limit
+
+
+class IngestedUpload:
+    """
+    An upload held in memory together with its sha256, ready to hand
+    straight to preprocessing without touching the disk.
+    """
+
+    def __init__(self, data: bytes, digest: str):
+        self.data = data
+        self.digest = digest
+        self.size = len(data)
+
+
+async def ingest_stream(chunks, max_bytes: int) -> IngestedUpload:
+    """
+    Collect an async iterator of byte chunks, hashing as they arrive and
+    giving up as soon as ``max_bytes`` is exceeded.
+    """
+    hasher = hashlib.sha256()
+    parts = []
+    size = 0
+    async for chunk in chunks:
+        if not chunk:
+            continue
+        size += len(chunk)
+        if size > max_bytes:
+            raise UploadTooLarge(max_bytes)
+        hasher.update(chunk)
+        parts.append(chunk)
+    return IngestedUpload(b"".join(parts), hasher.hexdigest())
+
+
+async def ingest_upload(upload, max_bytes: int, chunk_size: int = CHUNK_SIZE) -> IngestedUpload:
+    """
+    Read a multipart ``UploadFile`` in chunks (see ``ingest_stream``).
+    """
+    if upload.size is not None and upload.size > max_bytes:
+        raise UploadTooLarge(max_bytes)
+
+    async def chunks():
+        while True:
+            chunk = await upload.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+    return await ingest_stream(chunks(), max_bytes)
+
+
+def _write_atomic(path: str, data: bytes):
+    if os.path.exists(path):
+        return
+    # A unique temp file per writer: two uploads of the same content may
+    # race to the same content-addressed path, and either copy will do
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+async def persist_upload(path: str, data: bytes):
+    """
+    Write an upload to disk on a worker thread. Content-addressed paths
+    that already exist are left alone.
+    """
+    await asyncio.to_thread(_write_atomic, path, data)
+
+
+class UploadLimitMiddleware:
+    """
+    Rejects oversized request bodies before they are buffered.
+
+    Requests whose Content-Length is over the limit for their path get a
+    413 straight away. For chunked bodies the bytes are counted as they are
+    received and the request is aborted with 413 once the limit is passed.
+    """
+
+    def __init__(self, app, limits: dict):
+        self.app = app
+        # Longest prefix first so /crop/batch wins over /crop
+        self.limits = sorted(limits.items(), key=lambda item: len(item[0]), reverse=True)
+
+    def _limit_for(self, path: str):
+        for prefix, limit in self.limits:
+            if path.startswith(prefix):
+                return limit
+        return None
+
+    async def __call__(self, scope, receive, send):
+        limit = self._limit_for(scope["path"]) if scope["type"] == "http" else None
+        if limit is None:
+            return await self.app(scope, receive, send)
+
+        headers = dict(scope.get("headers") or [])
+        declared = headers.get(b"content-length")
+        if declared is not None and declared.isdigit() and int(declared) > limit:
+            return await self._reject(send, limit)
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit:
+                    raise UploadTooLarge(limit)
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+    async def _reject(self, send, limit: int):
+        body = f'{{"detail": "{UploadTooLarge(limit).detail}"}}'.encode("utf-8")
+        await send({
+            "type": "http.response.start",
+            "status": 413,
+            "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())],
+        })
+        await send({"type": "http.response.body", "body": body})
@@ -0,0 +1,288 @@
+import psycopg2  # type: ignore
+from createConnection import pooled_connection
+from asyncDb import run_db
+from llmClient import get_llm_client
+from responseCache import LRUCache
+from chatSystem import MODEL_NAME, WEATHER_INSTRUCTIONS
+from metrics import REGISTRY, Counter
+import asyncio
+import json
+import math
+import os
+import re
+import sys
+
+ADVISORY_LOOKUPS = REGISTRY.register(Counter(
+    "weather_advisory_lookups_total", "Weather advisories served, by where the answer came from.", ("source",)))
+
+# Forecasts are rounded into bands; farmers whose forecasts share a region
+# and a band for every field get the same advice.
+TEMPERATURE_STEP = 3  # degrees C
+HUMIDITY_STEP = 20  # percent
+RAIN_EDGES = (0.1, 2, 5, 10, 25, 50)  # mm; below 0.1 counts as dry
+ADVISORY_TURN = (
+    "Region: {region}\n"
+    "Forecast: temperature {temperature}, rainfall {rain}, relative humidity {humidity}.\n"
+    "Give the farmers of this region practical actions for the coming days."
+)
+
+
+def normalize_region(region: str) -> str:
+    return re.sub(r"\s+", " ", str(region or "")).strip().lower()
+
+
+def read_forecast(payload: dict):
+    """
+    Return ``(region, temperature, rain, humidity)`` from a flat payload
+    (``region``, ``temperature``, ``rain``, ``humidity``) or an
+    OpenWeatherMap-style one (``name``, ``main.temp``, ``main.humidity``,
+    ``rain.1h``). Temperatures are in °C and rain in mm; missing rain
+    counts as dry. Raises ValueError when the forecast is incomplete.
+    """
+    main = payload.get("main") or {}
+    region = normalize_region(payload.get("region") or payload.get("location") or payload.get("city") or payload.get("name"))
+    temperature = payload.get("temperature", payload.get("temp", main.get("temp")))
+    humidity = payload.get("humidity", main.get("humidity"))
+    rain = payload.get("rain", payload.get("precipitation")) or 0
+    if isinstance(rain, dict):
+        rain = rain.get("1h", rain.get("3h", 0))
+    if not region or temperature is None or humidity is None:
+        raise ValueError("A forecast needs a region, a temperature and a humidity.")
+    return region, float(temperature), float(rain), float(humidity)
+
+
+def quantize(temperature: float, rain: float, humidity: float) -> dict:
+    """
+    The forecast bands, as labels that read well in a prompt.
+    """
+    low = math.floor(temperature / TEMPERATURE_STEP) * TEMPERATURE_STEP
+    humid = min(100 - HUMIDITY_STEP, max(0, math.floor(humidity / HUMIDITY_STEP) * HUMIDITY_STEP))
+    if rain < RAIN_EDGES[0]:
+        rain_band = "none"
+    else:
+        lower = [edge for edge in RAIN_EDGES if edge <= rain][-1]
+        upper = next((edge for edge in RAIN_EDGES if edge > rain), None)
+        rain_band = f"{lower:g}-{upper:g} mm" if upper is not None else f"over {lower:g} mm"
+    return {
+        "temperature": f"{low}-{low + TEMPERATURE_STEP} °C",
+        "rain": rain_band,
+        "humidity": f"{humid}-{humid + HUMIDITY_STEP}%",
+    }
+
+
+def bucket_key(region: str, bands: dict) -> str:
+    return f"{region}|{bands['temperature']}|{bands['rain']}|{bands['humidity']}"
+
+
+class WeatherAdvisories:
+    """
+    Weather advice generated once per bucket (region plus forecast bands)
+    and kept in Postgres (``weather_advisories``), fronted by an in-process
+    LRU.
+
+    A lookup is a primary-key read; the model is only called on a bucket
+    miss, and concurrent misses for the same bucket share one call.
+    ``generate_batch`` fills many buckets ahead of demand (e.g. from a
+    scheduled job when forecasts are updated) with at most
+    ``concurrency`` model calls at a time.
+    """
+
+    def __init__(self, model_name: str, ttl: float = 6 * 3600, concurrency: int = 4,
+                 max_entries: int = 10000, memory_ttl: float = 300.0):
+        self.model_name = model_name
+        self.ttl = ttl
+        self.concurrency = concurrency
+        self.memory = LRUCache(max_entries, min(memory_ttl, ttl))
+        self._pending = {}  # bucket key -> asyncio.Task
+        self.stats_counts = {"memory": 0, "store": 0, "generated": 0, "coalesced": 0, "store_errors": 0, "failures": 0}
+
+    def _load(self, keys):
+        with pooled_connection() as conn, conn.cursor() as cursor:
+            cursor.execute(
+                "SELECT bucket_key, advice FROM weather_advisories WHERE bucket_key = ANY(%s) AND expires_at > CURRENT_TIMESTAMP",
+                (list(keys),),
+            )
+            return dict(cursor.fetchall())
+
+    def _save(self, rows):
+        with pooled_connection() as conn, conn.cursor() as cursor:
+            cursor.executemany("""
+                INSERT INTO weather_advisories (bucket_key, region, bands, advice, created_at, expires_at)
+                VALUES (%s, %s, %s::jsonb, %s, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP + %s * INTERVAL '1 second')
+                ON CONFLICT (bucket_key) DO UPDATE
+                SET advice = EXCLUDED.advice, created_at = EXCLUDED.created_at, expires_at = EXCLUDED.expires_at
+            """, [(key, region, json.dumps(bands), advice, self.ttl) for key, region, bands, advice in rows])
+            conn.commit()
+
+    def _purge(self):
+        with pooled_connection() as conn, conn.cursor() as cursor:
+            cursor.execute("DELETE FROM weather_advisories WHERE expires_at <= CURRENT_TIMESTAMP")
+            conn.commit()
+            return cursor.rowcount
+
+    async def _stored(self, keys) -> dict:
+        try:
+            return await run_db(self._load, keys)
+        except psycopg2.Error as e:
+            # Without the store every bucket is a miss; advice is still generated
+            print(f"Database error: {e}")
+            self.stats_counts["store_errors"] += 1
+            return {}
+
+    async def _store(self, rows):
+        try:
+            await run_db(self._save, rows)
+        except psycopg2.Error as e:
+            print(f"Database error: {e}")
+            self.stats_counts["store_errors"] += 1
+
+    async def _ask_model(self, region: str, bands: dict) -> str:
+        prompt = ADVISORY_TURN.format(region=region, **bands)
+        response = await get_llm_client().generate(
+            self.model_name, prompt, endpoint="weather", model_kwargs={"system_instruction": WEATHER_INSTRUCTIONS}
+        )
+        if not response or not response.text:
+            raise ValueError("No response generated.")
+        return response.text
+
+    async def _generate(self, key: str, region: str, bands: dict) -> str:
+        advice = await self._ask_model(region, bands)
+        self.stats_counts["generated"] += 1
+        self.memory.set(key, advice)
+        await self._store([(key, region, bands, advice)])
+        return advice
+
+    async def _generate_once(self, key: str, region: str, bands: dict) -> str:
+        task = self._pending.get(key)
+        if task is not None:
+            self.stats_counts["coalesced"] += 1
+            return await asyncio.shield(task)
+        task = asyncio.ensure_future(self._generate(key, region, bands))
+        self._pending[key] = task
+        task.add_done_callback(lambda _: self._pending.pop(key, None))
+        # Shielded, so a farmer hanging up does not cancel the call others wait on
+        return await asyncio.shield(task)
+
+    async def advise(self, payload: dict):
+        """
+        Return ``(advice, source)`` for a forecast payload, where source is
+        ``memory``, ``store`` or ``generated``. Raises ValueError for an
+        incomplete forecast and LLMUnavailable when the model is down.
+        """
+        region, temperature, rain, humidity = read_forecast(payload)
+        bands = quantize(temperature, rain, humidity)
+        key = bucket_key(region, bands)
+
+        source = "memory"
+        advice = self.memory.get(key)
+        if advice is None:
+            source = "store"
+            advice = (await self._stored([key])).get(key)
+            if advice is not None:
+                self.memory.set(key, advice)
+        if advice is None:
+            source = "generated"
+            advice = await self._generate_once(key, region, bands)
+        else:
+            self.stats_counts[source] += 1
+        ADVISORY_LOOKUPS.inc(source=source)
+        return advice, source
+
+    async def generate_batch(self, payloads, refresh: bool = False) -> dict:
+        """
+        Make sure every bucket the payloads fall into has advice. Payloads
+        are grouped by bucket first, the store is read once for all of
+        them, and only missing buckets (all of them with ``refresh``) go
+        to the model. Returns counts for the run.
+        """
+        buckets, invalid = {}, 0
+        for payload in payloads:
+            try:
+                region, temperature, rain, humidity = read_forecast(payload)
+            except (AttributeError, TypeError, ValueError):
+                invalid += 1
+                continue
+            bands = quantize(temperature, rain, humidity)
+            buckets.setdefault(bucket_key(region, bands), (region, bands))
+
+        stored = {} if refresh else await self._stored(buckets)
+        missing = {key: value for key, value in buckets.items() if key not in stored}
+        slots = asyncio.Semaphore(self.concurrency)
+        rows, failed = [], 0
+
+        async def fill(key, region, bands):
+            nonlocal failed
+            async with slots:
+                try:
+                    advice = await self._ask_model(region, bands)
+                except Exception as e:
+                    print(f"Weather advisory for {key} failed: {e}")
+                    failed += 1
+                    self.stats_counts["failures"] += 1
+                    return
+            self.stats_counts["generated"] += 1
+            self.memory.set(key, advice)
+            rows.append((key, region, bands, advice))
+
+        await asyncio.gather(*(fill(key, region, bands) for key, (region, bands) in missing.items()))
+        if rows:
+            await self._store(rows)
+        return {
+            "payloads": len(payloads),
+            "invalid": invalid,
+            "buckets": len(buckets),
+            "already_stored": len(buckets) - len(missing),
+            "generated": len(rows),
+            "failed": failed,
+        }
+
+    async def purge_expired(self) -> int:
+        return await run_db(self._purge)
+
+    def stats(self):
+        stats = dict(self.stats_counts)
+        stats.update({"pending": len(self._pending), "memory_cache": self.memory.stats()})
+        return stats
+
+
+def advisories_from_env(model_name: str = MODEL_NAME) -> WeatherAdvisories:
+    return WeatherAdvisories(
+        model_name,
+        ttl=float(os.getenv("weather_advisory_ttl", str(6 * 3600))),
+        concurrency=int(os.getenv("weather_advisory_concurrency", "4")),
+        max_entries=int(os.getenv("weather_advisory_cache_size", "10000")),
+        memory_ttl=float(os.getenv("weather_advisory_memory_ttl", "300")),
+    )
+
+
+async def _run_batch(path: str, refresh: bool):
+    from createConnection import init_pool, close_pool
+    from asyncDb import init_db_executor, close_db_executor
+    from llmClient import init_llm_client, close_llm_client
+
+    init_pool()
+    init_db_executor()
+    init_llm_client()
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            text = f.read()
+        try:
+            payloads = json.loads(text)
+        except ValueError:
+            payloads = [json.loads(line) for line in text.splitlines() if line.strip()]
+        advisories = advisories_from_env()
+        print(await advisories.generate_batch(payloads, refresh))
+        print(f"Expired advisories removed: {await advisories.purge_expired()}")
+    finally:
+        close_llm_client()
+        close_db_executor()
+        close_pool()
+
+
+if __name__ == "__main__":
+    # Scheduled use, e.g. from cron after each forecast update:
+    #   python weatherAdvisory.py forecasts.json [--refresh]
+    # where forecasts.json is a JSON list (or JSON lines) of forecast payloads.
+    if len(sys.argv) < 2:
+        sys.exit("usage: python weatherAdvisory.py FORECASTS.json [--refresh]")
+    asyncio.run(_run_batch(sys.argv[1], "--refresh" in sys.argv[2:]))